@@ -0,0 +1,504 @@
+import mmap
+import wave
+import struct
+import tempfile
+import subprocess
+
+SPEECH_FRAME_RATE = 16000
+
+class TooManyMissingFrames(Exception):
+    pass
+
+def silence(sample_width: int, frames: int, channels: int = 1) -> bytes:
+    """
+    Silent frames as they are stored in a wav file, where 8 bit samples are unsigned and centred on 0x80
+    """
+    return (b"\x80" if sample_width == 1 else bytes(sample_width)) * (channels * frames)
+
+class PcmAudio:
+    """
+    Interleaved PCM samples sliced by milliseconds exactly like pydub's AudioSegment,
+    so that turns written from it are byte-identical to the ones pydub exports
+    """
+    def __init__(self, data, channels: int, sample_width: int, frame_rate: int):
+        self.data = memoryview(data)
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.frame_width = channels * sample_width
+
+    def frame_count(self) -> int:
+        return len(self.data) // self.frame_width
+
+    def __len__(self) -> int:
+        # length in milliseconds, rounded the same way as pydub
+        return round(1000 * (float(self.frame_count()) / self.frame_rate))
+
+    def _parse_position(self, ms: float) -> int:
+        if ms < 0:
+            ms = len(self) - abs(ms)
+
+        return int(ms * (self.frame_rate / 1000.0))
+
+    def slice(self, start_ms: float, end_ms: float | None = None) -> memoryview | bytes:
+        """
+        Returns a view over the frames between two offsets, without copying them
+
+        :param start_ms: Start of the slice in milliseconds
+        :type start_ms: float
+        :param end_ms: End of the slice in milliseconds, end of the recording if None
+        :type end_ms: float | None
+        """
+        if end_ms is None:
+            end_ms = len(self)
+
+        start = self._parse_position(min(start_ms, len(self))) * self.frame_width
+        end = self._parse_position(min(end_ms, len(self))) * self.frame_width
+        data = self.data[start:end]
+
+        # pydub pads the rounding gap at the very end of a recording with silence
+        missing_frames = ((end - start) - len(data)) // self.frame_width
+        if missing_frames and len(data) > 0:
+            if missing_frames > 2 * (self.frame_rate / 1000.0):
+                raise TooManyMissingFrames("Missing {} frames at the end of the recording".format(missing_frames))
+
+            return bytes(data) + silence(self.sample_width, missing_frames, self.channels)
+
+        return data
+
+    def export_wav(self, path: str, start_ms: float, end_ms: float | None = None):
+        """
+        Writes a slice of the recording straight from the underlying buffer into a wav file
+
+        :param path: Destination wav file
+        :type path: str
+        :param start_ms: Start of the slice in milliseconds
+        :type start_ms: float
+        :param end_ms: End of the slice in milliseconds, end of the recording if None
+        :type end_ms: float | None
+        """
+        data = self.slice(start_ms, end_ms)
+
+        with WavWriter(path, self.channels, self.sample_width, self.frame_rate) as writer:
+            writer.write(data)
+
+        if isinstance(data, memoryview):
+            data.release()
+
+    def chunks(self, chunk_frames: int = 65536):
+        for position in range(0, len(self.data), chunk_frames * self.frame_width):
+            yield self.data[position:position + chunk_frames * self.frame_width]
+
+class WavFile(PcmAudio):
+    """
+    Memory-mapped wav file, the PCM payload is only paged in for the slices being read
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise Exception("Couldn't read wav audio from empty file {}".format(path))
+
+        self._view = memoryview(self._map)
+        try:
+            audio_format, channels, sample_rate, bits_per_sample, position, size = _read_wav_headers(self._view)
+            if audio_format != 1 and audio_format != 0xFFFE:
+                raise Exception("Unknown audio format 0x{:X} in {}".format(audio_format, path))
+        except Exception:
+            self.close()
+            raise
+
+        self.data_position = position
+        super().__init__(self._view[position:position + size], channels, bits_per_sample // 8, sample_rate)
+
+    def close(self):
+        if hasattr(self, "data"):
+            self.data.release()
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _read_wav_headers(data: memoryview) -> tuple[int, int, int, int, int, int]:
+    # walks the subchunks the same way pydub does, stopping at the data chunk
+    fmt_position, fmt_size, data_position, data_size = None, 0, None, 0
+    position = 12
+    subchunks = 0
+    while position + 8 <= len(data) and subchunks < 10:
+        subchunk_id = bytes(data[position:position + 4])
+        subchunk_size = struct.unpack_from("<I", data, position + 4)[0]
+        subchunks += 1
+
+        if subchunk_id == b"fmt " and fmt_position is None:
+            fmt_position, fmt_size = position + 8, subchunk_size
+
+        if subchunk_id == b"data":
+            data_position, data_size = position + 8, subchunk_size
+            break
+
+        position += subchunk_size + 8
+
+    if fmt_position is None or fmt_size < 16:
+        raise Exception("Couldn't find fmt header in wav data")
+    if data_position is None:
+        raise Exception("Couldn't find data header in wav data")
+
+    audio_format, channels, sample_rate = struct.unpack_from("<HHI", data, fmt_position)
+    bits_per_sample = struct.unpack_from("<H", data, fmt_position + 14)[0]
+    data_size = min(data_size, len(data) - data_position)
+
+    return audio_format, channels, sample_rate, bits_per_sample, data_position, data_size
+
+_SIGN_EXTENSION = bytes(0xFF if b > 0x7F else 0x00 for b in range(256))
+
+def _widen_24_bit_samples(data) -> bytes:
+    data = bytes(data)
+    widened = bytearray(len(data) // 3 * 4)
+    widened[0::4] = data[2::3].translate(_SIGN_EXTENSION)
+    widened[1::4] = data[0::3]
+    widened[2::4] = data[1::3]
+    widened[3::4] = data[2::3]
+
+    return bytes(widened)
+
+class WavWriter:
+    """
+    Wav file written a chunk at a time, the header is patched with the amount of frames when it is closed
+    """
+    def __init__(self, path: str, channels: int, sample_width: int, frame_rate: int):
+        self.sample_width = sample_width
+        self._wave_file = wave.open(path, "wb")
+        self._wave_file.setnchannels(channels)
+        # pydub stores 24 bit recordings as sign-extended 32 bit samples
+        self._wave_file.setsampwidth(4 if sample_width == 3 else sample_width)
+        self._wave_file.setframerate(frame_rate)
+
+    def write(self, data):
+        if self.sample_width == 3:
+            data = _widen_24_bit_samples(data)
+
+        self._wave_file.writeframesraw(data)
+
+    def close(self):
+        self._wave_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class PcmReader:
+    """
+    Sequential source of PCM frames, read a chunk at a time so that memory stays bounded whatever the length of the recording
+    """
+    channels: int
+    sample_width: int
+    frame_rate: int
+    frame_width: int
+
+    def frame_count(self) -> int | None:
+        # None when the length is only known once the whole recording is read
+        return None
+
+    def read(self, frames: int) -> bytes:
+        raise NotImplementedError()
+
+    def chunks(self, chunk_frames: int = 65536):
+        while True:
+            chunk = self.read(chunk_frames)
+            if len(chunk) == 0:
+                return
+
+            yield chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class WavReader(PcmReader):
+    """
+    Reads a wav file through its memory map, handing back the pages already read so that they don't pile up
+    """
+    def __init__(self, path: str):
+        self._wav_file = WavFile(path)
+        self.channels = self._wav_file.channels
+        self.sample_width = self._wav_file.sample_width
+        self.frame_rate = self._wav_file.frame_rate
+        self.frame_width = self._wav_file.frame_width
+        self._position = 0
+        self._released = 0
+
+    def frame_count(self) -> int:
+        return self._wav_file.frame_count()
+
+    def read(self, frames: int) -> bytes:
+        data = self._wav_file.data
+        end = min(self._position + frames * self.frame_width, len(data))
+        chunk = bytes(data[self._position:end])
+        self._position = end
+        self._release_pages()
+
+        return chunk
+
+    def _release_pages(self):
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+
+        read_until = (self._wav_file.data_position + self._position) // mmap.PAGESIZE * mmap.PAGESIZE
+        if read_until - self._released >= 64 * mmap.PAGESIZE:
+            self._wav_file._map.madvise(mmap.MADV_DONTNEED, self._released, read_until - self._released)
+            self._released = read_until
+
+    def close(self):
+        self._wav_file.close()
+
+class FfmpegReader(PcmReader):
+    """
+    Decodes a recording of any format through an ffmpeg pipe, the samples are picked the same way as pydub's from_file
+    unless a frame rate, an amount of channels or a sample width is asked for
+    """
+    def __init__(self, path: str, frame_rate: int | None = None, channels: int | None = None, sample_width: int | None = None):
+        from pydub import AudioSegment
+        from pydub.utils import mediainfo_json
+
+        if sample_width is None:
+            audio_stream = [stream for stream in mediainfo_json(path)["streams"] if stream["codec_type"] == "audio"][0]
+            # ffprobe reports float samples for compressed formats, pydub decodes them to 16 bit
+            if audio_stream.get("sample_fmt") == "fltp" and audio_stream.get("codec_name") in ["mp3", "mp4", "aac", "webm", "ogg"]:
+                sample_width = 2
+            else:
+                sample_width = int(audio_stream["bits_per_sample"]) // 8
+
+        command = [AudioSegment.converter, "-nostdin", "-v", "error", "-i", path, "-vn"]
+        command += ["-acodec", "pcm_u8" if sample_width == 1 else "pcm_s{}le".format(sample_width * 8)]
+        if frame_rate is not None:
+            command += ["-ar", str(frame_rate)]
+        if channels is not None:
+            command += ["-ac", str(channels)]
+        command += ["-f", "wav", "-"]
+
+        self.path = path
+        self._errors = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=self._errors)
+        try:
+            audio_format, self.channels, self.frame_rate, bits_per_sample = self._read_headers()
+        except Exception:
+            self.close()
+            raise
+
+        self.sample_width = bits_per_sample // 8
+        self.frame_width = self.channels * self.sample_width
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = self._process.stdout.read(size)  # type: ignore
+        if len(data) < size:
+            self._check_exit_code()
+            raise Exception("Couldn't read wav headers out of ffmpeg for {}".format(self.path))
+
+        return data
+
+    def _read_headers(self) -> tuple[int, int, int, int]:
+        # the data chunk of a piped wav has no usable size, the samples simply run until the end of the stream
+        if self._read_exactly(12)[8:12] != b"WAVE":
+            raise Exception("ffmpeg didn't output wav data for {}".format(self.path))
+
+        fmt = None
+        while True:
+            subchunk_id, subchunk_size = struct.unpack("<4sI", self._read_exactly(8))
+            if subchunk_id == b"data":
+                break
+
+            subchunk = self._read_exactly(subchunk_size + subchunk_size % 2)
+            if subchunk_id == b"fmt " and fmt is None:
+                fmt = subchunk
+
+        if fmt is None or len(fmt) < 16:
+            raise Exception("Couldn't find fmt header in wav data")
+
+        audio_format, channels, sample_rate = struct.unpack_from("<HHI", fmt, 0)
+        bits_per_sample = struct.unpack_from("<H", fmt, 14)[0]
+
+        return audio_format, channels, sample_rate, bits_per_sample
+
+    def _check_exit_code(self):
+        if self._process.wait() != 0:
+            self._errors.seek(0)
+            raise Exception("Decoding {} failed: {}".format(self.path, self._errors.read().decode(errors="ignore")))
+
+    def read(self, frames: int) -> bytes:
+        data = self._process.stdout.read(frames * self.frame_width)  # type: ignore
+        if len(data) < frames * self.frame_width:
+            self._check_exit_code()
+            data = data[:len(data) - len(data) % self.frame_width]
+
+        return data
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.stdout.close()  # type: ignore
+        self._process.wait()
+        self._errors.close()
+
+class TeeReader(PcmReader):
+    """
+    Passes the frames of a reader through while writing them into a wav file, so that a recording decoded
+    for one consumer can be read again by the next one without decoding it a second time
+    """
+    def __init__(self, reader: PcmReader, path: str):
+        self.reader = reader
+        self.channels = reader.channels
+        self.sample_width = reader.sample_width
+        self.frame_rate = reader.frame_rate
+        self.frame_width = reader.frame_width
+        self._writer = WavWriter(path, reader.channels, reader.sample_width, reader.frame_rate)
+
+    def frame_count(self) -> int | None:
+        return self.reader.frame_count()
+
+    def read(self, frames: int) -> bytes:
+        chunk = self.reader.read(frames)
+        self._writer.write(chunk)
+
+        return chunk
+
+    def close(self):
+        self._writer.close()
+        self.reader.close()
+
+def open_pcm_reader(path: str, frame_rate: int | None = None, channels: int | None = None, sample_width: int | None = None) -> PcmReader:
+    """
+    Opens a recording for sequential reading: pcm wav files straight from their memory map, anything else
+    or any conversion through ffmpeg
+
+    :param path: Recording to read
+    :type path: str
+    :param frame_rate: Frame rate to resample to, the one of the recording if None
+    :type frame_rate: int | None
+    :param channels: Amount of channels to mix to, the ones of the recording if None
+    :type channels: int | None
+    :param sample_width: Sample width in bytes to convert to, the one of the recording if None
+    :type sample_width: int | None
+    """
+    if path.endswith(".wav"):
+        try:
+            reader = WavReader(path)
+        except Exception:
+            # e.g. float samples, which only ffmpeg reads
+            reader = None
+
+        if reader is not None:
+            if frame_rate in (None, reader.frame_rate) and channels in (None, reader.channels) and sample_width in (None, reader.sample_width):
+                return reader
+
+            reader.close()
+
+    return FfmpegReader(path, frame_rate, channels, sample_width)
+
+def write_wav(reader: PcmReader, path: str, chunk_frames: int = 65536):
+    """
+    Writes every frame of a reader into a wav file, a chunk at a time
+    """
+    with WavWriter(path, reader.channels, reader.sample_width, reader.frame_rate) as writer:
+        for chunk in reader.chunks(chunk_frames):
+            writer.write(chunk)
+
+def export_ranges(reader: PcmReader, ranges: list[tuple[str, float, float | None]], chunk_frames: int = 65536):
+    """
+    Writes several slices of a recording into wav files in a single pass over the reader, cutting them
+    by milliseconds exactly like PcmAudio.slice does, so that only a chunk of the recording is ever in memory
+
+    :param reader: Recording to cut
+    :type reader: PcmReader
+    :param ranges: Destination wav file, start and end in milliseconds of every slice, the end of the recording if None
+    :type ranges: list[tuple[str, float, float | None]]
+    :param chunk_frames: Amount of frames read at once
+    :type chunk_frames: int
+    """
+    frame_rate, frame_width = reader.frame_rate, reader.frame_width
+    writers = {}
+    finished = set()
+
+    def bounds(start_ms: float, end_ms: float | None, frame_count: int | None) -> tuple[int, int]:
+        # until the length is known, slices are left uncapped: capping only moves positions in the last few
+        # milliseconds, which are held back until the end of the recording
+        if frame_count is None:
+            return int(start_ms * (frame_rate / 1000.0)), (int(end_ms * (frame_rate / 1000.0)) if end_ms is not None else 2 ** 62)
+
+        length_ms = round(1000 * (float(frame_count) / frame_rate))
+        if end_ms is None:
+            end_ms = length_ms
+
+        return int(min(start_ms, length_ms) * (frame_rate / 1000.0)), int(min(end_ms, length_ms) * (frame_rate / 1000.0))
+
+    def writer_for(index: int) -> WavWriter:
+        if index not in writers:
+            writers[index] = WavWriter(ranges[index][0], reader.channels, reader.sample_width, frame_rate)
+
+        return writers[index]
+
+    def dispatch(data, position: int, frame_count: int | None):
+        frames = len(data) // frame_width
+        for index, (_, start_ms, end_ms) in enumerate(ranges):
+            if index in finished:
+                continue
+
+            start, end = bounds(start_ms, end_ms, frame_count)
+            if start < position + frames and end > position:
+                writer_for(index).write(data[(max(start, position) - position) * frame_width:(min(end, position + frames) - position) * frame_width])
+
+            # nothing past this chunk belongs to the slice, its file can be closed
+            if end <= position + frames:
+                writer_for(index).close()
+                finished.add(index)
+
+    frame_count = reader.frame_count()
+    margin = frame_rate // 1000 + 2
+    pending = bytearray()
+    position = 0
+
+    try:
+        for chunk in reader.chunks(chunk_frames):
+            pending += chunk
+            ready = len(pending) // frame_width - (margin if frame_count is None else 0)
+            if ready > 0:
+                dispatch(memoryview(pending)[:ready * frame_width], position, frame_count)
+                del pending[:ready * frame_width]
+                position += ready
+
+        frame_count = position + len(pending) // frame_width
+        dispatch(memoryview(pending), position, frame_count)
+
+        for index, (_, start_ms, end_ms) in enumerate(ranges):
+            if index in finished:
+                continue
+
+            start, end = bounds(start_ms, end_ms, frame_count)
+
+            # pydub pads the rounding gap at the very end of a recording with silence
+            missing_frames = end - max(start, frame_count)
+            if missing_frames > 0 and start < frame_count:
+                if missing_frames > 2 * (frame_rate / 1000.0):
+                    raise TooManyMissingFrames("Missing {} frames at the end of the recording".format(missing_frames))
+
+                writer_for(index).write(silence(reader.sample_width, missing_frames, reader.channels))
+
+            # empty slices still give an empty wav file
+            writer_for(index)
+    finally:
+        for index, writer in writers.items():
+            if index not in finished:
+                writer.close()
@@ -1,20 +1,35 @@
+from __future__ import annotations
 import os 
-import time
 import json
-from docx2pdf import convert
-from pydub import AudioSegment
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
-from azure.core.credentials import AzureKeyCredential
-import azure.cognitiveservices.speech as speechsdk
-from azure.cognitiveservices.speech import SpeechConfig
-from collections import OrderedDict
+import shutil
+import tempfile
+from audio import PcmAudio, PcmReader, TeeReader, WavFile, WavWriter, open_pcm_reader, export_ranges, write_wav, SPEECH_FRAME_RATE
+from helper import run_jobs
+from docx_transcript import parse_docx_transcript
+from llm_cache import LLMCache
+from manifest import Manifest, atomic_directory, atomic_file, list_input_files
+from config import get_secrets
+from transcript import TurnStore, parse_offset
+from instrumentation import span, count, record_usage
 import threading
-from openai import OpenAI
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import random
 import base64
-from datetime import datetime
 from pydantic import BaseModel
-from typing import Literal
+from typing import Literal, TYPE_CHECKING
+
+# the speech sdk, pydub, numpy, docx2pdf and openai are only imported by the stages that use them,
+# so that importing this module, e.g. from a worker process, stays cheap and free of side effects
+if TYPE_CHECKING:
+    import azure.cognitiveservices.speech as speechsdk
+    from segmentation import AugmentationSettings
+    from vad import VadSettings, OffsetMap
+    from fingerprint import FingerprintIndex, DuplicateMatch
+    from azure.cognitiveservices.speech import SpeechConfig
+
+logger = logging.getLogger(__name__)
 
 class TurnOfConversation(BaseModel):
     offset: str
@@ -39,30 +54,291 @@ def rename_mp3_files(directory: str):
 
         new_name_counter += 1
 
-def augment_dataset(src: str, dest: str, counter: int, count_to_reach: int):
-    os.chdir(src)
-    files = [f for f in os.listdir() if os.path.isfile(os.path.join(".", f))]
+def _shorten_recording(src_file: str, dest_file: str, extra_file: str | None) -> str:
+    from pydub import AudioSegment
+
+    two_minutes = 120 * 1000
+
+    # only the minutes kept are decoded, ffmpeg is stopped as soon as they are read
+    with span("decode", src_file), open_pcm_reader(src_file) as reader:
+        needed_frames = int((two_minutes * (2 if extra_file is not None else 1) + 1) * reader.frame_rate / 1000) + 2
+        head = bytearray()
+        for chunk in reader.chunks():
+            head += chunk
+            if len(head) >= needed_frames * reader.frame_width:
+                break
+
+        recording = AudioSegment(data=bytes(head), sample_width=reader.sample_width, frame_rate=reader.frame_rate, channels=reader.channels)
+
+    first_two_minutes = recording[:two_minutes]
+    with span("export", src_file), atomic_file(dest_file) as temporary_file:
+        first_two_minutes.export(temporary_file, format="mp3")
+    message = "Shortened file {} in a 2min long file".format(os.path.basename(src_file))
+
+    # augment the dataset by splitting the long recordings into new mp3
+    if extra_file is not None:
+        two_other_minutes = recording[two_minutes:two_minutes*2+1]
+        with span("export", src_file), atomic_file(extra_file) as temporary_file:
+            two_other_minutes.export(temporary_file, format="mp3")
+
+        message += " and created a separate {} 2min long file".format(extra_file)
+
+    return message
+
+def _find_duplicates(fingerprints: FingerprintIndex | None, stage: str, src: str, files: list[str], workers: int | None = 1) -> dict[str, DuplicateMatch]:
+    # recordings already in the dataset, whole or as a clip, are found before anything is spent on them
+    if fingerprints is None:
+        return {}
+
+    with span("fingerprint", src):
+        duplicates = fingerprints.deduplicate(files, stage, os.path.basename(src), workers)
+
+    for file, match in duplicates.items():
+        print("Skipping {}, which duplicates {} from {}ms ({})".format(os.path.basename(file), match.original, match.offset_ms, match.kind))
+    count("duplicates_skipped", len(duplicates))
+
+    return duplicates
+
+def _record_jobs(manifest: Manifest | None, stage: str, jobs: list[tuple], errors: list[tuple], params_of_job, outputs_of_job=None):
+    if manifest is None:
+        return
+
+    # by default a job is its input followed by its outputs
+    outputs_of_job = outputs_of_job or (lambda job: job[1:])
+    failed_jobs = [job for job, _ in errors]
+    for job in jobs:
+        if job not in failed_jobs:
+            manifest.record(stage, [job[0]], params_of_job(job), [output for output in outputs_of_job(job) if output is not None])
+
+def augment_dataset(
+    src: str,
+    dest: str,
+    counter: int,
+    count_to_reach: int,
+    workers: int | None = 1,
+    manifest: Manifest | None = None,
+    fingerprints: FingerprintIndex | None = None
+):
+    """
+    Shortens every recording to its first 2 minutes, and the first ones to reach count_to_reach
+    also give a new recording out of their next 2 minutes
+
+    :param src: Directory of the mp3 recordings
+    :type src: str
+    :param dest: Export directory
+    :type dest: str
+    :param counter: Name of the first extra recording
+    :type counter: int
+    :param count_to_reach: Name at which to stop creating extra recordings
+    :type count_to_reach: int
+    :param workers: Amount of worker processes, None uses every core
+    :type workers: int | None
+    :param manifest: Skips the recordings already shortened with the same parameters
+    :type manifest: Manifest | None
+    :param fingerprints: Skips the recordings that duplicate another one
+    :type fingerprints: FingerprintIndex | None
+    """
+    src, dest = os.path.abspath(src), os.path.abspath(dest)
+    files = list_input_files(src)
+
+    # duplicates get no extra recording, so that the names of the extra recordings leave no gap
+    duplicates = _find_duplicates(fingerprints, "augment", src, [os.path.join(src, file) for file in files], workers)
+    files = [file for file in files if os.path.join(src, file) not in duplicates]
 
+    # names of the extra recordings are decided upfront, before skipping the fresh recordings, so that they stay
+    # the same from one run to the next and workers never race on the counter
+    jobs = []
     for file in files:
-        recording = AudioSegment.from_mp3(os.path.join(src, file))
+        extra_file = None
+        if (counter < count_to_reach):
+            extra_file = os.path.join(dest, str(counter) + ".mp3")
+            counter += 1
 
-        two_minutes = 120 * 1000
+        jobs.append((os.path.join(src, file), os.path.join(dest, file), extra_file))
+
+    params_of_job = lambda job: {"length_ms": 120 * 1000, "extra_file": job[2]}
+    if manifest is not None:
+        jobs = [job for job in jobs if not manifest.is_fresh("augment", [job[0]], params_of_job(job))]
+
+    errors = run_jobs(_shorten_recording, jobs, workers)
+    _record_jobs(manifest, "augment", jobs, errors, params_of_job)
+
+    return errors
+
+def _duration_ms(path: str) -> int:
+    if path.endswith(".wav"):
+        with WavFile(path) as recording:
+            return len(recording)
+
+    from pydub.utils import mediainfo
+
+    return int(float(mediainfo(path)["duration"]) * 1000)
+
+def _segment_recording(src_file: str, dest_files: tuple[str, ...], window_ms: int, stride_ms: int, settings: AugmentationSettings | None, seed: int, duration_ms: int, batch_size: int = 8) -> str:
+    import zlib
+    import numpy as np
+    from segmentation import samples_from_pcm, pcm_from_samples, window_starts, source_range, augment_segments
+
+    with span("segment", src_file), open_pcm_reader(src_file) as reader:
+        frame_width = reader.frame_width
+        # a piped recording only tells its exact length at the end, the planned duration places the windows
+        frame_count = reader.frame_count() or int(duration_ms * reader.frame_rate / 1000)
+        window_frames = int(window_ms * reader.frame_rate / 1000)
+        stride_frames = int(stride_ms * reader.frame_rate / 1000)
+        starts = window_starts(frame_count, window_frames, stride_frames, len(dest_files))
+
+        # the first segment of a recording is copied as it is, like the shortened recording it replaces
+        unperturbed = len(dest_files) if settings is None else 1
+        ranges = [
+            (int(start), int(start) + window_frames) if index < unperturbed else source_range(int(start), window_frames, reader.frame_rate, settings)  # type: ignore
+            for index, start in enumerate(starts)
+        ]
+        # the perturbations only depend on the seed and the file so that reruns and worker counts give the same dataset
+        rng = np.random.default_rng([seed, zlib.crc32(os.path.basename(src_file).encode("utf-8"))])
+
+        def export(data, dest_file: str):
+            with atomic_file(dest_file) as temporary_file:
+                if dest_file.endswith(".wav"):
+                    with WavWriter(temporary_file, reader.channels, reader.sample_width, reader.frame_rate) as writer:
+                        writer.write(data)
+                else:
+                    from pydub import AudioSegment
+
+                    exported = AudioSegment(data=bytes(data), sample_width=reader.sample_width, frame_rate=reader.frame_rate, channels=reader.channels)
+                    exported.export(temporary_file, format=os.path.splitext(dest_file)[1][1:])
+
+        # segments are cut in the order they start while the recording streams by, only the frames
+        # the segments left to cut still read from are kept
+        order = sorted(range(len(dest_files)), key=lambda index: ranges[index][0])
+        chunks = reader.chunks()
+        buffer, buffer_start = bytearray(), 0
+        ended = False
+        done = 0
+
+        while done < len(order):
+            buffer_end = buffer_start + len(buffer) // frame_width
+            ready = []
+            for index in order[done:done + batch_size]:
+                if not ended and ranges[index][1] > buffer_end:
+                    break
+                ready.append(index)
+
+            if len(ready) == 0:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    ended = True
+                else:
+                    buffer += chunk
+                    # frames before the start of the next segment are never read again
+                    dropped = max(0, min(ranges[order[done]][0], buffer_end) - buffer_start)
+                    del buffer[:dropped * frame_width]
+                    buffer_start += dropped
+                continue
+
+            perturbed = []
+            for index in ready:
+                if index < unperturbed:
+                    start, end = ranges[index]
+                    export(memoryview(buffer)[(start - buffer_start) * frame_width:(end - buffer_start) * frame_width], dest_files[index])
+                else:
+                    perturbed.append(index)
+
+            if len(perturbed) > 0:
+                excerpt_start = min(ranges[index][0] for index in perturbed)
+                excerpt_end = min(max(ranges[index][1] for index in perturbed), buffer_end)
+                excerpt = PcmAudio(
+                    memoryview(buffer)[(excerpt_start - buffer_start) * frame_width:(excerpt_end - buffer_start) * frame_width],
+                    reader.channels, reader.sample_width, reader.frame_rate
+                )
+                segments = augment_segments(
+                    samples_from_pcm(excerpt), starts[perturbed], window_frames, reader.frame_rate, settings, rng,  # type: ignore
+                    offset=excerpt_start, frame_count=buffer_end if ended else None
+                )
+                excerpt.data.release()
+
+                for segment, index in zip(segments, perturbed):
+                    export(pcm_from_samples(segment, reader.sample_width), dest_files[index])
+
+            done += len(ready)
+
+    return "Cut {} segments out of {}".format(len(dest_files), os.path.basename(src_file))
+
+def segment_dataset(
+    src: str,
+    dest: str,
+    counter: int,
+    window_ms: int = 120 * 1000,
+    stride_ms: int = 60 * 1000,
+    target: int | None = None,
+    settings: AugmentationSettings | None = None,
+    seed: int = 0,
+    workers: int | None = 1,
+    manifest: Manifest | None = None
+):
+    """
+    Cuts every recording into windows of window_ms, every stride_ms, and perturbs all but the first segment
+    of every recording, drawing as many segments from each recording as needed for the class to reach target
 
-        first_two_minutes = recording[:two_minutes]
-        first_two_minutes.export(os.path.join(dest, file), format="mp3")
-        print("Shortened file {} in a 2min long file".format(file))
+    :param src: Directory of the recordings
+    :type src: str
+    :param dest: Export directory
+    :type dest: str
+    :param counter: Name of the first extra segment, the first segment of a recording keeps its name
+    :type counter: int
+    :param window_ms: Length of the segments
+    :type window_ms: int
+    :param stride_ms: Gap between the starts of two windows, overlapping windows when shorter than window_ms
+    :type stride_ms: int
+    :param target: Amount of segments wanted, e.g. the amount of recordings of the other class. Every window if None
+    :type target: int | None
+    :param settings: Ranges of the perturbations, None cuts the segments without perturbing them
+    :type settings: AugmentationSettings | None
+    :param seed: Seed of the perturbations
+    :type seed: int
+    :param workers: Amount of worker processes, None uses every core
+    :type workers: int | None
+    :param manifest: Skips the recordings already segmented with the same parameters
+    :type manifest: Manifest | None
+    """
+    from segmentation import count_windows, plan_segments
 
-        # augment the dataset by splitting the long recordings into new mp3
-        if (counter < count_to_reach):
-            two_other_minutes = recording[two_minutes:two_minutes*2+1]
-            export_file = os.path.join(dest, str(counter) + ".mp3")
-            two_other_minutes.export(export_file, format="mp3")
+    src, dest = os.path.abspath(src), os.path.abspath(dest)
+    files = list_input_files(src)
 
-            print("Created from {} a separate {} 2min long file".format(file, export_file))
-            
+    durations = {file: _duration_ms(os.path.join(src, file)) for file in files}
+    window_counts = {file: count_windows(durations[file], window_ms, stride_ms) for file in files}
+    # repeating a window only makes sense when its perturbation tells it apart
+    plan = plan_segments(window_counts, target, allow_repeats=settings is not None)
+
+    jobs = []
+    for file in files:
+        extension = os.path.splitext(file)[1]
+        dest_files = [os.path.join(dest, file)]
+        for _ in range(plan[file] - 1):
+            dest_files.append(os.path.join(dest, str(counter) + extension))
             counter += 1
 
-def split_audio_file(src: str, dest: str, conversation: OrderedDict):
+        jobs.append((os.path.join(src, file), tuple(dest_files), window_ms, stride_ms, settings, seed, durations[file]))
+
+    params_of_job = lambda job: {
+        "window_ms": window_ms,
+        "stride_ms": stride_ms,
+        "settings": settings.model_dump() if settings is not None else None,
+        "seed": seed,
+        "dest_files": job[1]
+    }
+    if manifest is not None:
+        jobs = [job for job in jobs if not manifest.is_fresh("segment", [job[0]], params_of_job(job))]
+
+    errors = run_jobs(_segment_recording, jobs, workers)
+    _record_jobs(manifest, "segment", jobs, errors, params_of_job, lambda job: job[1])
+
+    return errors
+
+def write_transcript(dest: str, conversation: TurnStore):
+    conversation.to_json(os.path.join(dest, "transcripts.json"))
+
+def split_audio_file(src: str, dest: str, conversation: TurnStore, offset_map: OffsetMap | None = None):
     """
     Split each turn of a recorded conversation into a separate file into a destination directory
     
@@ -70,223 +346,420 @@ def split_audio_file(src: str, dest: str, conversation: OrderedDict):
     :type src: str
     :param dest: Export directory
     :type dest: str
-    :param conversation: Transcript
-    :type conversation: OrderedDict
+    :param conversation: Transcript, offsets in the original recording
+    :type conversation: TurnStore
+    :param offset_map: Speech of the recording, the turns then leave out the long pauses it dropped
+    :type offset_map: OffsetMap | None
     """
-    with open(os.path.join(dest, "transcripts.json"), "w") as json_file:
-        json.dump(conversation, json_file, indent=4, sort_keys=False)
-
-    count = 1
+    write_transcript(dest, conversation)
 
     if len(conversation) == 0:
         return 
-    
-    last_timestamp, _ = next(reversed(conversation.items()))
 
-    for timestamp, conversation in conversation.items():
-        recording = AudioSegment.from_wav(src)
-
-        turn = recording[int(timestamp):int(timestamp)+conversation["duration"]]
-        if (last_timestamp == timestamp):
-            turn = recording[int(timestamp):]
+    # every turn is written in a single pass over the recording, a chunk at a time
+    ranges = _turn_ranges(dest, conversation)
+    if offset_map is None:
+        reader = open_pcm_reader(src)
+    else:
+        from vad import TrimmedReader
+
+        reader = TrimmedReader(open_pcm_reader(src), offset_map)
+        ranges = [
+            (export_file, offset_map.to_trimmed(start_ms), None if end_ms is None else offset_map.to_trimmed(end_ms))
+            for export_file, start_ms, end_ms in ranges
+        ]
+
+    with span("export", src), reader:
+        export_ranges(reader, ranges)
+    count("turns_exported", len(ranges), src)
+
+    for export_file, _, _ in ranges:
+        logger.debug("Split conversation into %s", export_file)
+
+def _turn_ranges(dest: str, conversation: TurnStore) -> list[tuple[str, int, int | None]]:
+    # the last turn runs until the end of the recording
+    last_index = len(conversation) - 1
+
+    return [
+        (
+            os.path.join(dest, "{}.{}".format(str(index + 1), "wav")),
+            offset,
+            None if index == last_index else offset + duration
+        )
+        for index, (offset, duration) in enumerate(zip(conversation.offsets, conversation.durations))
+    ]
 
-        export_file = os.path.join(dest, "{}.{}".format(str(count), "wav"))
-        turn.export(export_file, format="wav")
+def _convert_mp3(src_file: str, dest_file: str) -> str:
+    # decoding and writing are interleaved a chunk at a time, so they are timed together
+    with span("convert", src_file), open_pcm_reader(src_file) as reader, atomic_file(dest_file) as temporary_file:
+        write_wav(reader, temporary_file)
 
-        count += 1
-        print("Split conversation into {}".format(export_file))
+    return "Converted {} in a wav format".format(os.path.basename(src_file))
 
 # Conversion to wav is required because diarisation service doesnt support mp3 files
-def convert_existing_mp3s(src: str, dest: str):
-    files = [f for f in os.listdir(src) if os.path.isfile(os.path.join(src, f))]
+def convert_existing_mp3s(src: str, dest: str, workers: int | None = 1, manifest: Manifest | None = None, fingerprints: FingerprintIndex | None = None):
+    src, dest = os.path.abspath(src), os.path.abspath(dest)
+    files = list_input_files(src)
+    jobs = [(os.path.join(src, file), os.path.join(dest, file).replace(".mp3", ".wav")) for file in files]
 
-    for file in files:
-        recording = AudioSegment.from_mp3(os.path.join(src, file))
-        recording.export(os.path.join(dest, file).replace(".mp3", ".wav"), format="wav")
-        print("Converted {} in a wav format".format(file))
+    duplicates = _find_duplicates(fingerprints, "convert", src, [job[0] for job in jobs], workers)
+    jobs = [job for job in jobs if job[0] not in duplicates]
 
-class Transcriber():
-    def __init__(self):
-        keyvault_name = os.environ["KEY_VAULT_NAME"]
+    params_of_job = lambda job: {"format": "wav"}
+    if manifest is not None:
+        jobs = [job for job in jobs if not manifest.is_fresh("convert", [job[0]], params_of_job(job))]
 
-        # Set these variables to the names you created for your secrets
-        KEY_SECRET_NAME = "com754-ss-key"
-        ENDPOINT_SECRET_NAME = "com754-ss-endpoint"
+    errors = run_jobs(_convert_mp3, jobs, workers)
+    _record_jobs(manifest, "convert", jobs, errors, params_of_job)
 
-        # URI for accessing key vault
-        keyvault_uri = f"https://{keyvault_name}.vault.azure.net"
+    return errors
 
-        # Instantiate the client and retrieve secrets
-        credential = DefaultAzureCredential()
-        kv_client = SecretClient(vault_url=keyvault_uri, credential=credential)
-
-        print(f"Retrieving your secrets from {keyvault_name}.")
-
-        retrieved_key = kv_client.get_secret(KEY_SECRET_NAME).value
-        retrieved_endpoint = kv_client.get_secret(ENDPOINT_SECRET_NAME).value
-
-        self.speech_config = speechsdk.SpeechConfig(subscription=retrieved_key, endpoint=retrieved_endpoint)
-        self.ongoing_conversation = OrderedDict()
+class TranscriptionSession():
+    """
+    Diarises a single recording into its own conversation, completion is signalled through an event
+    so that several sessions can run side by side without sharing any state.
+    When given already decoded samples or a reader, they are pushed to the service through a stream instead of read from the file.
+    """
+    def __init__(self, speech_config: SpeechConfig, file: str, recording: PcmAudio | PcmReader | None = None, turn_listeners: list | None = None):
+        import azure.cognitiveservices.speech as speechsdk
+
+        self.file = file
+        self.recording = recording
+        self.conversation = TurnStore()
+        self.done = threading.Event()
+        # events received from the service, transcribed or not
+        self.events = 0
+        # called with the offset and the turn each time a turn is started or extended, e.g. by a StreamingDetector
+        self.turn_listeners = turn_listeners or []
+
+        if recording is None:
+            audio_config = speechsdk.audio.AudioConfig(filename=file)
+        else:
+            stream_format = speechsdk.audio.AudioStreamFormat(
+                samples_per_second=recording.frame_rate, 
+                bits_per_sample=recording.sample_width * 8, 
+                channels=recording.channels
+            )
+            self.push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+            audio_config = speechsdk.audio.AudioConfig(stream=self.push_stream)
+        self.conversation_transcriber = speechsdk.transcription.ConversationTranscriber(speech_config=speech_config, audio_config=audio_config)
+
+        # Connect callbacks to the events fired by the conversation transcriber
+        self.conversation_transcriber.transcribed.connect(self.conversation_transcriber_transcribed_whole_sentence)
+        #self.conversation_transcriber.transcribing.connect(self.conversation_transcriber_transcribing_cb)
+        self.conversation_transcriber.session_started.connect(self.conversation_transcriber_session_started_cb)
+        self.conversation_transcriber.session_stopped.connect(self.conversation_transcriber_session_stopped_cb)
+        self.conversation_transcriber.canceled.connect(self.conversation_transcriber_recognition_canceled_cb)
+
+        # stop transcribing on either session stopped or canceled events
+        self.conversation_transcriber.session_stopped.connect(self.stop_cb)
+        self.conversation_transcriber.canceled.connect(self.stop_cb)
+
+    def stop_cb(self, evt: speechsdk.SessionEventArgs):
+        #"""callback that signals to stop continuous recognition upon receiving an event `evt`"""
+        logger.debug('CLOSING on %s', evt)
+        self.done.set()
 
     def conversation_transcriber_recognition_canceled_cb(self, evt: speechsdk.SessionEventArgs):
-        print('Canceled event')
+        logger.warning('Canceled event for %s: %s', self.file, evt)
 
     def conversation_transcriber_session_stopped_cb(self, evt: speechsdk.SessionEventArgs):
-        print('SessionStopped event')
+        logger.debug('SessionStopped event')
 
     def conversation_transcriber_transcribed_whole_sentence(self, evt: speechsdk.SpeechRecognitionEventArgs):
-        print('\nTRANSCRIBED:')
-        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
-            print('\tText={}'.format(evt.result.text))
-            print('\tSpeaker ID={}\n'.format(evt.result.speaker_id))  # type: ignore
-            last_offset, last_turn_of_conversation = 0, None
-            if (len(self.ongoing_conversation)) > 0:
-                last_offset, last_turn_of_conversation = next(reversed(self.ongoing_conversation.items()))
-
-            if last_turn_of_conversation is not None and last_turn_of_conversation["speaker"] == evt.result.speaker_id:  # type: ignore
-                self.ongoing_conversation[last_offset]["text"] += "\n{}".format(evt.result.text)
-                #self.ongoing_conversation[last_timestamp]["duration"] += int(evt.result.duration / 10000)
-            else:
-                # convert from hundreth of nanosecond to milisecond
-                # to keep the same unit and split the text
-                self.ongoing_conversation[int(evt.offset / 10000)] = {
-                    "speaker": evt.result.speaker_id,  # type: ignore
-                    "text": evt.result.text,
-                    "duration": int(evt.result.duration / 10000)
-                }
+        import azure.cognitiveservices.speech as speechsdk
 
-                # reason for that
-                # https://learn.microsoft.com/en-us/answers/questions/2237494/diarisation-is-not-picking-up-number-of-speakers-c
-                if last_turn_of_conversation is not None:
-                    self.ongoing_conversation[last_offset]["duration"] = int(evt.offset / 10000) - last_offset
+        self.events += 1
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+            logger.debug('TRANSCRIBED: Text=%s Speaker ID=%s', evt.result.text, evt.result.speaker_id)  # type: ignore
+            # the same speaker carries on the last turn, otherwise a new turn starts and the previous one
+            # lasts until then, reason for that
+            # https://learn.microsoft.com/en-us/answers/questions/2237494/diarisation-is-not-picking-up-number-of-speakers-c
+            # offsets and durations are converted from hundreth of nanosecond to milisecond
+            index = self.conversation.append_or_merge(
+                int(evt.offset / 10000),
+                evt.result.speaker_id,  # type: ignore
+                evt.result.text,
+                int(evt.result.duration / 10000)
+            )
+
+            if len(self.turn_listeners) > 0:
+                offset, turn = self.conversation.offsets[index], self.conversation.turn(index)
+                for turn_listener in self.turn_listeners:
+                    turn_listener(offset, turn)
 
         elif evt.result.reason == speechsdk.ResultReason.NoMatch:
-            print('\tNOMATCH: Speech could not be TRANSCRIBED: {}'.format(evt.result.no_match_details))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('NOMATCH: Speech could not be TRANSCRIBED: %s', evt.result.no_match_details)
 
     def conversation_transcriber_transcribing_cb(self, evt: speechsdk.SpeechRecognitionEventArgs):
-        print('TRANSCRIBING:')
-        print('\tText={}'.format(evt.result.text))
-        print('\tSpeaker ID={}'.format(evt.result.speaker_id))  # type: ignore
+        logger.debug('TRANSCRIBING: Text=%s Speaker ID=%s', evt.result.text, evt.result.speaker_id)  # type: ignore
 
     def conversation_transcriber_session_started_cb(self, evt: speechsdk.SessionEventArgs):
-        print('SessionStarted event')
+        logger.debug('SessionStarted event')
 
-    # make it so that each conversation turn goes into a separate .wav file
-    def split_conversation_into_multiple_files(self, file: str):
-        new_directory = file[:-4]
-        os.mkdir(new_directory)
+    def push_recording(self, chunk_ms: int = 100):
+        chunk_frames = int(self.recording.frame_rate * chunk_ms / 1000)  # type: ignore
+
+        for chunk in self.recording.chunks(chunk_frames):  # type: ignore
+            self.push_stream.write(bytes(chunk))
+
+        # closing the stream lets the service know the recording is over, which stops the session
+        self.push_stream.close()
+
+    def run(self) -> TurnStore:
+        """
+        Transcribes the whole recording, blocking until the service stops or cancels the session
+
+        :return: Transcript of the recording
+        :rtype: TurnStore
+        """
+        with span("transcribe", self.file):
+            self.conversation_transcriber.start_transcribing_async().get()
+
+            if self.recording is not None:
+                self.push_recording()
+
+            # Waits for completion.
+            self.done.wait()
+
+            self.conversation_transcriber.stop_transcribing_async().get()
+
+        count("speech_events", self.events, self.file)
+        count("turns_transcribed", len(self.conversation), self.file)
 
-        split_audio_file(file, new_directory, self.ongoing_conversation)
+        return self.conversation
 
-        self.ongoing_conversation.clear()
+def trim_silence(file: str, settings: VadSettings) -> OffsetMap:
+    """
+    Finds the speech of a recording ahead of transcribing or splitting it and counts the audio seconds saved
+    """
+    from vad import detect_speech
+
+    with span("vad", file):
+        offset_map = detect_speech(file, settings)
+    count("audio_seconds_saved", (offset_map.duration_ms - offset_map.trimmed_ms) / 1000, file)
+
+    return offset_map
+
+class Transcriber():
+    def __init__(self, manifest: Manifest | None = None, vad: VadSettings | None = None, fingerprints: FingerprintIndex | None = None, speech_turns: bool = False):
+        # Set these variables to the names you created for your secrets
+        KEY_SECRET_NAME = "com754-ss-key"
+        ENDPOINT_SECRET_NAME = "com754-ss-endpoint"
 
-    def diarise_and_split_dataset(self, src: str):
+        secrets = get_secrets(KEY_SECRET_NAME, ENDPOINT_SECRET_NAME)
+        retrieved_key = secrets[KEY_SECRET_NAME]
+        retrieved_endpoint = secrets[ENDPOINT_SECRET_NAME]
+
+        import azure.cognitiveservices.speech as speechsdk
+
+        self.speech_config = speechsdk.SpeechConfig(subscription=retrieved_key, endpoint=retrieved_endpoint)
         self.speech_config.speech_recognition_language="en-US"
         self.speech_config.request_word_level_timestamps()
         self.speech_config.set_property(property_id=speechsdk.PropertyId.Speech_SegmentationStrategy, value="Semantic") 
         self.speech_config.set_property(property_id=speechsdk.PropertyId.SpeechServiceResponse_DiarizeIntermediateResults, value='true')
 
-        files = [f for f in os.listdir(src) if os.path.isfile(os.path.join(src, f))]
-        for file in files:
-            print("Transcribing file {}".format(file))
-            audio_config = speechsdk.audio.AudioConfig(filename=os.path.join(src, file))
-            conversation_transcriber = speechsdk.transcription.ConversationTranscriber(speech_config=self.speech_config, audio_config=audio_config)
+        self.manifest = manifest
+        self.params = {"language": "en-US", "segmentation": "Semantic"}
+        # silences are cut out before the recordings are sent to the service
+        self.vad = vad
+        if vad is not None:
+            self.params["vad"] = vad.model_dump()
+        self.fingerprints = fingerprints
+        # streamed recordings get their turns cut from the 16kHz mono stream sent to the service instead of
+        # from the recording in its own format, which saves decoding them once more
+        self.speech_turns = speech_turns
+        if speech_turns:
+            self.params["speech_turns"] = True
+
+    def _params(self, streaming: bool) -> dict:
+        # files pushed through a stream and files read by the service are transcribed differently
+        return {**self.params, "streaming": streaming}
 
-            transcribing_stop = False
+    # make it so that each conversation turn goes into a separate .wav file
+    def split_conversation_into_multiple_files(
+        self,
+        file: str,
+        conversation: TurnStore,
+        decoded_file: str | None = None,
+        offset_map: OffsetMap | None = None,
+        streaming: bool = False
+    ):
+        """
+        :param decoded_file: Wav copy of the recording kept while it was transcribed, cut instead of the recording
+        :type decoded_file: str | None
+        """
+        new_directory = os.path.splitext(file)[0]
 
-            def stop_cb(evt: speechsdk.SessionEventArgs):
-                #"""callback that signals to stop continuous recognition upon receiving an event `evt`"""
-                print('CLOSING on {}'.format(evt))
-                nonlocal transcribing_stop
-                transcribing_stop = True
+        # the turns are written aside and only take the place of the directory once all of them are there
+        with atomic_directory(new_directory) as temporary_directory:
+            split_audio_file(decoded_file or file, temporary_directory, conversation, offset_map)
 
-            # Connect callbacks to the events fired by the conversation transcriber
-            conversation_transcriber.transcribed.connect(self.conversation_transcriber_transcribed_whole_sentence)
-            #conversation_transcriber.transcribing.connect(conversation_transcriber_transcribing_cb)
-            conversation_transcriber.session_started.connect(self.conversation_transcriber_session_started_cb)
-            conversation_transcriber.session_stopped.connect(self.conversation_transcriber_session_stopped_cb)
-            conversation_transcriber.canceled.connect(self.conversation_transcriber_recognition_canceled_cb)
+        if self.manifest is not None:
+            self.manifest.record("transcribe", [file], self._params(streaming), [new_directory])
 
-            # stop transcribing on either session stopped or canceled events
-            conversation_transcriber.session_stopped.connect(stop_cb)
-            conversation_transcriber.canceled.connect(stop_cb)
+    def transcribe_file(self, file: str, turn_listeners: list | None = None) -> TurnStore:
+        """
+        Transcribes a single recording, handing every turn to the listeners as soon as it is transcribed
+
+        :param file: Wav recording
+        :type file: str
+        :param turn_listeners: Callables taking the offset and the turn, e.g. StreamingDetector.on_turn
+        :type turn_listeners: list | None
+        :return: Transcript of the recording
+        :rtype: TurnStore
+        """
+        return TranscriptionSession(self.speech_config, file, turn_listeners=turn_listeners).run()
 
-            conversation_transcriber.start_transcribing_async()
+    def transcribe_and_split_file(self, file: str, streaming: bool = False) -> str:
+        print("Transcribing file {}".format(file))
+        with span("transcribe_and_split", file):
+            if self.vad is None and not streaming:
+                conversation = TranscriptionSession(self.speech_config, file).run()
+                self.split_conversation_into_multiple_files(file, conversation)
+                return "Transcribed and split {}".format(file)
 
-            # Waits for completion.
-            while not transcribing_stop:
-                time.sleep(.5)
+            # only the speech is streamed to the service, found in a first pass over the recording
+            offset_map = trim_silence(file, self.vad) if self.vad is not None else None
 
-            conversation_transcriber.stop_transcribing_async()
+            # the service gets a 16kHz mono 16 bit stream decoded on the fly and never held in memory, the turns are then
+            # cut from the recording in its own format like on the other paths, or from a wav copy of the stream written
+            # as it is pushed with speech_turns, which spares a decoding but leaves the turns in 16kHz mono
+            with tempfile.TemporaryDirectory() as decoded_directory:
+                decoded_file = os.path.join(decoded_directory, "speech.wav") if self.speech_turns else None
 
-            self.split_conversation_into_multiple_files(os.path.join(src, file))
+                speech_reader = open_pcm_reader(file, SPEECH_FRAME_RATE, 1, 2)
+                if decoded_file is not None:
+                    speech_reader = TeeReader(speech_reader, decoded_file)
+                if offset_map is not None:
+                    from vad import TrimmedReader
 
-class LLMSplitter:
-    def __init__(self) -> None:
-        keyvault_name = os.environ["KEY_VAULT_NAME"]
+                    speech_reader = TrimmedReader(speech_reader, offset_map)
 
-        # Set these variables to the names you created for your secrets
-        KEY_SECRET_NAME = "com754-ai-key"
-        ENDPOINT_SECRET_NAME = "com754-ai-endpoint"
+                with speech_reader:
+                    conversation = TranscriptionSession(self.speech_config, file, speech_reader).run()
+
+                # the offsets of the service are moved back onto the original recording
+                if offset_map is not None:
+                    conversation = offset_map.restore(conversation)
+                self.split_conversation_into_multiple_files(file, conversation, decoded_file, offset_map, streaming)
 
-        # URI for accessing key vault
-        keyvault_uri = f"https://{keyvault_name}.vault.azure.net"
+        return "Transcribed and split {}".format(file)
+
+    def diarise_and_split_dataset(self, src: str, max_sessions: int = 1, streaming: bool = False, workers: int | None = 1) -> list[tuple[str, Exception]]:
+        """
+        Transcribes and splits every recording of a directory, running up to max_sessions transcriptions at once
+
+        :param src: Directory of the recordings, wav files only unless streaming
+        :type src: str
+        :param max_sessions: Amount of concurrent transcription sessions allowed by the speech service quota
+        :type max_sessions: int
+        :param streaming: Decode recordings of any format on the fly and push them to the service, skipping the wav conversion
+        :type streaming: bool
+        :param workers: Worker processes fingerprinting the recordings, None uses every core
+        :type workers: int | None
+        :return: Recordings that failed along with the exception they raised
+        :rtype: list[tuple[str, Exception]]
+        """
+        files = [os.path.join(src, f) for f in list_input_files(src)]
+        # duplicates whose split was reused are recorded too, so that they are neither fingerprinted nor copied again
+        if self.manifest is not None:
+            files = [file for file in files if not self.manifest.is_fresh("transcribe", [file], self._params(streaming))]
+        duplicates = _find_duplicates(self.fingerprints, "transcribe", os.path.abspath(src), files, workers)
+        files = [file for file in files if os.path.abspath(file) not in duplicates]
+        errors = []
+
+        # sessions only wait on their own event, so threads are enough to keep several of them in flight
+        with ThreadPoolExecutor(max_workers=max_sessions) as executor:
+            futures = {executor.submit(self.transcribe_and_split_file, file, streaming): file for file in files}
+            for done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    print("[{}/{}] {}".format(done, len(files), future.result()))
+                except Exception as e:
+                    print("[{}/{}] An error happened for {}: {}".format(done, len(files), futures[future], e))
+                    errors.append((futures[future], e))
+
+        for file, match in duplicates.items():
+            self.reuse_split(file, match, streaming)
+
+        return errors
+
+    def reuse_split(self, file: str, match: DuplicateMatch, streaming: bool = False):
+        """
+        Gives a recording with the same audio as one already split a copy of its turns, overlapping clips get nothing
+        """
+        original_directory = os.path.splitext(match.original)[0]
+        new_directory = os.path.splitext(file)[0]
+        if match.kind == "overlap" or not os.path.isdir(original_directory):
+            return
 
-        # Instantiate the client and retrieve secrets
-        credential = DefaultAzureCredential()
-        kv_client = SecretClient(vault_url=keyvault_uri, credential=credential)
+        if not os.path.isdir(new_directory):
+            with atomic_directory(new_directory) as temporary_directory:
+                for name in os.listdir(original_directory):
+                    shutil.copy(os.path.join(original_directory, name), temporary_directory)
+            print("Reused the split of {} for {}".format(match.original, file))
 
-        print(f"Retrieving your secrets from {keyvault_name}.")
+        if self.manifest is not None:
+            self.manifest.record("transcribe", [file], self._params(streaming), [new_directory])
 
-        api_key = kv_client.get_secret(KEY_SECRET_NAME).value
-        endpoint = kv_client.get_secret(ENDPOINT_SECRET_NAME).value
+class LLMSplitter:
+    def __init__(self, endpoint: str | None = None, api_key: str | None = None, cache: LLMCache | None = None, manifest: Manifest | None = None, vad: VadSettings | None = None) -> None:
+        # an explicit endpoint, such as the stub model server, skips the key vault
+        if endpoint is None or api_key is None:
+            # Set these variables to the names you created for your secrets
+            KEY_SECRET_NAME = "com754-ai-key"
+            ENDPOINT_SECRET_NAME = "com754-ai-endpoint"
+
+            secrets = get_secrets(KEY_SECRET_NAME, ENDPOINT_SECRET_NAME)
+            api_key = secrets[KEY_SECRET_NAME]
+            endpoint = secrets[ENDPOINT_SECRET_NAME]
         self.MODEL = "gpt-5-mini"
 
+        from openai import OpenAI, AsyncOpenAI
+
         self.client = OpenAI(
             base_url=endpoint,
             api_key=api_key
         )                
+        # retries are handled by _parse_pdf_into_json_async so that they back off across the whole batch
+        self.async_client = AsyncOpenAI(
+            base_url=endpoint,
+            api_key=api_key,
+            max_retries=0
+        )
+        self.cache = cache
+        self.manifest = manifest
+        # long silences are left out of the split turns
+        self.vad = vad
+        self.corrupt_files = []
 
-    def _convert_json_into_dict(self, conversations_list: list) -> OrderedDict:
+    def _convert_json_into_dict(self, conversations_list: list) -> TurnStore:
         """
-        Converts a json into an ordered dict and fills out durations based on offset
+        Converts the parsed turns into a turn store and fills out durations based on offset
         
-        :param conversations: JSON needing converting
-        :type conversations: dict
+        :param conversations_list: Turns needing converting
+        :type conversations_list: list[TurnOfConversation]
         """
-        conversations_dict = OrderedDict()
+        conversation = TurnStore()
 
-        last_offset_in_miliseconds = None
         for turn in conversations_list:
             try:
-                offset = datetime.strptime(turn.offset.replace("[", "").replace("]", ""), "%M:%S")
-                offset_in_miliseconds = (offset.minute * 60 + offset.second) * 1000
-                conversations_dict[offset_in_miliseconds] = {
-                    "speaker": turn.speaker,  # type: ignore
-                    "text": turn.text,
-                    "duration": 0
-                }
-
-                if last_offset_in_miliseconds is not None:
-                    conversations_dict[last_offset_in_miliseconds]["duration"] = offset_in_miliseconds - last_offset_in_miliseconds
-                    # duration of the last turn will be determined by reading the mp3 directly
-
-                last_offset_in_miliseconds = offset_in_miliseconds
-            except:
+                # duration of the last turn will be determined by reading the recording directly
+                conversation.append(parse_offset(turn.offset), turn.speaker, turn.text)
+            except ValueError:
                 print("Couldnt interpret this turn {}".format(turn))
 
-        return conversations_dict
+        return conversation
 
-    def _parse_pdf_into_json(self, file_path: str) -> OrderedDict | None:
+    def _build_parse_request(self, file_path: str) -> dict:
         with open(file_path, "rb") as f:
             data = f.read()
 
         base64_string = base64.b64encode(data).decode("utf-8")
         _, tail = os.path.split(file_path)
 
-        print("Parsing {} into a json".format(tail))
-
-        response = self.client.responses.parse(
+        return dict(
             model=self.MODEL,
             store=False,
             reasoning={"effort": "medium"},
@@ -309,75 +782,250 @@ class LLMSplitter:
             text_format=Conversation
         )
 
+    def _parse_pdf_into_json(self, file_path: str) -> TurnStore | None:
+        _, tail = os.path.split(file_path)
+
+        print("Parsing {} into a json".format(tail))
+
+        request = self._build_parse_request(file_path)
+        output_parsed = None
+        if self.cache is not None:
+            key = self.cache.key_for_request(request)
+            output_parsed = self.cache.get(key, Conversation)
+
+        if output_parsed is None:
+            with span("llm.parse") as attributes:
+                response = self.client.responses.parse(**request)
+                record_usage(attributes, response)
+            output_parsed = response.output_parsed
+
+            if self.cache is not None and output_parsed is not None:
+                self.cache.put(key, output_parsed)
+
+        if output_parsed is not None:
+            dict_conversation = self._convert_json_into_dict(output_parsed.root)
+            print("Parsed {} into a json".format(tail))
+            return dict_conversation
+
+        return None
+
+    async def _parse_pdf_into_json_async(self, file_path: str, semaphore: asyncio.Semaphore, max_attempts: int = 6) -> TurnStore | None:
+        """
+        Parses a pdf transcript without blocking the event loop, backing off exponentially on rate limits and transient errors
+
+        :param file_path: Pdf transcript
+        :type file_path: str
+        :param semaphore: Limits how many requests are in flight at once
+        :type semaphore: asyncio.Semaphore
+        :param max_attempts: Attempts before giving up on the transcript
+        :type max_attempts: int
+        """
+        from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+        retryable_errors = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+        _, tail = os.path.split(file_path)
+        request = await asyncio.to_thread(self._build_parse_request, file_path)
+
+        if self.cache is not None:
+            key = self.cache.key_for_request(request)
+            output_parsed = self.cache.get(key, Conversation)
+
+            if output_parsed is not None:
+                return self._convert_json_into_dict(output_parsed.root)
+
+        for attempt in range(max_attempts):
+            try:
+                async with semaphore:
+                    print("Parsing {} into a json".format(tail))
+                    with span("llm.parse", attempt=attempt) as attributes:
+                        response = await self.async_client.responses.parse(**request)
+                        record_usage(attributes, response)
+                break
+            except retryable_errors as e:
+                if attempt == max_attempts - 1:
+                    raise
+
+                delay = min(60, 2 ** attempt) * (0.5 + random.random())
+                print("Retrying {} in {:.1f}s after {}".format(tail, delay, type(e).__name__))
+                await asyncio.sleep(delay)
 
         if response.output_parsed is not None:
+            if self.cache is not None:
+                self.cache.put(key, response.output_parsed)
+
             dict_conversation = self._convert_json_into_dict(response.output_parsed.root)
             print("Parsed {} into a json".format(tail))
             return dict_conversation
 
         return None
-    
-    def split_recordings(self):
-        #src = os.path.abspath(os.path.join(".", "Audio Recordings", "V"))
-        src = os.path.abspath(os.path.join(".", "Audio Recordings", "V-Processing"))
-        transcripts_src = os.path.abspath(os.path.join(".", "Transcripts"))
-        os.chdir(transcripts_src)
-        files = [f for f in os.listdir(transcripts_src) if ".docx" in f and not os.path.exists(f.replace(".docx", ".pdf"))]
-        corrupt_files = []
-        for file in files:
-            try:
-                convert(file)
-            except:
-                print("An conversion error happened for file " + file)
-                corrupt_files.append(file)
 
-        if (len(corrupt_files) > 0):
-            with open(os.path.join(".", "errors.json"), "w") as json_file:
-                json.dump(corrupt_files, json_file, indent=4, sort_keys=False)
+    def _parse_docx_natively(self, file_path: str) -> TurnStore | None:
+        with span("parse.docx"):
+            turns = parse_docx_transcript(file_path)
+        if turns is None:
+            return None
 
-        files = [f for f in os.listdir(transcripts_src) if ".pdf" in f]
-        
-        for file in files:
+        print("Parsed {} without the model".format(os.path.basename(file_path)))
+        return self._convert_json_into_dict([
+            TurnOfConversation(offset=offset, speaker=speaker, text=text)  # type: ignore
+            for offset, speaker, text in turns
+        ])
+
+    def _convert_docx_into_pdf(self, file_path: str) -> str | None:
+        from docx2pdf import convert
+
+        pdf_path = file_path.replace(".docx", ".pdf")
+        if os.path.exists(pdf_path):
+            return pdf_path
+
+        try:
+            convert(file_path, pdf_path)
+        except:
+            print("An conversion error happened for file " + file_path)
+            self.corrupt_files.append(os.path.basename(file_path))
+            return None
+
+        return pdf_path
+
+    def _parse_transcript(self, transcript_path: str) -> TurnStore | None:
+        """
+        Parses a docx transcript natively, only converting it into a pdf for the model when its layout isn't understood
+
+        :param transcript_path: Docx or pdf transcript
+        :type transcript_path: str
+        """
+        if transcript_path.endswith(".docx"):
+            conversation = self._parse_docx_natively(transcript_path)
+            if conversation is not None:
+                return conversation
+
+            transcript_path = self._convert_docx_into_pdf(transcript_path)
+            if transcript_path is None:
+                return None
+
+        return self._parse_pdf_into_json(transcript_path)
+
+    def _write_errors(self, transcripts_src: str):
+        if (len(self.corrupt_files) > 0):
+            with open(os.path.join(transcripts_src, "errors.json"), "w") as json_file:
+                json.dump(self.corrupt_files, json_file, indent=4, sort_keys=False)
+
+    def _pending_transcripts(self, src: str, transcripts_src: str) -> list[tuple[str, str, str]]:
+        # a docx transcript is preferred over the pdf converted out of it
+        transcripts = {}
+        for f in sorted(os.listdir(transcripts_src)):
+            name, extension = os.path.splitext(f)
+            if extension == ".docx" or (extension == ".pdf" and name not in transcripts):
+                transcripts[name] = f
+
+        pending = []
+
+        for name, file in transcripts.items():
             transcript_path = os.path.join(transcripts_src, file)
-            audio_path = os.path.join(src, file.replace(".pdf", ".wav"))
-            new_directory = os.path.abspath(os.path.join(src, file[:-4]))
+            audio_path = os.path.join(src, name + ".wav")
+            new_directory = os.path.abspath(os.path.join(src, name))
+
+            # without a manifest, an existing directory is all there is to tell that a recording was split
+            if self.manifest is not None:
+                is_done = self.manifest.is_fresh("split", [transcript_path, audio_path], self._params())
+            else:
+                is_done = os.path.exists(new_directory)
+
+            if not is_done:
+                pending.append((transcript_path, audio_path, new_directory))
+
+        return pending
+
+    def _params(self) -> dict:
+        params: dict = {"model": self.MODEL}
+        if self.vad is not None:
+            params["vad"] = self.vad.model_dump()
+
+        return params
+
+    def _split_into_directory(self, transcript_path: str, audio_path: str, new_directory: str, conversation: TurnStore):
+        # a crash halfway through leaves a temporary directory behind instead of one that looks complete
+        offset_map = trim_silence(audio_path, self.vad) if self.vad is not None else None
+        with atomic_directory(new_directory) as temporary_directory:
+            split_audio_file(audio_path, temporary_directory, conversation, offset_map)
+
+        if self.manifest is not None:
+            self.manifest.record("split", [transcript_path, audio_path], self._params(), [new_directory])
 
-            if (not os.path.exists(new_directory)):
-                conversation = self._parse_pdf_into_json(transcript_path)
+    def split_recordings(self, src: str | None = None, transcripts_src: str | None = None):
+        #src = os.path.abspath(os.path.join(".", "Audio Recordings", "V"))
+        src = os.path.abspath(src or os.path.join(".", "Audio Recordings", "V-Processing"))
+        transcripts_src = os.path.abspath(transcripts_src or os.path.join(".", "Transcripts"))
+        self.corrupt_files = []
+
+        for transcript_path, audio_path, new_directory in self._pending_transcripts(src, transcripts_src):
+            with span("split", audio_path):
+                conversation = self._parse_transcript(transcript_path)
 
                 if conversation is None:
                     continue
 
-                os.mkdir(new_directory)
-                split_audio_file(audio_path, new_directory, conversation)
+                self._split_into_directory(transcript_path, audio_path, new_directory, conversation)
+
+        self._write_errors(transcripts_src)
+
+    async def split_recordings_async(self, src: str, transcripts_src: str, max_concurrency: int = 8) -> list[tuple[str, Exception]]:
+        """
+        Parses up to max_concurrency transcripts at once and splits each recording as soon as its transcript
+        comes back, so that waiting on the model overlaps with splitting the audio
+
+        :param src: Directory of the wav recordings
+        :type src: str
+        :param transcripts_src: Directory of the docx and pdf transcripts
+        :type transcripts_src: str
+        :param max_concurrency: Amount of requests in flight at once
+        :type max_concurrency: int
+        :return: Transcripts that failed along with the exception they raised
+        :rtype: list[tuple[str, Exception]]
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        pending = self._pending_transcripts(src, transcripts_src)
+        errors = []
+
+        async def parse_and_split(transcript_path: str, audio_path: str, new_directory: str):
+            nonlocal done
+            try:
+                with span("split", audio_path):
+                    conversation = None
+                    parsed_path = transcript_path
+                    if transcript_path.endswith(".docx"):
+                        conversation = await asyncio.to_thread(self._parse_docx_natively, transcript_path)
+
+                        # word automation isn't thread-safe, the rare fallback conversion stays on the loop's thread
+                        if conversation is None:
+                            parsed_path = self._convert_docx_into_pdf(transcript_path) or ""
 
-#transcriber = Transcriber()
-#transcriber2 = Transcriber()
+                    if conversation is None and parsed_path.endswith(".pdf"):
+                        conversation = await self._parse_pdf_into_json_async(parsed_path, semaphore)
 
-#t1 = threading.Thread(target=transcriber.diarise_and_split_dataset, args=(os.path.abspath(os.path.join(".", "Audio Recordings", "NV-Processing")),))
-#t2 = threading.Thread(target=transcriber2.diarise_and_split_dataset, args=(os.path.abspath(os.path.join(".", "Audio Recordings", "V-Processing")),))
+                    if conversation is not None:
+                        await asyncio.to_thread(self._split_into_directory, transcript_path, audio_path, new_directory, conversation)
 
-#t1.start()
-#t2.start()
+                done += 1
+                print("[{}/{}] Processed {}".format(done, len(pending), transcript_path))
+            except Exception as e:
+                done += 1
+                print("[{}/{}] An error happened for {}: {}".format(done, len(pending), transcript_path, e))
+                errors.append((transcript_path, e))
 
-#t1.join()
-#t2.join()
-# convert_existing_mp3s(
-#     src=os.path.abspath(os.path.join(".", "Audio Recordings", "NV-Processing")),
-#     dest=os.path.abspath(os.path.join(".", "Audio Recordings", "NV-Processing")),
-# )
+        done = 0
+        self.corrupt_files = []
+        await asyncio.gather(*(parse_and_split(*job) for job in pending))
+        self._write_errors(transcripts_src)
 
-"""convert_existing_mp3s(
-    src=os.path.abspath(os.path.join(".", "Audio Recordings", "V")),
-    dest=os.path.abspath(os.path.join(".", "Audio Recordings", "V-Processing")),
-)"""
+        return errors
 
-LLMSplitter().split_recordings()
+    def split_recordings_concurrently(self, max_concurrency: int = 8, src: str | None = None, transcripts_src: str | None = None) -> list[tuple[str, Exception]]:
+        src = os.path.abspath(src or os.path.join(".", "Audio Recordings", "V-Processing"))
+        transcripts_src = os.path.abspath(transcripts_src or os.path.join(".", "Transcripts"))
 
-""" augment_dataset(
-    src=os.path.abspath(os.path.join(".", "Audio Recordings", "NV")),
-    dest=os.path.abspath(os.path.join(".", "Audio Recordings", "NV-Processing")),
-    counter=410, 
-    count_to_reach=420
- )"""
+        return asyncio.run(self.split_recordings_async(src, transcripts_src, max_concurrency))
 
+# every stage can be run from the command line, see cli.py
+if __name__ == "__main__":
+    LLMSplitter(cache=LLMCache()).split_recordings()
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from detector import LLMDetector
+from llm_cache import LLMCache
+from transcript import TurnStore, load_dataset
+from instrumentation import span, percentile
+from classifier import HashedNgramClassifier, CascadeDetector
+
+def run_benchmark(detector: LLMDetector | CascadeDetector, dataset: list[tuple[str, str, TurnStore]], mode: str, concurrency: int = 4) -> dict:
+    """
+    Runs a detector over the whole dataset and measures its speed and quality
+
+    :param detector: Detector to measure
+    :type detector: LLMDetector | CascadeDetector
+    :param dataset: Recordings as returned by load_dataset
+    :type dataset: list[tuple[str, str, TurnStore]]
+    :param mode: "naive" for the single prompt detector, "principles" for LLMDetector.analyse, "cascade" for CascadeDetector.analyse
+    :type mode: str
+    :param concurrency: Amount of recordings analysed at once
+    :type concurrency: int
+    """
+    if mode == "naive":
+        analyse = detector._analyse_call_for_vishing_naive
+    elif mode in ("principles", "cascade"):
+        analyse = detector.analyse
+    else:
+        raise ValueError("Unknown detector mode {}".format(mode))
+
+    def timed(transcript_file: str, conversation: TurnStore) -> tuple[float, str | None]:
+        start = time.perf_counter()
+        with span("detect", transcript_file, mode=mode):
+            result = analyse(conversation)  # type: ignore
+        return time.perf_counter() - start, result.answer if result is not None else None
+
+    usage_before = dict(detector.usage)
+    forwarded_before = getattr(detector, "forwarded", None)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda recording: timed(recording[0], recording[2]), dataset))
+    wall_time = time.perf_counter() - start
+    # checks left running by an early exit still spend tokens, which belong to this run
+    detector.wait_for_abandoned()
+
+    latencies = [latency for latency, _ in results]
+    answers = [answer for _, answer in results]
+    labels = [label for _, label, _ in dataset]
+
+    true_fraud = sum(1 for answer, label in zip(answers, labels) if answer == "FRAUD" and label == "FRAUD")
+    predicted_fraud = answers.count("FRAUD")
+    actual_fraud = labels.count("FRAUD")
+
+    report = {
+        "mode": mode,
+        "recordings": len(dataset),
+        "concurrency": concurrency,
+        "wall_seconds": wall_time,
+        "throughput_per_second": len(dataset) / wall_time if wall_time > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "tokens": {key: detector.usage[key] - usage_before[key] for key in detector.usage},
+        "accuracy": sum(1 for answer, label in zip(answers, labels) if answer == label) / len(dataset) if len(dataset) > 0 else 0.0,
+        "fraud_precision": true_fraud / predicted_fraud if predicted_fraud > 0 else 0.0,
+        "fraud_recall": true_fraud / actual_fraud if actual_fraud > 0 else 0.0,
+        "uncertain_rate": answers.count("UNCERTAIN") / len(dataset) if len(dataset) > 0 else 0.0,
+        "failed": answers.count(None)
+    }
+    if forwarded_before is not None:
+        # share of the calls the classifier couldn't decide and sent to the model
+        report["llm_forwarded_share"] = (detector.forwarded - forwarded_before) / len(dataset) if len(dataset) > 0 else 0.0  # type: ignore
+
+    return report
+
+def compare_with_llm(llm_report: dict, cascade_report: dict):
+    """
+    Prints what putting the classifier in front of the model saved, and what it cost in accuracy
+    """
+    llm_requests = llm_report["tokens"]["requests"]
+    cascade_requests = cascade_report["tokens"]["requests"]
+
+    print("Cascade against {} alone:".format(llm_report["mode"]))
+    print("\tmodel requests: {} -> {} ({:.0%} fewer)".format(
+        llm_requests, cascade_requests, 1 - cascade_requests / llm_requests if llm_requests > 0 else 0.0
+    ))
+    for metric in ("latency_p50", "latency_p95", "throughput_per_second", "accuracy", "fraud_precision", "fraud_recall", "uncertain_rate"):
+        print("\t{}: {:.3f} -> {:.3f}".format(metric, llm_report[metric], cascade_report[metric]))
+
+def compare_with_previous(history_file: str, report: dict):
+    """
+    Prints how a run moved against the previous run of the same mode recorded in the history file
+    """
+    if not os.path.exists(history_file):
+        return
+
+    previous = None
+    with open(history_file, "r") as history:
+        for line in history:
+            entry = json.loads(line)
+            if entry["mode"] == report["mode"] and entry.get("endpoint") == report.get("endpoint"):
+                previous = entry
+
+    if previous is None:
+        return
+
+    for metric in ("throughput_per_second", "latency_p50", "latency_p95", "latency_p99", "accuracy"):
+        print("\t{}: {:.3f} -> {:.3f}".format(metric, previous[metric], report[metric]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the speed and accuracy of the detectors over the split dataset")
+    parser.add_argument("--modes", nargs="+", default=["naive", "principles"], choices=["naive", "principles", "cascade"])
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--token-budget", type=int, default=None)
+    parser.add_argument("--cache", default=None, help="sqlite file caching the model answers")
+    parser.add_argument("--endpoint", default=None, help="model endpoint to use instead of the one of the key vault")
+    parser.add_argument("--api-key", default="stub")
+    parser.add_argument("--stub", action="store_true", help="run against a local stub model server")
+    parser.add_argument("--stub-latency", type=float, default=0.5)
+    parser.add_argument("--history", default="benchmarks.jsonl", help="jsonl file every run is appended to")
+    parser.add_argument("--classifier", default=None, help="classifier trained by cli.py train, required by the cascade mode")
+    parser.add_argument("--cascade-mode", default="principles", choices=["naive", "principles"], help="detector the cascade forwards to")
+    parser.add_argument("--all-recordings", action="store_true", help="also run over the recordings the classifier was trained and calibrated on")
+    args = parser.parse_args()
+
+    if "cascade" in args.modes and args.classifier is None:
+        parser.error("the cascade mode needs --classifier")
+
+    endpoint = args.endpoint
+    if args.stub:
+        from stub_server import start_stub_server
+        _, endpoint = start_stub_server(latency=args.stub_latency)
+
+    detector = LLMDetector(
+        cache=LLMCache(args.cache) if args.cache is not None else None,
+        token_budget=args.token_budget,
+        endpoint=endpoint,
+        api_key=args.api_key if endpoint is not None else None
+    )
+    dataset = load_dataset()
+
+    cascade = None
+    if args.classifier is not None:
+        classifier = HashedNgramClassifier.load_npz(args.classifier)
+        cascade = CascadeDetector(classifier, detector, args.cascade_mode)
+        # every mode runs over the test recordings of the classifier, so that they are compared on the same calls
+        if not args.all_recordings:
+            if len(classifier.test) == 0:
+                raise Exception("{} keeps no test recordings, train it again or pass --all-recordings".format(args.classifier))
+
+            test = set(classifier.test)
+            dataset = [recording for recording in dataset if os.path.realpath(recording[0]) in test]
+    print("Loaded {} transcripts".format(len(dataset)))
+
+    reports = {}
+    for mode in args.modes:
+        report = run_benchmark(cascade if mode == "cascade" else detector, dataset, mode, args.concurrency)  # type: ignore
+        report["date"] = datetime.now().isoformat()
+        report["endpoint"] = "stub" if args.stub else "remote"
+
+        print(json.dumps(report, indent=4))
+        compare_with_previous(args.history, report)
+
+        with open(args.history, "a") as history:
+            history.write(json.dumps(report) + "\n")
+        reports[mode] = report
+
+    if "cascade" in reports and args.cascade_mode in reports:
+        compare_with_llm(reports[args.cascade_mode], reports["cascade"])
@@ -1,58 +1,290 @@
-import os 
+import time
+import asyncio
+from collections import deque
+from datetime import datetime, timedelta
 from helper import start_dev_tunnel
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
-from azure.communication.callautomation import CallAutomationClient, CallConnectionClient
-from azure.communication.identity import CommunicationIdentityClient 
+from config import get_secrets_provider
 from uuid import uuid4
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from azure.core.credentials import AccessToken
+    from azure.communication.identity import CommunicationUserIdentifier
+    from azure.communication.identity.aio import CommunicationIdentityClient
+    from azure.communication.callautomation.aio import CallConnectionClient
+
+class IdentityPool:
+    """
+    Communication users provisioned ahead of the calls along with their tokens, topped up in the background
+    so that placing a call doesn't wait on the identity service. Tokens close to expiry are reissued for the
+    same user instead of provisioning a new one.
+    """
+    def __init__(
+        self,
+        identity_client: "CommunicationIdentityClient",
+        size: int = 8,
+        scopes: list[str] | None = None,
+        token_lifetime: timedelta = timedelta(hours=24),
+        refresh_margin_seconds: float = 600,
+        refresh_interval_seconds: float = 30
+    ):
+        """
+        :param identity_client: Asynchronous identity client, kept open for the life of the pool
+        :type identity_client: CommunicationIdentityClient
+        :param size: Identities kept ready, 0 provisions every identity when it is asked for
+        :type size: int
+        :param token_lifetime: Validity of the issued tokens, between 1 and 24 hours
+        :type token_lifetime: timedelta
+        :param refresh_margin_seconds: Tokens expiring sooner than that are reissued and never handed out
+        :type refresh_margin_seconds: float
+        :param refresh_interval_seconds: Longest time between two checks of the tokens when no identity is taken
+        :type refresh_interval_seconds: float
+        """
+        self.identity_client = identity_client
+        self.size = size
+        self.scopes = scopes or ["voip"]
+        self.token_lifetime = token_lifetime
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.refresh_interval_seconds = refresh_interval_seconds
+
+        self._ready: deque[tuple["CommunicationUserIdentifier", "AccessToken"]] = deque()
+        self._expiring: list["CommunicationUserIdentifier"] = []
+        self._wanted = asyncio.Event()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, token: "AccessToken") -> bool:
+        # the identity client hands the expiry back as it was received, an ISO 8601 string
+        expires_on = token.expires_on
+        if isinstance(expires_on, str):
+            expires_on = datetime.fromisoformat(expires_on).timestamp()
+        elif isinstance(expires_on, datetime):
+            expires_on = expires_on.timestamp()
+
+        return expires_on - time.time() > self.refresh_margin_seconds
+
+    async def _create(self) -> tuple["CommunicationUserIdentifier", "AccessToken"]:
+        return await self.identity_client.create_user_and_token(self.scopes, token_expires_in=self.token_lifetime)  # type: ignore
+
+    async def _reissue(self, identifier: "CommunicationUserIdentifier") -> tuple["CommunicationUserIdentifier", "AccessToken"]:
+        return identifier, await self.identity_client.get_token(identifier, self.scopes, token_expires_in=self.token_lifetime)  # type: ignore
+
+    async def _fill(self):
+        for identifier, token in list(self._ready):
+            if not self._fresh(token):
+                self._expiring.append(identifier)
+        self._ready = deque((identifier, token) for identifier, token in self._ready if self._fresh(token))
+
+        expiring, self._expiring = self._expiring, []
+        missing = max(0, self.size - len(self._ready) - len(expiring))
+
+        results = await asyncio.gather(
+            *(self._reissue(identifier) for identifier in expiring),
+            *(self._create() for _ in range(missing)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                print("Couldn't provision an identity: {}".format(result))
+            else:
+                self._ready.append(result)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wanted.wait(), self.refresh_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wanted.clear()
+            await self._fill()
+
+    async def start(self):
+        """
+        Provisions the first identities and starts topping the pool up in the background
+        """
+        await self._fill()
+        self._task = asyncio.create_task(self._run())
+
+    async def acquire(self) -> tuple["CommunicationUserIdentifier", "AccessToken"]:
+        """
+        Takes an identity out of the pool, provisioning one on the spot when the pool ran dry
+
+        :return: The user and its token
+        :rtype: tuple[CommunicationUserIdentifier, AccessToken]
+        """
+        self._wanted.set()
+
+        while len(self._ready) > 0:
+            identifier, token = self._ready.popleft()
+            if self._fresh(token):
+                self.hits += 1
+                return identifier, token
+
+            self._expiring.append(identifier)
+
+        self.misses += 1
+        return await self._create()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
 class CallerCallee:
-    def __init__(self):
-        keyvault_name = os.environ["KEY_VAULT_NAME"]
+    """
+    Places calls through a single long-lived call automation client, whose connections are reused from one
+    call to the next, to users taken from an IdentityPool. Meant to be used as an async context manager.
+    """
+    def __init__(self, endpoint: str | None = None, access_key: str | None = None, pool_size: int = 8, tunnel: bool = True):
+        """
+        :param endpoint: Communication Services endpoint, such as the one of the stub server, skips the key vault along with access_key
+        :type endpoint: str | None
+        :param pool_size: Identities kept ready
+        :type pool_size: int
+        :param tunnel: Start a dev tunnel for the callbacks and the media stream
+        :type tunnel: bool
+        """
+        if endpoint is None or access_key is None:
+            # Set these variables to the names you created for your secrets
+            CS_KEY_NAME = "com754-cs-key"
+            CS_ENDPOINT_NAME = "com754-cs-endpoint"
+
+            secrets = get_secrets_provider().get_secrets(CS_KEY_NAME, CS_ENDPOINT_NAME)
+            endpoint = secrets[CS_ENDPOINT_NAME] or ""
+            access_key = secrets[CS_KEY_NAME] or ""
+
+        self.cs_endpoint = endpoint.rstrip("/")
+        self.cs_key = access_key
+        self.pool_size = pool_size
 
-        # Set these variables to the names you created for your secrets
-        CS_KEY_NAME = "com754-cs-key"
-        CS_ENDPOINT_NAME = "com754-cs-endpoint"
+        self.local_uri = start_dev_tunnel() if tunnel else None
+        # callbacks of calls placed without a tunnel go nowhere, which the stub doesn't mind
+        self.callback_base_url = self.local_uri[0] if self.local_uri is not None else "https://localhost:8080"
 
-        # URI for accessing key vault
-        keyvault_uri = f"https://{keyvault_name}.vault.azure.net"
+        self.identity_client = None
+        self.call_automation_client = None
+        self.identity_pool = None
 
-        # Instantiate the client and retrieve secrets
-        self.credential = DefaultAzureCredential()
-        kv_client = SecretClient(vault_url=keyvault_uri, credential=self.credential)
+    async def start(self):
+        from azure.core.credentials import AzureKeyCredential
+        from azure.communication.identity.aio import CommunicationIdentityClient
+        from azure.communication.callautomation.aio import CallAutomationClient
 
-        print(f"Retrieving your secrets from {keyvault_name}.")
+        # unlike connection strings, an endpoint keeps its scheme, which lets the http stub stand in for the service
+        credential = AzureKeyCredential(self.cs_key)
+        self.identity_client = CommunicationIdentityClient(self.cs_endpoint, credential)
+        self.call_automation_client = CallAutomationClient(self.cs_endpoint, credential)
 
-        self.cs_endpoint = kv_client.get_secret(CS_ENDPOINT_NAME).value or ""
-        self.cs_key = kv_client.get_secret(CS_KEY_NAME).value or ""
+        self.identity_pool = IdentityPool(self.identity_client, self.pool_size)
+        await self.identity_pool.start()
 
-        self.call_identity_client = CommunicationIdentityClient.from_connection_string(
-            conn_str="endpoint={}/;accesskey={}".format(self.cs_endpoint, self.cs_key)
+    async def close(self):
+        if self.identity_pool is not None:
+            await self.identity_pool.close()
+        if self.call_automation_client is not None:
+            await self.call_automation_client.close()
+        if self.identity_client is not None:
+            await self.identity_client.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _media_streaming(self):
+        from azure.communication.callautomation import (
+            MediaStreamingOptions, StreamingTransportType, MediaStreamingContentType, MediaStreamingAudioChannelType, AudioFormat
         )
 
-        self.local_uri = start_dev_tunnel()
+        if self.local_uri is None:
+            return None
 
-    def initiate_call(self) -> CallConnectionClient:
-        caller_identifier, caller_token = self.call_identity_client.create_user_and_token(["voip"])
-        callee_identifier, callee_token = self.call_identity_client.create_user_and_token(["voip"])
+        # the mixed audio of the call goes through the same tunnel to media_server.MediaStreamingServer
+        return MediaStreamingOptions(
+            transport_url=self.local_uri[0].replace("https://", "wss://"),
+            transport_type=StreamingTransportType.WEBSOCKET,
+            content_type=MediaStreamingContentType.AUDIO,
+            audio_channel_type=MediaStreamingAudioChannelType.MIXED,
+            start_media_streaming=True,
+            audio_format=AudioFormat.PCM16_K_MONO
+        )
 
-        caller_callback_url = "http:/{}//calls/{}".format(self.local_uri, uuid4())
-        callee_callback_url = "http:/{}//calls/{}".format(self.local_uri, uuid4())
+    async def initiate_call(self) -> "CallConnectionClient":
+        if self.identity_pool is None or self.call_automation_client is None:
+            raise Exception("CallerCallee must be started before placing calls")
 
-        self.call_automation_client = CallAutomationClient(credential=self.credential, endpoint=self.cs_endpoint)
-        call = self.call_automation_client.create_call(
+        callee_identifier, callee_token = await self.identity_pool.acquire()
+        callback_url = "{}/calls/{}".format(self.callback_base_url, uuid4())
+
+        call = await self.call_automation_client.create_call(
             target_participant=callee_identifier,  # type: ignore
-            callback_url=caller_callback_url
+            callback_url=callback_url,
+            media_streaming=self._media_streaming()
         )
-        
+
         if (call.call_connection_id is None):
             raise Exception("Couldn't obtain call connection details")
 
-        call_connection = self.call_automation_client.get_call_connection(call.call_connection_id)
-        #self.call_automation_client.
+        return self.call_automation_client.get_call_connection(call.call_connection_id)
+
+async def generate_load(caller: CallerCallee, calls: int, concurrency: int = 8) -> dict:
+    """
+    Places calls concurrently and measures how long setting up each of them took
+
+    :param caller: Started CallerCallee
+    :type caller: CallerCallee
+    :param calls: Amount of calls to place
+    :type calls: int
+    :param concurrency: Calls being set up at once
+    :type concurrency: int
+    """
+    from instrumentation import percentile
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def place_call():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await caller.initiate_call()
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+    hits, misses = caller.identity_pool.hits, caller.identity_pool.misses  # type: ignore
+    start = time.perf_counter()
+    await asyncio.gather(*(place_call() for _ in range(calls)))
+    wall_time = time.perf_counter() - start
+
+    for error in errors[:5]:
+        print("Call setup failed: {}".format(error))
 
+    return {
+        "calls": calls,
+        "concurrency": concurrency,
+        "pool_size": caller.pool_size,
+        "wall_seconds": wall_time,
+        "calls_per_second": len(latencies) / wall_time if wall_time > 0 else 0.0,
+        "setup_latency_p50": percentile(latencies, 50),
+        "setup_latency_p95": percentile(latencies, 95),
+        "setup_latency_p99": percentile(latencies, 99),
+        "pool_hits": caller.identity_pool.hits - hits,  # type: ignore
+        "pool_misses": caller.identity_pool.misses - misses,  # type: ignore
+        "failed": len(errors)
+    }
 
-        return call_connection
+async def main():
+    async with CallerCallee() as app:
+        await app.initiate_call()
 
-app = CallerCallee()
-app.initiate_call()
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
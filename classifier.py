@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import time
+import zlib
+import threading
+import numpy as np
+from detector import FinalDetectorResults, LLMDetector
+from instrumentation import span, count
+from transcript import TurnStore
+
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d+")
+
+def _ngrams(text: str, max_n: int) -> list[str]:
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    # digits are collapsed, so that every card or account number counts as the same feature
+    tokens = ["0" if token.isdigit() else token for token in tokens]
+
+    return [" ".join(tokens[i:i + n]) for n in range(1, max_n + 1) for i in range(len(tokens) - n + 1)]
+
+def conversation_text(conversation: TurnStore) -> str:
+    return "\n".join(conversation.texts)
+
+class HashedNgramClassifier:
+    """
+    Logistic regression over the word n-grams of a transcript, hashed into a fixed amount of features so that
+    no vocabulary needs to be kept. Judges a call in about a millisecond on the CPU, and only answers SAFE or FRAUD
+    when the probability clears thresholds picked on recordings held out of the training, UNCERTAIN otherwise.
+    """
+    def __init__(self, feature_bits: int = 18, max_n: int = 2):
+        """
+        :param feature_bits: The n-grams are hashed into 2**feature_bits features
+        :type feature_bits: int
+        :param max_n: Longest n-gram, 2 for words and pairs of words
+        :type max_n: int
+        """
+        self.feature_bits = feature_bits
+        self.max_n = max_n
+        self.weights = np.zeros(1 << feature_bits, dtype=np.float32)
+        self.bias = 0.0
+        # probability of fraud at or below which a call is SAFE, and at or above which it is FRAUD
+        self.safe_threshold = 0.0
+        self.fraud_threshold = 1.0
+        # recordings kept out of both the training and the calibration, to be benchmarked on
+        self.test: list[str] = []
+        self.metrics: dict = {}
+
+    def features(self, text: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Hashed n-gram counts of a text, log scaled and normalised to unit length
+
+        :return: Indices and values of the non zero features
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        ngrams = _ngrams(text, self.max_n)
+        if len(ngrams) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # crc32 is stable from one process to the next, unlike hash()
+        hashes = np.fromiter((zlib.crc32(ngram.encode("utf-8")) for ngram in ngrams), dtype=np.int64, count=len(ngrams))
+        indices, counts = np.unique(hashes & ((1 << self.feature_bits) - 1), return_counts=True)
+        values = 1 + np.log(counts.astype(np.float32))
+
+        return indices, values / np.linalg.norm(values)
+
+    def _matrix(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # rows of a sparse matrix laid end to end, as row of every value, index and value
+        rows, indices, values = [], [], []
+        for row, text in enumerate(texts):
+            row_indices, row_values = self.features(text)
+            rows.append(np.full(len(row_indices), row, dtype=np.int64))
+            indices.append(row_indices)
+            values.append(row_values)
+
+        return np.concatenate(rows), np.concatenate(indices), np.concatenate(values)
+
+    def _probabilities(self, matrix: tuple[np.ndarray, np.ndarray, np.ndarray], row_count: int, weights: np.ndarray, bias: float) -> np.ndarray:
+        rows, indices, values = matrix
+        scores = np.bincount(rows, weights=values * weights[indices], minlength=row_count) + bias
+
+        return 1 / (1 + np.exp(-scores))
+
+    def predict_proba(self, text: str) -> float:
+        """
+        Probability that a transcript is a fraud
+        """
+        indices, values = self.features(text)
+        score = float(np.dot(self.weights[indices], values)) + self.bias
+
+        return 1 / (1 + np.exp(-score))
+
+    def fit(self, texts: list[str], labels: list[str], epochs: int = 300, learning_rate: float = 0.5, l2: float = 1e-4):
+        """
+        Trains the weights by gradient descent over the whole set at once, with Adagrad steps so that
+        rare n-grams still move
+
+        :param texts: Transcripts
+        :type texts: list[str]
+        :param labels: FRAUD or SAFE for each transcript
+        :type labels: list[str]
+        """
+        matrix = self._matrix(texts)
+        rows, indices, values = matrix
+        targets = np.array([1.0 if label == "FRAUD" else 0.0 for label in labels])
+        # the rarer class weighs as much as the other one
+        fraud_share = targets.mean()
+        sample_weights = np.where(targets == 1, 0.5 / max(fraud_share, 1e-6), 0.5 / max(1 - fraud_share, 1e-6)) / len(texts)
+
+        weights = np.zeros(1 << self.feature_bits)
+        bias = 0.0
+        squared_gradients = np.full(1 << self.feature_bits, 1e-8)
+        squared_bias_gradient = 1e-8
+
+        for _ in range(epochs):
+            residuals = (self._probabilities(matrix, len(texts), weights, bias) - targets) * sample_weights
+            gradient = np.bincount(indices, weights=values * residuals[rows], minlength=1 << self.feature_bits) + l2 * weights
+            bias_gradient = residuals.sum()
+
+            squared_gradients += gradient ** 2
+            squared_bias_gradient += bias_gradient ** 2
+            weights -= learning_rate * gradient / np.sqrt(squared_gradients)
+            bias -= learning_rate * bias_gradient / np.sqrt(squared_bias_gradient)
+
+        self.weights = weights.astype(np.float32)
+        self.bias = float(bias)
+
+    def calibrate(self, texts: list[str], labels: list[str], target_precision: float = 0.95):
+        """
+        Picks the widest thresholds at which the SAFE and FRAUD answers on held out transcripts are still
+        right at least target_precision of the time, everything in between being UNCERTAIN. These transcripts
+        must not be the ones the classifier is then measured on, whose precision would be the target by construction
+
+        :param texts: Transcripts left out of the training
+        :type texts: list[str]
+        :param labels: FRAUD or SAFE for each transcript
+        :type labels: list[str]
+        """
+        probabilities = np.array([self.predict_proba(text) for text in texts])
+        is_fraud = np.array([label == "FRAUD" for label in labels])
+
+        # the lowest probability from which the calls above it are frauds often enough
+        self.fraud_threshold = 1.0
+        for threshold in np.sort(probabilities)[::-1]:
+            above = probabilities >= threshold
+            if is_fraud[above].mean() < target_precision:
+                break
+            self.fraud_threshold = float(threshold)
+
+        self.safe_threshold = 0.0
+        for threshold in np.sort(probabilities):
+            below = probabilities <= threshold
+            if (~is_fraud[below]).mean() < target_precision:
+                break
+            self.safe_threshold = float(threshold)
+
+        # thresholds crossing each other leave no room for UNCERTAIN, the calls are split halfway between them
+        if self.safe_threshold >= self.fraud_threshold:
+            self.safe_threshold = self.fraud_threshold = (self.safe_threshold + self.fraud_threshold) / 2
+
+    def classify_text(self, text: str) -> FinalDetectorResults:
+        probability = self.predict_proba(text)
+        if probability >= self.fraud_threshold:
+            return FinalDetectorResults(answer="FRAUD")
+        if probability <= self.safe_threshold:
+            return FinalDetectorResults(answer="SAFE")
+
+        return FinalDetectorResults(answer="UNCERTAIN")
+
+    def classify(self, conversation: TurnStore | str) -> FinalDetectorResults:
+        """
+        SAFE, FRAUD or UNCERTAIN when the probability falls between both thresholds
+
+        :param conversation: Transcript of the call
+        :type conversation: TurnStore | str
+        :rtype: FinalDetectorResults
+        """
+        return self.classify_text(conversation if isinstance(conversation, str) else conversation_text(conversation))
+
+    def evaluate(self, texts: list[str], labels: list[str]) -> dict:
+        answers = [self.classify_text(text).answer for text in texts]
+        decided = [(answer, label) for answer, label in zip(answers, labels) if answer != "UNCERTAIN"]
+
+        return {
+            "recordings": len(texts),
+            "decided_share": len(decided) / len(texts) if len(texts) > 0 else 0.0,
+            "decided_accuracy": sum(1 for answer, label in decided if answer == label) / len(decided) if len(decided) > 0 else 0.0,
+            "safe_threshold": self.safe_threshold,
+            "fraud_threshold": self.fraud_threshold
+        }
+
+    def save_npz(self, path: str):
+        settings = {
+            "feature_bits": self.feature_bits,
+            "max_n": self.max_n,
+            "bias": self.bias,
+            "safe_threshold": self.safe_threshold,
+            "fraud_threshold": self.fraud_threshold,
+            "test": self.test,
+            "metrics": self.metrics
+        }
+        # most weights are zero, only the others are stored
+        indices = np.flatnonzero(self.weights)
+        np.savez_compressed(path, indices=indices, weights=self.weights[indices], settings=np.array(json.dumps(settings)))
+
+    @classmethod
+    def load_npz(cls, path: str) -> "HashedNgramClassifier":
+        with np.load(path) as columns:
+            settings = json.loads(str(columns["settings"]))
+            classifier = cls(settings["feature_bits"], settings["max_n"])
+            classifier.weights[columns["indices"]] = columns["weights"]
+
+        classifier.bias = settings["bias"]
+        classifier.safe_threshold = settings["safe_threshold"]
+        classifier.fraud_threshold = settings["fraud_threshold"]
+        # classifiers saved before the test split calibrated and measured on the same recordings, they have none
+        classifier.test = settings.get("test", [])
+        classifier.metrics = settings["metrics"]
+
+        return classifier
+
+def train_classifier(
+    dataset: list[tuple[str, str, TurnStore]],
+    calibration_share: float = 0.2,
+    test_share: float = 0.2,
+    target_precision: float = 0.95,
+    seed: int = 0,
+    feature_bits: int = 18,
+    max_n: int = 2
+) -> HashedNgramClassifier:
+    """
+    Trains a classifier on the labelled transcripts, calibrates its thresholds on a share of them left out and
+    measures it on another share left out of both, split per label so that all three keep their proportions
+
+    :param dataset: Recordings as returned by transcript.load_dataset
+    :type dataset: list[tuple[str, str, TurnStore]]
+    :param calibration_share: Share of the recordings of each label the thresholds are picked on
+    :type calibration_share: float
+    :param test_share: Share of the recordings of each label the metrics are measured on, and the benchmark runs over
+    :type test_share: float
+    :param target_precision: How often the SAFE and FRAUD answers must be right on the calibration recordings
+    :type target_precision: float
+    :rtype: HashedNgramClassifier
+    """
+    rng = np.random.default_rng(seed)
+    training, calibration, test = [], [], []
+    for label in sorted(set(label for _, label, _ in dataset)):
+        recordings = [recording for recording in dataset if recording[1] == label]
+        order = rng.permutation(len(recordings))
+        test_cut = int(round(len(recordings) * test_share))
+        calibration_cut = test_cut + int(round(len(recordings) * calibration_share))
+        test += [recordings[index] for index in order[:test_cut]]
+        calibration += [recordings[index] for index in order[test_cut:calibration_cut]]
+        training += [recordings[index] for index in order[calibration_cut:]]
+
+    if len(training) == 0 or len(calibration) == 0 or len(test) == 0:
+        raise Exception("Not enough transcripts to train, calibrate and test a classifier: {} in total".format(len(dataset)))
+
+    classifier = HashedNgramClassifier(feature_bits, max_n)
+    start = time.perf_counter()
+    with span("classifier.train"):
+        classifier.fit([conversation_text(conversation) for _, _, conversation in training], [label for _, label, _ in training])
+    print("Trained on {} transcripts in {:.1f}s".format(len(training), time.perf_counter() - start))
+
+    classifier.calibrate([conversation_text(conversation) for _, _, conversation in calibration], [label for _, label, _ in calibration], target_precision)
+    classifier.metrics = classifier.evaluate([conversation_text(conversation) for _, _, conversation in test], [label for _, label, _ in test])
+    classifier.test = [os.path.realpath(transcript_file) for transcript_file, _, _ in test]
+    print("Calibrated on {} transcripts, tested on {}".format(len(calibration), len(test)))
+
+    return classifier
+
+class CascadeDetector:
+    """
+    Lets the classifier judge every call first and only asks the LLMDetector about the calls it is uncertain about
+    """
+    def __init__(self, classifier: HashedNgramClassifier, detector: LLMDetector, mode: str = "principles"):
+        """
+        :param mode: "naive" for the single prompt detector, "principles" for LLMDetector.analyse
+        :type mode: str
+        """
+        self.classifier = classifier
+        self.detector = detector
+        self.mode = mode
+        # read by the benchmark, like the token usage of the detector
+        self.usage = detector.usage
+        self.decided = 0
+        self.forwarded = 0
+        self._lock = threading.Lock()
+
+    def wait_for_abandoned(self):
+        self.detector.wait_for_abandoned()
+
+    def analyse(self, conversation: TurnStore | str, early_exit: bool = True) -> FinalDetectorResults | None:
+        with span("classify"):
+            result = self.classifier.classify(conversation)
+
+        with self._lock:
+            if result.answer != "UNCERTAIN":
+                self.decided += 1
+            else:
+                self.forwarded += 1
+
+        if result.answer != "UNCERTAIN":
+            count("classifier_decided")
+            return result
+
+        count("llm_forwarded")
+        if self.mode == "naive":
+            return self.detector._analyse_call_for_vishing_naive(conversation)
+
+        return self.detector.analyse(conversation, early_exit)
@@ -0,0 +1,407 @@
+import os
+import sys
+import logging
+import argparse
+
+# every stage imports its dependencies when it runs, so that e.g. detecting does not load the speech sdk or pydub
+AUDIO_RECORDINGS = os.path.join(".", "Audio Recordings")
+
+def _workers(value: str) -> int | None:
+    # 0 uses every core
+    return int(value) or None
+
+def _cache(args):
+    if args.cache is None:
+        return None
+
+    from llm_cache import LLMCache
+    return LLMCache(args.cache)
+
+def _manifest(args):
+    if args.manifest is None:
+        return None
+
+    from manifest import Manifest
+    return Manifest(args.manifest)
+
+def _fingerprints(args):
+    if args.fingerprints is None:
+        return None
+
+    from fingerprint import FingerprintIndex
+    return FingerprintIndex(args.fingerprints)
+
+def _vad(args, enabled: bool = False):
+    if not (enabled or args.vad):
+        return None
+
+    from vad import VadSettings
+    return VadSettings(margin_db=args.vad_margin_db, min_silence_ms=args.vad_min_silence_ms, padding_ms=args.vad_padding_ms)
+
+def _add_vad_arguments(parser: argparse.ArgumentParser, flag: bool = True):
+    if flag:
+        parser.add_argument("--vad", action="store_true", help="cut the pauses longer than --vad-min-silence-ms out before going further")
+    parser.add_argument("--vad-margin-db", type=float, default=12.0, help="loudness over the noise floor from which a frame is speech")
+    parser.add_argument("--vad-min-silence-ms", type=int, default=1000, help="shorter pauses are kept")
+    parser.add_argument("--vad-padding-ms", type=int, default=250, help="audio kept on each side of the speech")
+
+def convert(args) -> int:
+    from augmentation import convert_existing_mp3s
+
+    return 1 if convert_existing_mp3s(args.src, args.dest, args.workers, _manifest(args), _fingerprints(args)) else 0
+
+def augment(args) -> int:
+    from augmentation import augment_dataset
+
+    return 1 if augment_dataset(args.src, args.dest, args.counter, args.count_to_reach, args.workers, _manifest(args), _fingerprints(args)) else 0
+
+def segment(args) -> int:
+    from augmentation import segment_dataset
+    from manifest import list_input_files
+    from segmentation import AugmentationSettings
+
+    target = args.target
+    if args.balance_with is not None:
+        # as many segments as the other class has recordings
+        target = len(list_input_files(args.balance_with))
+
+    settings = None
+    if not args.no_augmentation:
+        settings = AugmentationSettings(
+            gain_db=args.gain_db,
+            noise_snr_db=args.noise_snr_db,
+            max_shift_ms=args.max_shift_ms,
+            speed=args.speed
+        )
+
+    errors = segment_dataset(
+        args.src, args.dest, args.counter, args.window_ms, args.stride_ms, target, settings, args.seed, args.workers, _manifest(args)
+    )
+    return 1 if errors else 0
+
+def transcribe(args) -> int:
+    from augmentation import Transcriber
+
+    return 1 if Transcriber(_manifest(args), _vad(args), _fingerprints(args), args.speech_turns).diarise_and_split_dataset(os.path.abspath(args.src), args.max_sessions, args.streaming, args.workers) else 0
+
+def split(args) -> int:
+    from augmentation import LLMSplitter
+
+    splitter = LLMSplitter(cache=_cache(args), manifest=_manifest(args), vad=_vad(args))
+    if args.concurrency > 1:
+        return 1 if splitter.split_recordings_concurrently(args.concurrency, args.src, args.transcripts) else 0
+
+    splitter.split_recordings(args.src, args.transcripts)
+    return 0
+
+def export(args) -> int:
+    import json
+    from shards import export_shards, ShardedDataset
+
+    export_shards(args.dest, {"FRAUD": args.fraud, "SAFE": args.safe}, args.shard_mb * 1024 * 1024)
+    print(json.dumps(ShardedDataset(args.dest).summary(), indent=4))
+    return 0
+
+def detect(args) -> int:
+    from detector import LLMDetector
+    from transcript import load_transcript
+
+    detector = LLMDetector(cache=_cache(args), token_budget=args.token_budget)
+    cascade = None
+    if args.classifier is not None:
+        from classifier import HashedNgramClassifier, CascadeDetector
+        cascade = CascadeDetector(HashedNgramClassifier.load_npz(args.classifier), detector, args.mode)
+
+    for transcript_file in args.transcripts:
+        conversation = load_transcript(transcript_file)
+        if cascade is not None:
+            result = cascade.analyse(conversation)
+        elif args.mode == "principles":
+            result = detector.analyse(conversation)
+        else:
+            result = detector._analyse_call_for_vishing_naive(conversation)
+
+        print("{}: {}".format(transcript_file, result.answer if result is not None else "NO ANSWER"))
+
+    return 0
+
+def train(args) -> int:
+    import json
+    from transcript import load_dataset
+    from classifier import train_classifier
+
+    dataset = load_dataset({"FRAUD": args.fraud, "SAFE": args.safe})
+    classifier = train_classifier(dataset, args.calibration_share, args.test_share, args.target_precision, args.seed, args.feature_bits)
+    classifier.save_npz(args.model)
+    print(json.dumps(classifier.metrics, indent=4))
+    return 0
+
+def serve(args) -> int:
+    import asyncio
+    from detector import LLMDetector
+    from media_server import MediaStreamingServer
+
+    speech_config = None
+    if not args.replay_only:
+        from augmentation import Transcriber
+        speech_config = Transcriber().speech_config
+
+    server = MediaStreamingServer(
+        LLMDetector(cache=_cache(args)), speech_config, port=args.port, debounce_seconds=args.debounce_seconds,
+        max_delay_seconds=args.max_delay_seconds, use_principles=args.mode == "principles"
+    )
+    asyncio.run(server.serve_forever())
+    return 0
+
+def replay(args) -> int:
+    import json
+    import asyncio
+    from media_server import replay_recording, benchmark_media_server
+
+    speed = args.speed or None
+    if not args.benchmark:
+        for recording in args.recordings:
+            seconds = asyncio.run(replay_recording(args.url, recording, speed, not args.no_transcript))
+            print("Replayed {} in {:.1f}s".format(recording, seconds))
+        return 0
+
+    from detector import LLMDetector
+
+    endpoint = None
+    if args.stub:
+        from stub_server import start_stub_server
+        _, endpoint = start_stub_server(latency=args.stub_latency)
+
+    detector = LLMDetector(cache=_cache(args), endpoint=endpoint, api_key="stub" if endpoint is not None else None)
+    report = asyncio.run(benchmark_media_server(detector, args.recordings, speed, args.concurrency, args.debounce_seconds, args.max_delay_seconds))
+    report.pop("reports")
+    print(json.dumps(report, indent=4))
+    return 0
+
+def vad(args) -> int:
+    import json
+    from vad import vad_report
+    from manifest import list_input_files
+
+    files = [os.path.join(args.src, f) for f in list_input_files(args.src)]
+    reports = vad_report(files, _vad(args, enabled=True))
+    original_seconds = sum(report["original_seconds"] for report in reports)
+    saved_seconds = sum(report["saved_seconds"] for report in reports)
+    print(json.dumps({
+        "files": len(reports),
+        "original_seconds": original_seconds,
+        "saved_seconds": saved_seconds,
+        "saved_share": saved_seconds / original_seconds if original_seconds > 0 else 0.0,
+        "recordings": reports
+    }, indent=4))
+    return 0
+
+def dedup(args) -> int:
+    from fingerprint import FingerprintIndex
+    from manifest import list_input_files
+
+    index = FingerprintIndex(args.index)
+    duplicates = {}
+    # the directories are indexed in order, each one labelled with its name
+    for directory in args.directories:
+        directory = os.path.abspath(directory)
+        files = [os.path.join(directory, f) for f in list_input_files(directory)]
+        duplicates.update(index.deduplicate(files, "dedup", os.path.basename(directory), args.workers))
+
+    for file, match in duplicates.items():
+        print("{} duplicates {} from {}ms ({}, {} hashes matched, {:.0%})".format(
+            file, match.original, match.offset_ms, match.kind, match.matched_hashes, match.coverage
+        ))
+
+    leaks = index.leaks("dedup")
+    for file, label, match in leaks:
+        print("{} is labelled {} but duplicates {}".format(file, label, match.original))
+    print("{} duplicates, {} across labels".format(len(duplicates), len(leaks)))
+
+    return 1 if leaks else 0
+
+def report(args) -> int:
+    import json
+    from instrumentation import load_records, summarise
+
+    summary = summarise(load_records(args.trace_file))
+    summary["recordings"] = dict(list(summary["recordings"].items())[:args.recordings])
+    print(json.dumps(summary, indent=4))
+    return 0
+
+def call(args) -> int:
+    import json
+    import asyncio
+    from callercallee import CallerCallee, generate_load
+
+    endpoint, access_key = None, None
+    if args.stub:
+        from stub_server import start_stub_server
+        _, base_url = start_stub_server(latency=args.stub_latency)
+        endpoint, access_key = base_url.rsplit("/v1", 1)[0], "c3R1Yg=="
+
+    async def place_calls() -> int:
+        async with CallerCallee(endpoint, access_key, args.pool_size, tunnel=not args.stub) as caller:
+            if args.calls == 1:
+                await caller.initiate_call()
+                return 0
+
+            report = await generate_load(caller, args.calls, args.concurrency)
+            print(json.dumps(report, indent=4))
+            return 1 if report["failed"] > 0 else 0
+
+    return asyncio.run(place_calls())
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="Vishing dataset pipeline and detector")
+    parser.add_argument("--trace", default=None, help="jsonl file the timings and token counts of every stage are appended to")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="DEBUG shows every transcribed sentence and exported turn")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="convert mp3 recordings into wav files")
+    convert_parser.add_argument("--src", default=os.path.join(AUDIO_RECORDINGS, "V"))
+    convert_parser.add_argument("--dest", default=os.path.join(AUDIO_RECORDINGS, "V-Processing"))
+    convert_parser.add_argument("--workers", type=_workers, default=1, help="worker processes, 0 uses every core")
+    convert_parser.add_argument("--manifest", default=None, help="sqlite file recording finished work, so that reruns only redo what changed")
+    convert_parser.add_argument("--fingerprints", default=None, help="sqlite fingerprint index, recordings duplicating another one are skipped")
+    convert_parser.set_defaults(handler=convert)
+
+    augment_parser = subparsers.add_parser("augment", help="shorten recordings to 2 minutes and cut extra ones out of the long recordings")
+    augment_parser.add_argument("--src", default=os.path.join(AUDIO_RECORDINGS, "NV"))
+    augment_parser.add_argument("--dest", default=os.path.join(AUDIO_RECORDINGS, "NV-Processing"))
+    augment_parser.add_argument("--counter", type=int, required=True, help="name of the first extra recording")
+    augment_parser.add_argument("--count-to-reach", type=int, required=True, help="name at which to stop creating extra recordings")
+    augment_parser.add_argument("--workers", type=_workers, default=1, help="worker processes, 0 uses every core")
+    augment_parser.add_argument("--manifest", default=None, help="sqlite file recording finished work, so that reruns only redo what changed")
+    augment_parser.add_argument("--fingerprints", default=None, help="sqlite fingerprint index, recordings duplicating another one are skipped")
+    augment_parser.set_defaults(handler=augment)
+
+    segment_parser = subparsers.add_parser("segment", help="cut recordings into sliding windows and perturb the extra ones")
+    segment_parser.add_argument("--src", default=os.path.join(AUDIO_RECORDINGS, "NV"))
+    segment_parser.add_argument("--dest", default=os.path.join(AUDIO_RECORDINGS, "NV-Processing"))
+    segment_parser.add_argument("--counter", type=int, required=True, help="name of the first extra segment")
+    segment_parser.add_argument("--window-ms", type=int, default=120 * 1000)
+    segment_parser.add_argument("--stride-ms", type=int, default=60 * 1000)
+    target_group = segment_parser.add_mutually_exclusive_group()
+    target_group.add_argument("--target", type=int, default=None, help="amount of segments wanted, every window by default")
+    target_group.add_argument("--balance-with", default=None, help="directory of the other class, as many segments as it has recordings")
+    segment_parser.add_argument("--no-augmentation", action="store_true", help="cut the segments without perturbing them")
+    segment_parser.add_argument("--gain-db", type=float, nargs=2, default=(-6.0, 6.0))
+    segment_parser.add_argument("--noise-snr-db", type=float, nargs=2, default=(20.0, 40.0))
+    segment_parser.add_argument("--max-shift-ms", type=int, default=500)
+    segment_parser.add_argument("--speed", type=float, nargs=2, default=(0.9, 1.1))
+    segment_parser.add_argument("--seed", type=int, default=0)
+    segment_parser.add_argument("--workers", type=_workers, default=1, help="worker processes, 0 uses every core")
+    segment_parser.add_argument("--manifest", default=None, help="sqlite file recording finished work, so that reruns only redo what changed")
+    segment_parser.set_defaults(handler=segment)
+
+    transcribe_parser = subparsers.add_parser("transcribe", help="diarise recordings and split them into one file per turn")
+    transcribe_parser.add_argument("src", help="directory of the recordings")
+    transcribe_parser.add_argument("--max-sessions", type=int, default=1, help="concurrent transcription sessions")
+    transcribe_parser.add_argument("--streaming", action="store_true", help="decode the recordings in memory instead of reading wav files")
+    transcribe_parser.add_argument("--speech-turns", action="store_true", help="with --streaming or --vad, cut the turns from the 16kHz mono audio sent to the service, decoding the recordings once less")
+    transcribe_parser.add_argument("--manifest", default=None, help="sqlite file recording finished work, so that reruns only redo what changed")
+    _add_vad_arguments(transcribe_parser)
+    transcribe_parser.add_argument("--fingerprints", default=None, help="sqlite fingerprint index, recordings duplicating another one are skipped")
+    transcribe_parser.add_argument("--workers", type=_workers, default=1, help="worker processes fingerprinting the recordings, 0 uses every core")
+    transcribe_parser.set_defaults(handler=transcribe)
+
+    split_parser = subparsers.add_parser("split", help="split recordings along their docx transcripts")
+    split_parser.add_argument("--src", default=os.path.join(AUDIO_RECORDINGS, "V-Processing"))
+    split_parser.add_argument("--transcripts", default=os.path.join(".", "Transcripts"))
+    split_parser.add_argument("--concurrency", type=int, default=1, help="transcripts parsed at once")
+    split_parser.add_argument("--cache", default=None, help="sqlite file caching the model answers")
+    split_parser.add_argument("--manifest", default=None, help="sqlite file recording finished work, so that reruns only redo what changed")
+    _add_vad_arguments(split_parser)
+    split_parser.set_defaults(handler=split)
+
+    vad_parser = subparsers.add_parser("vad", help="report the audio seconds voice activity trimming saves on every recording")
+    vad_parser.add_argument("src", help="directory of the recordings")
+    _add_vad_arguments(vad_parser, flag=False)
+    vad_parser.set_defaults(handler=vad)
+
+    dedup_parser = subparsers.add_parser("dedup", help="find recordings that duplicate or overlap another one, and the ones shared by two classes")
+    dedup_parser.add_argument("directories", nargs="+", help="directories of the recordings, each one a class named after it")
+    dedup_parser.add_argument("--index", default="fingerprints.sqlite3", help="sqlite fingerprint index, kept from one run to the next")
+    dedup_parser.add_argument("--workers", type=_workers, default=1, help="worker processes, 0 uses every core")
+    dedup_parser.set_defaults(handler=dedup)
+
+    export_parser = subparsers.add_parser("export", help="pack the split turns into memory-mappable shards with a columnar index")
+    export_parser.add_argument("dest", help="directory of the dataset")
+    export_parser.add_argument("--fraud", default=os.path.join(AUDIO_RECORDINGS, "V-Processing"))
+    export_parser.add_argument("--safe", default=os.path.join(AUDIO_RECORDINGS, "NV-Processing"))
+    export_parser.add_argument("--shard-mb", type=int, default=128, help="size a shard grows to before the next one starts")
+    export_parser.set_defaults(handler=export)
+
+    detect_parser = subparsers.add_parser("detect", help="judge transcripts.json files")
+    detect_parser.add_argument("transcripts", nargs="+")
+    detect_parser.add_argument("--mode", choices=["naive", "principles"], default="principles")
+    detect_parser.add_argument("--token-budget", type=int, default=None)
+    detect_parser.add_argument("--cache", default=None, help="sqlite file caching the model answers")
+    detect_parser.add_argument("--classifier", default=None, help="model trained by train, only the calls it is uncertain about go to the LLM")
+    detect_parser.set_defaults(handler=detect)
+
+    train_parser = subparsers.add_parser("train", help="train the local classifier judging calls before the LLM on the split transcripts")
+    train_parser.add_argument("model", help="npz file the classifier is saved to")
+    train_parser.add_argument("--fraud", default=os.path.join(AUDIO_RECORDINGS, "V-Processing"))
+    train_parser.add_argument("--safe", default=os.path.join(AUDIO_RECORDINGS, "NV-Processing"))
+    train_parser.add_argument("--calibration-share", type=float, default=0.2, help="share of the transcripts of each class the thresholds are picked on")
+    train_parser.add_argument("--test-share", type=float, default=0.2, help="share of the transcripts of each class the classifier is measured and benchmarked on")
+    train_parser.add_argument("--target-precision", type=float, default=0.95, help="how often SAFE and FRAUD answers must be right on the calibration transcripts")
+    train_parser.add_argument("--feature-bits", type=int, default=18, help="the n-grams are hashed into 2**feature-bits features")
+    train_parser.add_argument("--seed", type=int, default=0)
+    train_parser.set_defaults(handler=train)
+
+    serve_parser = subparsers.add_parser("serve", help="receive call audio over websockets, transcribing and judging calls as they go")
+    serve_parser.add_argument("--port", type=int, default=8080, help="port the dev tunnel forwards")
+    serve_parser.add_argument("--replay-only", action="store_true", help="no speech service, only accept replayed calls carrying their transcript")
+    serve_parser.add_argument("--mode", choices=["naive", "principles"], default="naive")
+    serve_parser.add_argument("--debounce-seconds", type=float, default=2.0)
+    serve_parser.add_argument("--max-delay-seconds", type=float, default=10.0)
+    serve_parser.add_argument("--cache", default=None, help="sqlite file caching the model answers")
+    serve_parser.set_defaults(handler=serve)
+
+    replay_parser = subparsers.add_parser("replay", help="send recordings to the media streaming server as calls")
+    replay_parser.add_argument("recordings", nargs="+")
+    replay_parser.add_argument("--url", default="ws://localhost:8080")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="times faster than real time, 0 sends as fast as possible")
+    replay_parser.add_argument("--no-transcript", action="store_true", help="don't send the transcript along, for servers with a speech service")
+    replay_parser.add_argument("--benchmark", action="store_true", help="replay through a local server and report the audio to verdict latency")
+    replay_parser.add_argument("--concurrency", type=int, default=4, help="calls going on at once when benchmarking")
+    replay_parser.add_argument("--debounce-seconds", type=float, default=2.0)
+    replay_parser.add_argument("--max-delay-seconds", type=float, default=10.0)
+    replay_parser.add_argument("--stub", action="store_true", help="benchmark against a local stub model server")
+    replay_parser.add_argument("--stub-latency", type=float, default=0.5)
+    replay_parser.add_argument("--cache", default=None, help="sqlite file caching the model answers")
+    replay_parser.set_defaults(handler=replay)
+
+    report_parser = subparsers.add_parser("report", help="summarise where the time of every recording went in a trace")
+    report_parser.add_argument("trace_file")
+    report_parser.add_argument("--recordings", type=int, default=10, help="slowest recordings to show")
+    report_parser.set_defaults(handler=report)
+
+    call_parser = subparsers.add_parser("call", help="start a dev tunnel and place a call, or many to measure the call setup latency")
+    call_parser.add_argument("--calls", type=int, default=1, help="calls to place, more than one reports the setup latency percentiles")
+    call_parser.add_argument("--concurrency", type=int, default=8, help="calls being set up at once")
+    call_parser.add_argument("--pool-size", type=int, default=8, help="identities provisioned ahead of the calls, 0 provisions them per call")
+    call_parser.add_argument("--stub", action="store_true", help="place the calls against a local stub of the identity and call endpoints")
+    call_parser.add_argument("--stub-latency", type=float, default=0.05)
+    call_parser.set_defaults(handler=call)
+
+    return parser
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # the sdks log every request at INFO
+    for library in ("httpx", "openai", "azure", "websockets"):
+        logging.getLogger(library).setLevel(logging.WARNING)
+
+    if args.trace is not None:
+        from instrumentation import JsonlSink, configure_instrumentation
+        configure_instrumentation(JsonlSink(args.trace))
+
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
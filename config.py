@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# every secret used by the pipeline, fetched together so that startup costs a single parallel round trip
+SECRET_NAMES = [
+    "com754-ss-key",
+    "com754-ss-endpoint",
+    "com754-ai-key",
+    "com754-ai-endpoint",
+    "com754-cs-key",
+    "com754-cs-endpoint"
+]
+
+SECRETS_FILE_VARIABLE = "COM754_SECRETS_FILE"
+DEFAULT_SECRETS_FILE = "secrets.local.json"
+
+class SecretsProvider:
+    """
+    Process-wide source of secrets. Values come from, in order: an environment variable named after the secret
+    (com754-ai-key is read from COM754_AI_KEY), a local json file, then the key vault. The credential is
+    resolved once and key vault values are kept for ttl_seconds.
+    """
+    def __init__(self, keyvault_name: str | None = None, ttl_seconds: float = 3600, secrets_file: str | None = None):
+        self.keyvault_name = keyvault_name
+        self.ttl_seconds = ttl_seconds
+        self.secrets_file = secrets_file or os.environ.get(SECRETS_FILE_VARIABLE, DEFAULT_SECRETS_FILE)
+
+        self._lock = threading.Lock()
+        self._credential = None
+        self._kv_client = None
+        self._cache: dict[str, tuple[float, str | None]] = {}
+        self._file_secrets = None
+
+    @property
+    def credential(self):
+        with self._lock:
+            if self._credential is None:
+                from azure.identity import DefaultAzureCredential
+                self._credential = DefaultAzureCredential()
+
+            return self._credential
+
+    def _local_secret(self, name: str) -> str | None:
+        value = os.environ.get(name.upper().replace("-", "_"))
+        if value is not None:
+            return value
+
+        if self._file_secrets is None:
+            self._file_secrets = {}
+            if os.path.isfile(self.secrets_file):
+                with open(self.secrets_file, "r") as json_file:
+                    self._file_secrets = json.load(json_file)
+
+        return self._file_secrets.get(name)
+
+    def _key_vault_client(self):
+        credential = self.credential
+
+        with self._lock:
+            if self._kv_client is None:
+                from azure.keyvault.secrets import SecretClient
+
+                keyvault_name = self.keyvault_name or os.environ["KEY_VAULT_NAME"]
+
+                # URI for accessing key vault
+                keyvault_uri = f"https://{keyvault_name}.vault.azure.net"
+                self._kv_client = SecretClient(vault_url=keyvault_uri, credential=credential)
+
+                print(f"Retrieving your secrets from {keyvault_name}.")
+
+            return self._kv_client
+
+    def get_secrets(self, *names: str) -> dict[str, str | None]:
+        """
+        Returns the value of every secret asked for, fetching the ones missing from the key vault concurrently
+
+        :param names: Names of the secrets in the key vault
+        :type names: str
+        :return: Value of every secret
+        :rtype: dict[str, str | None]
+        """
+        secrets = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for name in names:
+                local_value = self._local_secret(name)
+                if local_value is not None:
+                    secrets[name] = local_value
+                elif name in self._cache and now - self._cache[name][0] < self.ttl_seconds:
+                    secrets[name] = self._cache[name][1]
+
+        missing = [name for name in names if name not in secrets]
+        if len(missing) == 0:
+            return secrets
+
+        # every known secret missing from the cache comes along, so that later lookups cost nothing
+        with self._lock:
+            to_fetch = set(missing) | {
+                name for name in SECRET_NAMES
+                if self._local_secret(name) is None and (name not in self._cache or now - self._cache[name][0] >= self.ttl_seconds)
+            }
+
+        kv_client = self._key_vault_client()
+        with ThreadPoolExecutor(max_workers=len(to_fetch)) as executor:
+            fetched = dict(zip(to_fetch, executor.map(lambda name: kv_client.get_secret(name).value, to_fetch)))
+
+        with self._lock:
+            for name, value in fetched.items():
+                self._cache[name] = (now, value)
+
+        for name in missing:
+            secrets[name] = fetched[name]
+
+        return secrets
+
+    def get_secret(self, name: str) -> str | None:
+        return self.get_secrets(name)[name]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._file_secrets = None
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_secrets_provider() -> SecretsProvider:
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = SecretsProvider()
+
+        return _provider
+
+def get_secrets(*names: str) -> dict[str, str | None]:
+    return get_secrets_provider().get_secrets(*names)
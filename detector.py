@@ -1,11 +1,14 @@
-import os 
+import time
+import itertools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from typing import Literal
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
-import azure.cognitiveservices.speech as speechsdk
-from collections import OrderedDict
-from openai import OpenAI
+from config import get_secrets
 from pydantic import BaseModel
+from llm_cache import LLMCache
+from transcript import TurnStore, encode_transcript
+from instrumentation import span, count, record_usage
 
 class FinalDetectorResults(BaseModel):
     answer: Literal["SAFE", "FRAUD", "UNCERTAIN"]
@@ -60,51 +63,163 @@ distraction_prompt = """
     If one or many seems to be true, return "TRUE", otherwise, return "FALSE".
 """
 
-"""if (results.authority_detected or results.distraction_detected or results.social_proof_detected) and results.sensitive_requested:
-return FinalDetectorResults(answer="FRAUD")
-elif (results.authority_detected or results.distraction_detected or results.social_proof_detected) or results.sensitive_requested:
-return FinalDetectorResults(answer="UNCERTAIN")
-else:
-return FinalDetectorResults(answer="SAFE")"""
+sensitive_information_prompt = """
+    Please analyze the call content and detect whether the caller is requesting sensitive information or actions from the callee. 
+    You can determine so by answering those questions:
+        - Does the caller ask for credentials, passwords, PINs or one-time codes?
+        - Does the caller ask for banking or card details, or for money to be transferred?
+        - Does the caller ask for personal identifying information (e.g. date of birth, national insurance or social security number, address)?
+        - Does the caller ask the callee to install software, give remote access to a device or perform an action on one of their accounts?
+    If one or many seems to be true, return "TRUE", otherwise, return "FALSE".
+"""
 
-class LLMDetector():
-    def __init__(self):
-        keyvault_name = os.environ["KEY_VAULT_NAME"]
+summary_prompt = """
+    Please summarise the phone call below so that the summary can replace the transcript when deciding whether the call is a fraud.
+    Start from the previous summary when one is given and fold the new turns into it.
+    Keep who the caller claims to be, everything the caller asks the callee to give or do, 
+    any pressure, urgency, threat or promise made, and how the callee reacts. Leave out greetings and small talk.
+"""
 
-        # Set these variables to the names you created for your secrets
-        SS_KEY_NAME = "com754-ss-key"
-        SS_ENDPOINT_NAME = "com754-ss-endpoint"
-        AI_KEY_NAME = "com754-ai-key"
-        AI_ENDPOINT_NAME = "com754-ai-endpoint"
-        CS_KEY_NAME = "com754-cs-key"
-        CS_ENDPOINT_NAME = "com754-cs-endpoint"
+class CallSummary(BaseModel):
+    summary: str
 
-        # URI for accessing key vault
-        keyvault_uri = f"https://{keyvault_name}.vault.azure.net"
+class EnhancedDetectorResults(BaseModel):
+    # None until the matching check has answered
+    authority_detected: bool | None = None
+    social_proof_detected: bool | None = None
+    distraction_detected: bool | None = None
+    sensitive_requested: bool | None = None
 
-        # Instantiate the client and retrieve secrets
-        credential = DefaultAzureCredential()
-        kv_client = SecretClient(vault_url=keyvault_uri, credential=credential)
+persuasion_principle_prompts = {
+    "authority_detected": authority_prompt,
+    "social_proof_detected": social_proof_prompt,
+    "distraction_detected": distraction_prompt,
+    "sensitive_requested": sensitive_information_prompt
+}
 
-        print(f"Retrieving your secrets from {keyvault_name}.")
+def combine_results(results: EnhancedDetectorResults) -> FinalDetectorResults:
+    if (results.authority_detected or results.distraction_detected or results.social_proof_detected) and results.sensitive_requested:
+        return FinalDetectorResults(answer="FRAUD")
+    elif (results.authority_detected or results.distraction_detected or results.social_proof_detected) or results.sensitive_requested:
+        return FinalDetectorResults(answer="UNCERTAIN")
+    else:
+        return FinalDetectorResults(answer="SAFE")
 
-        retrieved_key = kv_client.get_secret(SS_KEY_NAME).value
-        retrieved_endpoint = kv_client.get_secret(SS_ENDPOINT_NAME).value
+def decided_result(results: EnhancedDetectorResults) -> FinalDetectorResults | None:
+    """
+    Returns the final answer if the checks still pending can no longer change it, None otherwise
 
-        self.speech_client = speechsdk.SpeechConfig(subscription=retrieved_key, endpoint=retrieved_endpoint)
+    :param results: Answers of the checks so far
+    :type results: EnhancedDetectorResults
+    """
+    pending = [field for field, value in results if value is None]
+    answers = set()
 
-        retrieved_key = kv_client.get_secret(AI_KEY_NAME).value
-        retrieved_endpoint = kv_client.get_secret(AI_ENDPOINT_NAME).value
+    for outcome in itertools.product([False, True], repeat=len(pending)):
+        answers.add(combine_results(results.model_copy(update=dict(zip(pending, outcome)))).answer)
 
+        if len(answers) > 1:
+            return None
+
+    return FinalDetectorResults(answer=answers.pop())
+
+class LLMDetector():
+    def __init__(self, cache: LLMCache | None = None, token_budget: int | None = None, endpoint: str | None = None, api_key: str | None = None):
         self.MODEL = "gpt-5-mini"
-        self.ai_client = OpenAI(base_url=retrieved_endpoint, api_key=retrieved_key)
 
-        self.cs_endpoint = kv_client.get_secret(CS_ENDPOINT_NAME).value or ""
-        self.cs_key = kv_client.get_secret(CS_KEY_NAME).value or ""
+        # imported here so that importing the prompts and results does not load the sdks
+        from openai import OpenAI
+
+        # an explicit endpoint, such as the stub model server, skips the key vault
+        if endpoint is not None and api_key is not None:
+            self.ai_client = OpenAI(base_url=endpoint, api_key=api_key)
+        else:
+            # Set these variables to the names you created for your secrets
+            SS_KEY_NAME = "com754-ss-key"
+            SS_ENDPOINT_NAME = "com754-ss-endpoint"
+            AI_KEY_NAME = "com754-ai-key"
+            AI_ENDPOINT_NAME = "com754-ai-endpoint"
+            CS_KEY_NAME = "com754-cs-key"
+            CS_ENDPOINT_NAME = "com754-cs-endpoint"
+
+            secrets = get_secrets(SS_KEY_NAME, SS_ENDPOINT_NAME, AI_KEY_NAME, AI_ENDPOINT_NAME, CS_KEY_NAME, CS_ENDPOINT_NAME)
+
+            import azure.cognitiveservices.speech as speechsdk
+
+            self.speech_client = speechsdk.SpeechConfig(subscription=secrets[SS_KEY_NAME], endpoint=secrets[SS_ENDPOINT_NAME])
+
+            self.ai_client = OpenAI(base_url=secrets[AI_ENDPOINT_NAME], api_key=secrets[AI_KEY_NAME])
+
+            self.cs_endpoint = secrets[CS_ENDPOINT_NAME] or ""
+            self.cs_key = secrets[CS_KEY_NAME] or ""
+
+        self.cache = cache
+        self.token_budget = token_budget
+
+        # token usage of every request sent, read by the benchmark, late_checks counting the checks still running
+        # when analyse returned early, whose tokens are added once they complete
+        self.usage = {"requests": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0, "late_checks": 0}
+        self._usage_lock = threading.Lock()
+        self._abandoned = set()
+
+    def _render(self, conversation: TurnStore | str) -> str:
+        # already rendered content, such as the summary and latest turns of a StreamingDetector, is sent as it is
+        if isinstance(conversation, str):
+            return conversation
+
+        return encode_transcript(conversation, self.token_budget)
+
+    def _parse(self, request: dict):
+        """
+        Sends a request to the model unless the cache already holds its answer
+
+        :param request: Keyword arguments of responses.parse
+        :type request: dict
+        """
+        if self.cache is not None:
+            key = self.cache.key_for_request(request)
+            output_parsed = self.cache.get(key, request["text_format"])
+
+            if output_parsed is not None:
+                count("llm_cache_hits")
+                return output_parsed
+
+        with span("llm.detect", format=request["text_format"].__name__) as attributes:
+            response = self.ai_client.responses.parse(**request)
+            record_usage(attributes, response)
+
+        if response.usage is not None:
+            with self._usage_lock:
+                self.usage["requests"] += 1
+                self.usage["input_tokens"] += response.usage.input_tokens
+                self.usage["cached_tokens"] += response.usage.input_tokens_details.cached_tokens
+                self.usage["output_tokens"] += response.usage.output_tokens
+                self.usage["reasoning_tokens"] += response.usage.output_tokens_details.reasoning_tokens
+
+        if self.cache is not None and response.output_parsed is not None:
+            self.cache.put(key, response.output_parsed)
+
+        return response.output_parsed
+
+    def _summarise_call(self, previous_summary: str, turns: TurnStore) -> str:
+        summary = self._parse(dict(
+            model=self.MODEL,
+            store=False,
+            reasoning={"effort": "low"},
+            instructions=summary_prompt,
+            input=[
+                {
+                    "role": "user",
+                    "content": "Previous summary:\n{}\n\nNew turns:\n{}".format(previous_summary or "None", encode_transcript(turns))
+                }
+            ],
+            text_format=CallSummary
+        ))
 
+        return summary.summary if summary is not None else previous_summary
 
-    def _analyse_call_for_vishing_naive(self, conversation: OrderedDict) -> FinalDetectorResults | None:
-        response = self.ai_client.responses.parse(
+    def _analyse_call_for_vishing_naive(self, conversation: TurnStore | str) -> FinalDetectorResults | None:
+        return self._parse(dict(
             model=self.MODEL,
             store=False,
             reasoning={"effort": "medium"},
@@ -112,21 +227,19 @@ class LLMDetector():
             input=[
                 {
                     "role": "user",
-                    "content": str(conversation)
+                    "content": self._render(conversation)
                 }
             ],
             text_format=FinalDetectorResults
-        )
-
-        return response.output_parsed
+        ))
     
     def _analyse_call_for_vishing(
         self, 
         prompt: str, 
-        conversation: OrderedDict,
+        conversation: TurnStore | str,
         response_format
     ) -> FinalDetectorResults | None:
-        response = self.ai_client.responses.parse(
+        return self._parse(dict(
             model=self.MODEL,
             store=False,
             reasoning={"effort": "medium"},
@@ -134,10 +247,205 @@ class LLMDetector():
             input=[
                 {
                     "role": "user",
-                    "content": str(conversation)
+                    "content": self._render(conversation)
                 }
             ],
             text_format=response_format
+        ))
+
+    def analyse(self, conversation: TurnStore | str, early_exit: bool = True) -> FinalDetectorResults:
+        """
+        Runs every persuasion principle check at once and combines their answers into a verdict,
+        returning as soon as the checks still pending can no longer change it. The requests of these checks
+        are already sent by then and can't be called back: they still run to completion and spend their tokens,
+        which are added to usage after the verdict is returned, see wait_for_abandoned
+
+        :param conversation: Transcript of the call
+        :type conversation: TurnStore | str
+        :param early_exit: Return without waiting for the checks that can no longer change the verdict
+        :type early_exit: bool
+        :return: SAFE, FRAUD or UNCERTAIN
+        :rtype: FinalDetectorResults
+        """
+        results = EnhancedDetectorResults()
+        executor = ThreadPoolExecutor(max_workers=len(persuasion_principle_prompts))
+        futures = {}
+
+        try:
+            futures = {
+                # each check runs in a copy of the caller's context, so that its span belongs to the caller's recording
+                executor.submit(contextvars.copy_context().run, self._analyse_call_for_vishing, prompt, conversation, IntermediateEnhancedDetectorResults): field
+                for field, prompt in persuasion_principle_prompts.items()
+            }
+
+            for future in as_completed(futures):
+                answer = future.result()
+                if answer is not None:
+                    setattr(results, futures[future], answer.answer)
+
+                if early_exit:
+                    decided = decided_result(results)
+                    if decided is not None:
+                        return decided
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+            # checks that hadn't started are cancelled, the ones still running are left to finish on their own
+            late = [future for future in futures if not future.done()]
+            with self._usage_lock:
+                self.usage["late_checks"] += len(late)
+                self._abandoned.update(late)
+            for future in late:
+                future.add_done_callback(self._release_abandoned)
+
+        # a check without any parsed answer leaves the verdict open
+        return decided_result(results) or FinalDetectorResults(answer="UNCERTAIN")
+
+    def _release_abandoned(self, future):
+        with self._usage_lock:
+            self._abandoned.discard(future)
+
+    def wait_for_abandoned(self):
+        """
+        Waits for the checks analyse left running after returning early, so that usage holds all of their tokens
+        """
+        with self._usage_lock:
+            abandoned = list(self._abandoned)
+
+        wait(abandoned)
+
+class StreamingDetector():
+    """
+    Judges a call while it is still going on. Turns are received as they are transcribed, re-evaluation is
+    debounced, and older turns are folded into a summary so that each evaluation only sends the summary
+    plus the latest turns instead of the whole call.
+    """
+    def __init__(
+        self, 
+        detector: LLMDetector, 
+        debounce_seconds: float = 2.0, 
+        max_delay_seconds: float = 10.0,
+        recent_turns: int = 4,
+        use_principles: bool = False,
+        on_verdict=None
+    ):
+        """
+        :param detector: Detector sending the requests
+        :type detector: LLMDetector
+        :param debounce_seconds: Quiet time after the last turn before evaluating
+        :type debounce_seconds: float
+        :param max_delay_seconds: Longest a turn waits to be evaluated when turns keep coming
+        :type max_delay_seconds: float
+        :param recent_turns: Turns sent verbatim, older ones are summarised
+        :type recent_turns: int
+        :param use_principles: Use LLMDetector.analyse instead of the naive prompt
+        :type use_principles: bool
+        :param on_verdict: Called with the seconds since start and the verdict after each evaluation
+        """
+        self.detector = detector
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.recent_turns = max(1, recent_turns)
+        self.use_principles = use_principles
+        self.on_verdict = on_verdict
+
+        self.turns = TurnStore()
+        self.summary = ""
+        self.summarised_turns = 0
+        self.verdicts: list[tuple[float, FinalDetectorResults]] = []
+        self.time_to_first_fraud: float | None = None
+        # end in milliseconds of the audio the latest verdict was based on, read by on_verdict to measure latency
+        self.evaluated_until = 0
+
+        self._condition = threading.Condition()
+        self._pending_since: float | None = None
+        self._last_turn_at = 0.0
+        self._stopped = False
+        self._thread = None
+        # verdicts are timed from start(), or from the creation of a detector that is only ever stopped
+        self.started_at = time.monotonic()
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, evaluate_remaining: bool = True):
+        """
+        Stops the detector, evaluating the turns received since the last verdict unless asked not to
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        if evaluate_remaining and self._pending_since is not None:
+            self._evaluate()
+
+    def on_turn(self, offset: int, turn: dict):
+        """
+        Receives a turn that was just started or extended, meant to be given to TranscriptionSession as a turn listener
+        """
+        with self._condition:
+            self.turns.put(offset, turn["speaker"], turn["text"], turn["duration"])
+            self._last_turn_at = time.monotonic()
+            if self._pending_since is None:
+                self._pending_since = self._last_turn_at
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending_since is None and not self._stopped:
+                    self._condition.wait()
+
+                # wait for the speakers to pause, without holding a turn back for longer than max_delay_seconds
+                while not self._stopped:
+                    now = time.monotonic()
+                    deadline = min(self._last_turn_at + self.debounce_seconds, self._pending_since + self.max_delay_seconds)  # type: ignore
+                    if now >= deadline:
+                        break
+                    self._condition.wait(deadline - now)
+
+                if self._stopped:
+                    return
+
+            self._evaluate()
+
+    def _evaluate(self):
+        with self._condition:
+            self._pending_since = None
+            turns = self.turns.slice(0)
+
+        evaluated_until = turns.offsets[-1] + turns.durations[-1] if len(turns) > 0 else 0
+
+        # the last turn can still be extended, so only turns before the most recent ones are folded into the summary
+        to_summarise = turns.slice(self.summarised_turns, max(self.summarised_turns, len(turns) - self.recent_turns))
+        if len(to_summarise) > 0:
+            self.summary = self.detector._summarise_call(self.summary, to_summarise)
+            self.summarised_turns += len(to_summarise)
+
+        content = "Summary of the call so far:\n{}\n\nLatest turns:\n{}".format(
+            self.summary or "None", 
+            encode_transcript(turns.slice(self.summarised_turns), self.detector.token_budget, "tail")
         )
 
-        return response.output_parsed
\ No newline at end of file
+        if self.use_principles:
+            verdict = self.detector.analyse(content)
+        else:
+            verdict = self.detector._analyse_call_for_vishing_naive(content)
+
+        if verdict is None:
+            return
+
+        elapsed = time.monotonic() - self.started_at
+        self.evaluated_until = evaluated_until
+        self.verdicts.append((elapsed, verdict))
+        if verdict.answer == "FRAUD" and self.time_to_first_fraud is None:
+            self.time_to_first_fraud = elapsed
+            print("FRAUD detected {:.1f}s after the call started".format(elapsed))
+
+        if self.on_verdict is not None:
+            self.on_verdict(elapsed, verdict)
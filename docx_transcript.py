@@ -0,0 +1,101 @@
+import re
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+SPEAKER_ALIASES = {
+    "attacker": "Attacker",
+    "scammer": "Attacker",
+    "fraudster": "Attacker",
+    "victim": "Victim",
+    "target": "Victim"
+}
+
+# [MM:SS] Speaker: text, hours and brackets optional, the speaker can also come on the next paragraph
+TIMESTAMP = r"\[?\s*(?P<offset>(?:\d{1,2}:)?\d{1,3}:\d{2}(?:[.,]\d+)?)\s*\]?"
+TURN_PATTERN = re.compile(r"^\s*" + TIMESTAMP + r"\s*[-–—]?\s*(?P<speaker>[A-Za-z][\w .'-]{0,40}?)\s*:\s*(?P<text>.*)$", re.DOTALL)
+TIMESTAMP_PATTERN = re.compile(r"^\s*" + TIMESTAMP + r"\s*$")
+SPEAKER_PATTERN = re.compile(r"^\s*(?P<speaker>[A-Za-z][\w .'-]{0,40}?)\s*:\s*(?P<text>.*)$", re.DOTALL)
+
+def read_paragraphs(path: str) -> list[str]:
+    """
+    Reads the text of every paragraph of a docx file straight from its xml, tabs and line breaks included
+    """
+    with zipfile.ZipFile(path) as docx:
+        root = ElementTree.fromstring(docx.read("word/document.xml"))
+
+    paragraphs = []
+    for paragraph in root.iter(WORD_NAMESPACE + "p"):
+        text = []
+        for element in paragraph.iter():
+            if element.tag == WORD_NAMESPACE + "t":
+                text.append(element.text or "")
+            elif element.tag == WORD_NAMESPACE + "tab":
+                text.append("\t")
+            elif element.tag in (WORD_NAMESPACE + "br", WORD_NAMESPACE + "cr"):
+                text.append("\n")
+        paragraphs.append("".join(text))
+
+    return paragraphs
+
+def _speaker(name: str) -> str | None:
+    return SPEAKER_ALIASES.get(name.strip().lower())
+
+def parse_docx_transcript(path: str) -> list[tuple[str, str, str]] | None:
+    """
+    Extracts the timestamped turns of a docx transcript without any model
+
+    :param path: Docx transcript
+    :type path: str
+    :return: Offset as written in the transcript (e.g. "[01:05]"), speaker and text of every turn,
+        None when the document doesn't follow the expected layout
+    :rtype: list[tuple[str, str, str]] | None
+    """
+    try:
+        paragraphs = read_paragraphs(path)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError):
+        return None
+
+    turns = []
+    pending_offset = None
+
+    for paragraph in paragraphs:
+        if paragraph.strip() == "":
+            continue
+
+        match = TURN_PATTERN.match(paragraph)
+        if match is not None:
+            offset, speaker, text = match.group("offset"), match.group("speaker"), match.group("text")
+        else:
+            timestamp_match = TIMESTAMP_PATTERN.match(paragraph)
+            if timestamp_match is not None:
+                pending_offset = timestamp_match.group("offset")
+                continue
+
+            speaker_match = SPEAKER_PATTERN.match(paragraph)
+            if pending_offset is not None and speaker_match is not None:
+                offset, speaker, text = pending_offset, speaker_match.group("speaker"), speaker_match.group("text")
+            elif len(turns) > 0 and pending_offset is None:
+                # a paragraph without timestamp carries on the current turn
+                offset, speaker, text = turns[-1]
+                turns[-1] = (offset, speaker, "{}\n{}".format(text, paragraph.strip()))
+                continue
+            elif len(turns) == 0:
+                # title and header lines before the first turn
+                continue
+            else:
+                # a timestamp followed by something else than a speaker, left to the LLM rather than dropped
+                return None
+
+        pending_offset = None
+        normalised_speaker = _speaker(speaker)
+        if normalised_speaker is None:
+            return None
+
+        turns.append(("[{}]".format(offset), normalised_speaker, text.strip()))
+
+    if len(turns) < 2 or pending_offset is not None:
+        return None
+
+    return turns
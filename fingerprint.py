@@ -0,0 +1,394 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import BaseModel
+from audio import PcmAudio, open_pcm_reader
+from segmentation import samples_from_pcm
+
+class FingerprintSettings(BaseModel):
+    """
+    Shape of the spectral peak hashes, an index only matches recordings fingerprinted with the same settings
+    """
+    # window and hop are in milliseconds so that the frequency bins are the same whatever the frame rate
+    window_ms: int = 64
+    hop_ms: int = 32
+    # telephone band, higher frequencies don't survive every codec
+    max_frequency: int = 4000
+    # a peak is the loudest bin within that many frames and bins around it
+    neighbourhood_frames: int = 8
+    neighbourhood_bins: int = 12
+    # and stands that far above the mean level of its frame
+    min_prominence_db: float = 10.0
+    min_level_db: float = -70.0
+    # every peak is paired with up to fan_out of the next peaks, at most max_delta_frames later
+    fan_out: int = 5
+    max_delta_frames: int = 63
+
+class DuplicateMatch(BaseModel):
+    """
+    Recording of the index a new recording duplicates
+    """
+    original: str
+    # exact: same bytes, same: same audio over the whole length, overlap: one recording is a clip of the other
+    # or they share a stretch
+    kind: str
+    # where the new recording starts within the original, negative when it starts earlier
+    offset_ms: int
+    matched_hashes: int
+    # share of the hashes of the shorter recording found at the same offset in the other one
+    coverage: float
+
+def _frame_spectra(samples: np.ndarray, window: int, hop: int, bins: int) -> np.ndarray:
+    # log magnitude of every whole window of samples, one row per frame
+    if len(samples) < window:
+        return np.empty((0, bins), dtype=np.float32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, window)[::hop]
+    spectra = np.abs(np.fft.rfft(frames * np.hanning(window).astype(np.float32), axis=1))[:, :bins]
+
+    return (20 * np.log10(spectra / window + 1e-10)).astype(np.float32)
+
+def _local_maxima(spectra: np.ndarray, neighbourhood_frames: int, neighbourhood_bins: int) -> np.ndarray:
+    # maximum filter split into one pass over the bins and one over the frames
+    padded = np.pad(spectra, ((0, 0), (neighbourhood_bins, neighbourhood_bins)), constant_values=-np.inf)
+    maxima = np.lib.stride_tricks.sliding_window_view(padded, 2 * neighbourhood_bins + 1, axis=1).max(axis=2)
+    padded = np.pad(maxima, ((neighbourhood_frames, neighbourhood_frames), (0, 0)), constant_values=-np.inf)
+    maxima = np.lib.stride_tricks.sliding_window_view(padded, 2 * neighbourhood_frames + 1, axis=0).max(axis=2)
+
+    return spectra >= maxima
+
+def find_peaks(path: str, settings: FingerprintSettings | None = None, chunk_frames: int = 65536) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Finds the spectral peaks of a recording in a single streamed pass, holding only a chunk of its spectrogram at a time
+
+    :param path: Recording of any format
+    :type path: str
+    :return: Frame and frequency bin of every peak, by frame, and the duration of the recording in milliseconds
+    :rtype: tuple[np.ndarray, np.ndarray, int]
+    """
+    settings = settings or FingerprintSettings()
+    peak_frames, peak_bins = [], []
+
+    with open_pcm_reader(path) as reader:
+        frame_rate = reader.frame_rate
+        window = frame_rate * settings.window_ms // 1000
+        hop = frame_rate * settings.hop_ms // 1000
+        bins = min(window // 2 + 1, settings.max_frequency * settings.window_ms // 1000)
+
+        # samples not yet covered by a whole window, then frames whose neighbourhood is not complete yet,
+        # after the frames already judged they need
+        remainder = np.empty(0, dtype=np.float32)
+        context = np.empty((0, bins), dtype=np.float32)
+        pending = np.empty((0, bins), dtype=np.float32)
+        first_pending = 0
+        sample_count = 0
+
+        def judge(count: int):
+            nonlocal context, pending, first_pending
+            spectra = np.concatenate((context, pending))
+            maxima = _local_maxima(spectra, settings.neighbourhood_frames, settings.neighbourhood_bins)[len(context):len(context) + count]
+            judged = pending[:count]
+            level = judged.mean(axis=1, keepdims=True)
+            frames, frequencies = np.nonzero(maxima & (judged > level + settings.min_prominence_db) & (judged > settings.min_level_db))
+
+            peak_frames.append(frames + first_pending)
+            peak_bins.append(frequencies)
+            context = spectra[max(0, len(context) + count - settings.neighbourhood_frames):len(context) + count]
+            pending = pending[count:]
+            first_pending += count
+
+        for chunk in reader.chunks(chunk_frames):
+            samples = samples_from_pcm(PcmAudio(chunk, reader.channels, reader.sample_width, reader.frame_rate)).mean(axis=1)
+            sample_count += len(samples)
+            samples = np.concatenate((remainder, samples))
+
+            spectra = _frame_spectra(samples, window, hop, bins)
+            remainder = samples[len(spectra) * hop:]
+            pending = np.concatenate((pending, spectra))
+
+            if len(pending) > settings.neighbourhood_frames:
+                judge(len(pending) - settings.neighbourhood_frames)
+
+        # the last frames have nothing after them
+        judge(len(pending))
+
+    return np.concatenate(peak_frames), np.concatenate(peak_bins), sample_count * 1000 // frame_rate
+
+def hash_peaks(frames: np.ndarray, frequencies: np.ndarray, settings: FingerprintSettings | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs every peak with the next ones, a pair being hashed from both frequencies and the frames between them
+
+    :return: Hash and frame of the first peak of every pair
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    settings = settings or FingerprintSettings()
+    order = np.lexsort((frequencies, frames))
+    frames, frequencies = frames[order].astype(np.int64), frequencies[order].astype(np.int64)
+
+    hashes, offsets, found = [], [], np.zeros(len(frames), dtype=np.int64)
+    # the peaks of a frame are few, looking that far ahead finds the fan out of nearly every peak
+    for step in range(1, 4 * settings.fan_out + 1):
+        if step >= len(frames):
+            break
+
+        delta = frames[step:] - frames[:-step]
+        valid = (delta > 0) & (delta <= settings.max_delta_frames) & (found[:-step] < settings.fan_out)
+        found[:-step] += valid
+
+        anchors = np.flatnonzero(valid)
+        hashes.append((frequencies[anchors] << 14) | (frequencies[anchors + step] << 6) | delta[anchors])
+        offsets.append(frames[anchors])
+
+    if len(hashes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def fingerprint_file(path: str, settings: FingerprintSettings | None = None) -> tuple[str, np.ndarray, np.ndarray, int]:
+    """
+    Content hash, peak pair hashes and offsets, and duration in milliseconds of a recording, made in a worker process
+    """
+    frames, frequencies, duration_ms = find_peaks(path, settings)
+    hashes, offsets = hash_peaks(frames, frequencies, settings)
+
+    return file_hash(path), hashes, offsets, duration_ms
+
+class FingerprintIndex:
+    """
+    Spectral peak hashes of every recording seen by a stage, to find the recordings already there, exactly or as
+    a clip of a longer one, before spending anything on them. Recordings are compared within a scope, usually the stage,
+    so that the output of a stage doesn't count as a duplicate of its input, and carry a label, such as V or NV,
+    to tell duplicates that leak from one class to the other.
+    """
+    def __init__(
+        self,
+        path: str = "fingerprints.sqlite3",
+        settings: FingerprintSettings | None = None,
+        min_matches: int = 20,
+        min_coverage: float = 0.1
+    ):
+        """
+        :param path: SQLite file of the index
+        :type path: str
+        :param min_matches: Hashes found at the same offset from which two recordings share audio
+        :type min_matches: int
+        :param min_coverage: Share of the hashes of the shorter recording they must share as well
+        :type min_coverage: float
+        """
+        self.path = path
+        self.settings = settings or FingerprintSettings()
+        self.min_matches = min_matches
+        self.min_coverage = min_coverage
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS recordings (
+                id INTEGER PRIMARY KEY,
+                scope TEXT NOT NULL,
+                path TEXT NOT NULL,
+                label TEXT,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                hash_count INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                duplicate_of INTEGER,
+                kind TEXT,
+                offset_ms INTEGER,
+                matched_hashes INTEGER,
+                coverage REAL,
+                indexed_at REAL NOT NULL,
+                UNIQUE (scope, path)
+            );
+            CREATE INDEX IF NOT EXISTS recordings_by_content ON recordings (scope, content_hash);
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                hash INTEGER NOT NULL,
+                recording INTEGER NOT NULL,
+                offset INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fingerprints_by_hash ON fingerprints (hash);
+        """)
+        self._connection.commit()
+
+    def _known(self, scope: str, path: str) -> tuple | None:
+        # the outcome of a recording that didn't change since it was indexed
+        stat = os.stat(path)
+        row = self._connection.execute(
+            "SELECT id, size, mtime_ns, settings, duplicate_of FROM recordings WHERE scope = ? AND path = ?", (scope, path)
+        ).fetchone()
+
+        if row is not None and (row[1], row[2], row[3]) == (stat.st_size, stat.st_mtime_ns, self.settings.model_dump_json()):
+            return row
+
+        if row is not None:
+            self._forget(row[0])
+
+        return None
+
+    def _forget(self, recording_id: int):
+        # duplicates of a recording that changed are checked again
+        self._connection.execute("DELETE FROM fingerprints WHERE recording = ?", (recording_id,))
+        self._connection.execute("DELETE FROM recordings WHERE id = ? OR duplicate_of = ?", (recording_id, recording_id))
+
+    def _match(self, scope: str, content_hash: str, hashes: np.ndarray, offsets: np.ndarray, duration_ms: int) -> tuple[int, DuplicateMatch] | None:
+        row = self._connection.execute(
+            "SELECT id, path FROM recordings WHERE scope = ? AND content_hash = ? AND duplicate_of IS NULL", (scope, content_hash)
+        ).fetchone()
+        if row is not None:
+            return row[0], DuplicateMatch(original=row[1], kind="exact", offset_ms=0, matched_hashes=len(hashes), coverage=1.0)
+
+        if len(hashes) == 0:
+            return None
+
+        # the index looks every hash up once, the alignment is then found by counting the offsets between the matches
+        self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER NOT NULL, offset INTEGER NOT NULL)")
+        self._connection.execute("DELETE FROM query")
+        self._connection.executemany("INSERT INTO query (hash, offset) VALUES (?, ?)", zip(hashes.tolist(), offsets.tolist()))
+        matches = np.array(self._connection.execute("""
+            SELECT f.recording, f.offset - q.offset FROM query q
+            JOIN fingerprints f ON f.hash = q.hash
+            JOIN recordings r ON r.id = f.recording
+            WHERE r.scope = ?
+        """, (scope,)).fetchall(), dtype=np.int64).reshape(-1, 2)
+        if len(matches) == 0:
+            return None
+
+        keys, counts = np.unique(matches[:, 0] * (1 << 32) + matches[:, 1], return_counts=True)
+        # a clip cut between two hops lands on either of two neighbouring offsets
+        scores = counts.copy()
+        for neighbour in (-1, 1):
+            positions = np.searchsorted(keys, keys + neighbour)
+            found = (positions < len(keys)) & (keys[np.minimum(positions, len(keys) - 1)] == keys + neighbour)
+            scores[found] += counts[positions[found]]
+
+        best = int(np.argmax(scores))
+        recording_id, delta = int(keys[best] >> 32), int(keys[best] - (keys[best] >> 32 << 32))
+        if delta >= 1 << 31:
+            recording_id, delta = recording_id + 1, delta - (1 << 32)
+
+        path, hash_count, original_duration_ms = self._connection.execute(
+            "SELECT path, hash_count, duration_ms FROM recordings WHERE id = ?", (recording_id,)
+        ).fetchone()
+        matched = int(scores[best])
+        coverage = matched / max(1, min(len(hashes), hash_count))
+        if matched < self.min_matches or coverage < self.min_coverage:
+            return None
+
+        offset_ms = delta * self.settings.hop_ms
+        same = abs(offset_ms) <= 2 * self.settings.hop_ms and abs(duration_ms - original_duration_ms) <= max(1000, 0.02 * original_duration_ms)
+
+        return recording_id, DuplicateMatch(
+            original=path, kind="same" if same else "overlap", offset_ms=offset_ms, matched_hashes=matched, coverage=min(1.0, coverage)
+        )
+
+    def _add(self, scope: str, path: str, label: str | None, fingerprint: tuple[str, np.ndarray, np.ndarray, int]) -> DuplicateMatch | None:
+        content_hash, hashes, offsets, duration_ms = fingerprint
+        stat = os.stat(path)
+
+        match = self._match(scope, content_hash, hashes, offsets, duration_ms)
+        duplicate_of, fields = None, (None, None, None, None)
+        if match is not None:
+            duplicate_of, duplicate = match
+            fields = (duplicate.kind, duplicate.offset_ms, duplicate.matched_hashes, duplicate.coverage)
+
+        cursor = self._connection.execute(
+            """INSERT INTO recordings (scope, path, label, size, mtime_ns, content_hash, duration_ms, hash_count, settings,
+            duplicate_of, kind, offset_ms, matched_hashes, coverage, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (scope, path, label, stat.st_size, stat.st_mtime_ns, content_hash, duration_ms, len(hashes), self.settings.model_dump_json(),
+             duplicate_of, *fields, time.time())
+        )
+        # duplicates aren't indexed, whatever matches them matches their original as well
+        if match is None:
+            self._connection.executemany(
+                "INSERT INTO fingerprints (hash, recording, offset) VALUES (?, ?, ?)",
+                ((hash_value, cursor.lastrowid, offset) for hash_value, offset in zip(hashes.tolist(), offsets.tolist()))
+            )
+        self._connection.commit()
+
+        return match[1] if match is not None else None
+
+    def _stored_match(self, recording_id: int) -> DuplicateMatch | None:
+        row = self._connection.execute("""
+            SELECT o.path, r.kind, r.offset_ms, r.matched_hashes, r.coverage FROM recordings r
+            JOIN recordings o ON o.id = r.duplicate_of WHERE r.id = ?
+        """, (recording_id,)).fetchone()
+        if row is None:
+            return None
+
+        return DuplicateMatch(original=row[0], kind=row[1], offset_ms=row[2], matched_hashes=row[3], coverage=row[4])
+
+    def deduplicate(self, files: list[str], scope: str, label: str | None = None, workers: int | None = 1) -> dict[str, DuplicateMatch]:
+        """
+        Indexes the recordings in order and tells which ones duplicate a recording indexed before them in the scope,
+        theirs or one of an earlier run. Recordings that didn't change since they were indexed aren't fingerprinted again.
+
+        :param files: Recordings, the first of two duplicates is the one kept
+        :type files: list[str]
+        :param scope: Recordings are only compared within their scope, e.g. the stage about to process them
+        :type scope: str
+        :param label: Class of the recordings, e.g. V or NV
+        :type label: str | None
+        :param workers: Worker processes fingerprinting the recordings, None uses every core
+        :type workers: int | None
+        :return: Duplicates along with the recording they duplicate
+        :rtype: dict[str, DuplicateMatch]
+        """
+        files = [os.path.abspath(file) for file in files]
+        duplicates = {}
+
+        with self._lock:
+            known = {file: self._known(scope, file) for file in files}
+            self._connection.commit()
+        new_files = [file for file in files if known[file] is None]
+
+        # fingerprinting decodes the audio and runs in parallel, matching and indexing are kept in order
+        if workers == 1:
+            fingerprints = [fingerprint_file(file, self.settings) for file in new_files]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                fingerprints = list(executor.map(fingerprint_file, new_files, [self.settings] * len(new_files)))
+        fingerprints = dict(zip(new_files, fingerprints))
+
+        with self._lock:
+            for file in files:
+                if known[file] is not None:
+                    match = self._stored_match(known[file][0])
+                else:
+                    match = self._add(scope, file, label, fingerprints[file])
+
+                if match is not None:
+                    duplicates[file] = match
+
+        return duplicates
+
+    def leaks(self, scope: str) -> list[tuple[str, str, DuplicateMatch]]:
+        """
+        Duplicates whose label differs from the label of their original, e.g. a vishing call also among the safe ones
+
+        :return: Duplicate, its label and how it matches its original
+        :rtype: list[tuple[str, str, DuplicateMatch]]
+        """
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT r.id, r.path, r.label FROM recordings r JOIN recordings o ON o.id = r.duplicate_of
+                WHERE r.scope = ? AND r.label IS NOT o.label
+            """, (scope,)).fetchall()
+
+            return [(path, label, self._stored_match(recording_id)) for recording_id, path, label in rows]  # type: ignore
+
+    def close(self):
+        self._connection.close()
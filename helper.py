@@ -1,6 +1,7 @@
 import subprocess
 import re
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def start_dev_tunnel() -> tuple[str, subprocess.Popen ] | None:
     PID_FILE_PATH = "devtunnel.pid"
@@ -20,4 +21,45 @@ def start_dev_tunnel() -> tuple[str, subprocess.Popen ] | None:
 
                 return (match.group(), process)
         else:
-            raise Exception("Couldn't launch the dev tunnel. Is any other application running on 8080?")
\ No newline at end of file
+            raise Exception("Couldn't launch the dev tunnel. Is any other application running on 8080?")
+
+def run_jobs(function, jobs: list[tuple], workers: int | None = 1) -> list[tuple[tuple, Exception]]:
+    """
+    Runs a function over every job, spreading them over a process pool unless a single worker is asked for.
+    The function must be importable by the worker processes, it returns the progress message to print.
+
+    :param function: Module level function called with the unpacked arguments of a job
+    :param jobs: Arguments of every call
+    :type jobs: list[tuple]
+    :param workers: Amount of worker processes, None uses every core
+    :type workers: int | None
+    :return: Jobs that failed along with the exception they raised
+    :rtype: list[tuple[tuple, Exception]]
+    """
+    errors = []
+
+    def report(done: int, job: tuple, message: str | None, error: Exception | None):
+        if error is None:
+            print("[{}/{}] {}".format(done, len(jobs), message))
+        else:
+            print("[{}/{}] An error happened for {}: {}".format(done, len(jobs), job[0], error))
+            errors.append((job, error))
+
+    if workers == 1:
+        for done, job in enumerate(jobs, start=1):
+            try:
+                report(done, job, function(*job), None)
+            except Exception as e:
+                report(done, job, None, e)
+
+        return errors
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, *job): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                report(done, futures[future], future.result(), None)
+            except Exception as e:
+                report(done, futures[future], None, e)
+
+    return errors
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# worker processes, which may be spawned rather than forked, pick the trace file up from the environment
+TRACE_FILE_VARIABLE = "COM754_TRACE_FILE"
+
+# recording and stage of the innermost span, inherited by the spans and counters opened inside it,
+# including in asyncio tasks and asyncio.to_thread calls
+_current_span: ContextVar[tuple[str | None, str | None]] = ContextVar("current_span", default=(None, None))
+
+class MemorySink:
+    """
+    Keeps every record in a list, for tests and for reports made by the process itself
+    """
+    def __init__(self):
+        self.records: list[dict] = []
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        with self._lock:
+            self.records.append(record)
+
+class JsonlSink:
+    """
+    Appends every record as a line of a jsonl file, each process opening the file on its own
+    """
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            # a forked worker must not share the file object of its parent
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._pid = os.getpid()
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+
+class Instrumentation:
+    """
+    Times the stages of the pipeline and counts what they consume, such as tokens, into a sink.
+    Without a sink, spans and counters do nothing beyond a single check.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+
+    @contextmanager
+    def span(self, stage: str, recording: str | None = None, **attributes):
+        """
+        Times the block as a stage of a recording. The yielded dict can be filled with attributes
+        only known once the block ran, such as the tokens a request used.
+
+        :param stage: Name of the stage, e.g. "transcribe" or "llm.detect"
+        :type stage: str
+        :param recording: Recording the work is done for, the one of the enclosing span if None
+        :type recording: str | None
+        """
+        if self.sink is None:
+            yield attributes
+            return
+
+        parent_recording, parent_stage = _current_span.get()
+        recording = recording or parent_recording
+        token = _current_span.set((recording, stage))
+        started_at = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            _current_span.reset(token)
+            self.sink.write({
+                "type": "span",
+                "stage": stage,
+                "recording": recording,
+                "parent": parent_stage,
+                "started_at": started_at,
+                "seconds": seconds,
+                "error": error,
+                **attributes
+            })
+
+    def count(self, name: str, value: float = 1, recording: str | None = None, **attributes):
+        if self.sink is None:
+            return
+
+        self.sink.write({
+            "type": "count",
+            "name": name,
+            "value": value,
+            "recording": recording or _current_span.get()[0],
+            "stage": _current_span.get()[1],
+            **attributes
+        })
+
+_instrumentation = Instrumentation(JsonlSink(os.environ[TRACE_FILE_VARIABLE]) if os.environ.get(TRACE_FILE_VARIABLE) else None)
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+def configure_instrumentation(sink) -> Instrumentation:
+    """
+    Sends the records of the whole process to sink, None disables the instrumentation.
+    A JsonlSink is also handed down to the worker processes started afterwards.
+    """
+    _instrumentation.sink = sink
+    if isinstance(sink, JsonlSink):
+        os.environ[TRACE_FILE_VARIABLE] = sink.path
+    else:
+        os.environ.pop(TRACE_FILE_VARIABLE, None)
+
+    return _instrumentation
+
+def span(stage: str, recording: str | None = None, **attributes):
+    return _instrumentation.span(stage, recording, **attributes)
+
+def count(name: str, value: float = 1, recording: str | None = None, **attributes):
+    _instrumentation.count(name, value, recording, **attributes)
+
+def record_usage(attributes: dict, response):
+    """
+    Adds the tokens used by a Responses API request to the attributes of its span and to the token counters
+    """
+    usage = getattr(response, "usage", None)
+    if _instrumentation.sink is None or usage is None:
+        return
+
+    attributes["input_tokens"] = usage.input_tokens
+    attributes["cached_tokens"] = usage.input_tokens_details.cached_tokens
+    attributes["output_tokens"] = usage.output_tokens
+    attributes["reasoning_tokens"] = usage.output_tokens_details.reasoning_tokens
+    for name in ("input_tokens", "cached_tokens", "output_tokens", "reasoning_tokens"):
+        count(name, attributes[name])
+
+def percentile(values: list[float], percent: float) -> float:
+    # nearest-rank percentile
+    if len(values) == 0:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+
+    return ordered[int(rank) - 1]
+
+def load_records(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip() != ""]
+
+def summarise(records: list[dict]) -> dict:
+    """
+    Breaks the wall time of every recording down by stage, along with the totals of every stage and counter.
+    The wall time of a recording is the time of its outermost spans, nested spans are part of it.
+
+    :param records: Records of a MemorySink or of load_records
+    :type records: list[dict]
+    :rtype: dict
+    """
+    recordings = {}
+    stages = {}
+    counters = {}
+
+    for record in records:
+        recording = recordings.setdefault(record.get("recording") or "(none)", {"wall_seconds": 0.0, "stages": {}, "counters": {}})
+
+        if record["type"] == "span":
+            if record.get("parent") is None:
+                recording["wall_seconds"] += record["seconds"]
+
+            for totals in (recording["stages"].setdefault(record["stage"], {"seconds": 0.0, "calls": 0, "errors": 0}),
+                           stages.setdefault(record["stage"], {"seconds": 0.0, "calls": 0, "errors": 0, "max_seconds": 0.0})):
+                totals["seconds"] += record["seconds"]
+                totals["calls"] += 1
+                totals["errors"] += 1 if record.get("error") is not None else 0
+            stages[record["stage"]]["max_seconds"] = max(stages[record["stage"]]["max_seconds"], record["seconds"])
+        elif record["type"] == "count":
+            recording["counters"][record["name"]] = recording["counters"].get(record["name"], 0) + record["value"]
+            counters[record["name"]] = counters.get(record["name"], 0) + record["value"]
+
+    for recording in recordings.values():
+        for totals in recording["stages"].values():
+            totals["share"] = totals["seconds"] / recording["wall_seconds"] if recording["wall_seconds"] > 0 else 0.0
+
+    for totals in stages.values():
+        totals["mean_seconds"] = totals["seconds"] / totals["calls"]
+
+    return {
+        "wall_seconds": sum(recording["wall_seconds"] for recording in recordings.values()),
+        "stages": stages,
+        "counters": counters,
+        # the slowest recordings first
+        "recordings": dict(sorted(recordings.items(), key=lambda item: -item[1]["wall_seconds"]))
+    }
@@ -0,0 +1,114 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pydantic import BaseModel
+
+class LLMCache:
+    """
+    On-disk cache of parsed model answers, keyed by a hash of everything that can change the answer:
+    model, instructions, reasoning settings, response schema and input content
+    """
+    def __init__(self, path: str = "llm_cache.sqlite3", max_entries: int | None = None, max_age_seconds: float | None = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    @staticmethod
+    def key_for_request(request: dict) -> str:
+        """
+        Hashes the arguments given to responses.parse
+
+        :param request: Keyword arguments of responses.parse
+        :type request: dict
+        :return: Hex digest identifying the request
+        :rtype: str
+        """
+        text_format = request.get("text_format")
+        identity = {
+            "model": request.get("model"),
+            "instructions": request.get("instructions"),
+            "reasoning": request.get("reasoning"),
+            "schema": text_format.model_json_schema() if text_format is not None else None,
+            "input": request.get("input")
+        }
+
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, response_format: "type[BaseModel]") -> "BaseModel | None":
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None or (self.max_age_seconds is not None and now - row[1] > self.max_age_seconds):
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+
+        return response_format.model_validate_json(row[0])
+
+    def put(self, key: str, value: "BaseModel"):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value.model_dump_json(), now, now)
+            )
+            self._connection.commit()
+
+        if self.max_entries is not None or self.max_age_seconds is not None:
+            self.evict(self.max_entries, self.max_age_seconds)
+
+    def evict(self, max_entries: int | None = None, max_age_seconds: float | None = None) -> int:
+        """
+        Removes entries older than max_age_seconds, then the least recently used ones beyond max_entries
+
+        :return: Amount of entries removed
+        :rtype: int
+        """
+        removed = 0
+        with self._lock:
+            if max_age_seconds is not None:
+                removed += self._connection.execute(
+                    "DELETE FROM entries WHERE created_at < ?", (time.time() - max_age_seconds,)
+                ).rowcount
+
+            if max_entries is not None:
+                removed += self._connection.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,)
+                ).rowcount
+
+            self._connection.commit()
+
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import re
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# name of the temporary files and directories, e.g. 1.tmp-0123abcd.wav
+TEMPORARY_NAME = re.compile(r"\.tmp-[0-9a-f]{8}(\.[^.]*)?$")
+
+class Manifest:
+    """
+    Records, for each input of each stage, the content hash of the input, the parameters and the outputs,
+    so that a run only redoes the work whose inputs or parameters changed or whose outputs went missing
+    """
+    def __init__(self, path: str = "manifest.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                stage TEXT NOT NULL,
+                input_path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                outputs TEXT NOT NULL,
+                completed_at REAL NOT NULL,
+                PRIMARY KEY (stage, input_path)
+            );
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            );
+        """)
+        self._connection.commit()
+
+    def content_hash(self, *paths: str) -> str:
+        """
+        Hashes the content of the input files together, files whose size and modification time didn't change
+        since they were last hashed aren't read again
+        """
+        combined = hashlib.sha256()
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+
+            with self._lock:
+                row = self._connection.execute("SELECT size, mtime_ns, content_hash FROM hashes WHERE path = ?", (path,)).fetchone()
+
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                file_hash = row[2]
+            else:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                file_hash = digest.hexdigest()
+
+                with self._lock:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                        (path, stat.st_size, stat.st_mtime_ns, file_hash)
+                    )
+                    self._connection.commit()
+
+            combined.update(file_hash.encode("utf-8"))
+
+        return combined.hexdigest()
+
+    def is_fresh(self, stage: str, inputs: list[str], params: dict) -> bool:
+        """
+        Tells whether a stage already processed these inputs with these parameters and all of its outputs still exist
+
+        :param stage: Name of the stage
+        :type stage: str
+        :param inputs: Input files, the first one identifies the record
+        :type inputs: list[str]
+        :param params: Parameters the outputs depend on
+        :type params: dict
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_hash, params, outputs FROM records WHERE stage = ? AND input_path = ?",
+                (stage, os.path.abspath(inputs[0]))
+            ).fetchone()
+
+        if row is None or row[1] != json.dumps(params, sort_keys=True):
+            return False
+
+        if not all(os.path.exists(output) for output in json.loads(row[2])):
+            return False
+
+        if not all(os.path.exists(path) for path in inputs):
+            return False
+
+        return row[0] == self.content_hash(*inputs)
+
+    def record(self, stage: str, inputs: list[str], params: dict, outputs: list[str]):
+        content_hash = self.content_hash(*inputs)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO records (stage, input_path, content_hash, params, outputs, completed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (stage, os.path.abspath(inputs[0]), content_hash, json.dumps(params, sort_keys=True), json.dumps([os.path.abspath(output) for output in outputs]), time.time())
+            )
+            self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+def _temporary_path(path: str) -> str:
+    # next to the final path so that the rename stays on the same file system
+    return "{}.tmp-{}".format(path, uuid.uuid4().hex[:8])
+
+def is_temporary_path(path: str) -> bool:
+    """
+    Tells whether a path was left behind by an atomic_file or atomic_directory that never completed, e.g. after a hard kill
+    """
+    return TEMPORARY_NAME.search(os.path.basename(path)) is not None
+
+def list_input_files(directory: str) -> list[str]:
+    """
+    Names of the files of a directory in order, leaving out the temporary files of interrupted runs
+    """
+    return sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)) and not is_temporary_path(f))
+
+def _replace(temporary_path: str, path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(temporary_path, path)
+
+@contextmanager
+def atomic_directory(path: str):
+    """
+    Yields a temporary directory which replaces path once the block succeeds, a failure leaves path untouched
+    """
+    temporary_path = _temporary_path(path)
+    os.mkdir(temporary_path)
+    try:
+        yield temporary_path
+    except BaseException:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        raise
+
+    _replace(temporary_path, path)
+
+@contextmanager
+def atomic_file(path: str):
+    """
+    Yields a temporary file path which replaces path once the block succeeds, keeping the extension
+    so that tools picking the format from it still work
+    """
+    root, extension = os.path.splitext(path)
+    temporary_path = _temporary_path(root) + extension
+    try:
+        yield temporary_path
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, path)
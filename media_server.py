@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import bisect
+import threading
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+from audio import PcmReader, open_pcm_reader, SPEECH_FRAME_RATE
+from instrumentation import percentile
+from transcript import TurnStore
+
+if TYPE_CHECKING:
+    from azure.cognitiveservices.speech import SpeechConfig
+    from detector import LLMDetector
+
+MEDIA_PORT = 8080
+# Azure Communication Services sends 20ms of 16kHz mono 16 bit audio per message
+FRAME_MS = 20
+
+class FrameQueueReader(PcmReader):
+    """
+    Reader over audio that is still arriving, read blocks until enough frames came in or the call ended
+    """
+    def __init__(self, frame_rate: int = SPEECH_FRAME_RATE, channels: int = 1, sample_width: int = 2):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_width = channels * sample_width
+        self.received_frames = 0
+        self._buffer = bytearray()
+        self._finished = False
+        self._condition = threading.Condition()
+
+    def feed(self, data: bytes):
+        with self._condition:
+            self._buffer += data
+            self.received_frames += len(data) // self.frame_width
+            self._condition.notify()
+
+    def finish(self):
+        with self._condition:
+            self._finished = True
+            self._condition.notify()
+
+    def read(self, frames: int) -> bytes:
+        size = frames * self.frame_width
+        with self._condition:
+            while len(self._buffer) < size and not self._finished:
+                self._condition.wait()
+
+            # the tail of a call may not fill a whole frame
+            size = min(size, len(self._buffer) - len(self._buffer) % self.frame_width)
+            chunk = bytes(self._buffer[:size])
+            del self._buffer[:size]
+
+        return chunk
+
+class TranscriptReplaySession:
+    """
+    Stands in for TranscriptionSession when replaying recordings that were already transcribed: every turn of the
+    known transcript is handed to the listeners as soon as the audio it ends with was received, so that the
+    pipeline can be tested and benchmarked without the speech service
+    """
+    def __init__(self, recording: PcmReader, conversation: TurnStore, turn_listeners: list | None = None):
+        self.recording = recording
+        self.known_conversation = conversation
+        self.conversation = TurnStore()
+        self.turn_listeners = turn_listeners or []
+
+    def _emit(self, index: int):
+        offset, turn = self.known_conversation.offsets[index], self.known_conversation.turn(index)
+        self.conversation.append(offset, turn["speaker"], turn["text"], turn["duration"])
+        for turn_listener in self.turn_listeners:
+            turn_listener(offset, turn)
+
+    def run(self, chunk_ms: int = FRAME_MS) -> TurnStore:
+        chunk_frames = int(self.recording.frame_rate * chunk_ms / 1000)
+        received_frames = 0
+        emitted = 0
+
+        for chunk in self.recording.chunks(chunk_frames):
+            received_frames += len(chunk) // self.recording.frame_width
+            position = received_frames * 1000 // self.recording.frame_rate
+
+            while emitted < len(self.known_conversation) and position >= self.known_conversation.offsets[emitted] + self.known_conversation.durations[emitted]:
+                self._emit(emitted)
+                emitted += 1
+
+        # turns running past the end of the audio
+        for index in range(emitted, len(self.known_conversation)):
+            self._emit(index)
+
+        return self.conversation
+
+class CallSession:
+    """
+    Transcribes and judges a single call while its audio comes in, and measures how long after the audio
+    was received each turn got transcribed and each verdict was given
+    """
+    def __init__(
+        self,
+        call_id: str,
+        detector: "LLMDetector",
+        reader: FrameQueueReader,
+        speech_config: "SpeechConfig | None" = None,
+        replayed_conversation: TurnStore | None = None,
+        debounce_seconds: float = 2.0,
+        max_delay_seconds: float = 10.0,
+        use_principles: bool = False
+    ):
+        from detector import StreamingDetector
+
+        self.call_id = call_id
+        self.reader = reader
+        self.streaming_detector = StreamingDetector(detector, debounce_seconds, max_delay_seconds, use_principles=use_principles, on_verdict=self._on_verdict)
+        turn_listeners = [self._on_turn, self.streaming_detector.on_turn]
+
+        if speech_config is not None:
+            from augmentation import TranscriptionSession
+
+            self.session = TranscriptionSession(speech_config, call_id, reader, turn_listeners)
+        elif replayed_conversation is not None:
+            self.session = TranscriptReplaySession(reader, replayed_conversation, turn_listeners)
+        else:
+            raise Exception("Call {} has neither a speech service nor a replayed transcript to transcribe it".format(call_id))
+
+        # arrival time of every message, along with the milliseconds of audio received once it arrived
+        self._arrival_positions: list[int] = []
+        self._arrival_times: list[float] = []
+        self.transcription_latencies: list[float] = []
+        self.verdict_latencies: list[float] = []
+        self.verdicts: list[dict] = []
+        self.error: Exception | None = None
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.streaming_detector.start()
+        self._thread = threading.Thread(target=self._transcribe, daemon=True)
+        self._thread.start()
+
+    def _transcribe(self):
+        try:
+            self.session.run()
+        except Exception as e:
+            print("Transcription of call {} failed: {}".format(self.call_id, e))
+            self.error = e
+
+    def feed(self, data: bytes):
+        self.reader.feed(data)
+        self._arrival_positions.append(self.reader.received_frames * 1000 // self.reader.frame_rate)
+        self._arrival_times.append(time.monotonic())
+
+    def _arrival_time(self, position: int) -> float:
+        # first message the audio at position was part of
+        index = bisect.bisect_left(self._arrival_positions, position)
+
+        return self._arrival_times[min(index, len(self._arrival_times) - 1)]
+
+    def _on_turn(self, offset: int, turn: dict):
+        if len(self._arrival_times) > 0:
+            self.transcription_latencies.append(time.monotonic() - self._arrival_time(offset + turn["duration"]))
+
+    def _on_verdict(self, elapsed: float, verdict):
+        latency = time.monotonic() - self._arrival_time(self.streaming_detector.evaluated_until) if len(self._arrival_times) > 0 else None
+        if latency is not None:
+            self.verdict_latencies.append(latency)
+
+        self.verdicts.append({"elapsed": elapsed, "answer": verdict.answer, "latency": latency})
+        print("Call {}: {} after {:.1f}s of call, {:.2f}s after the audio".format(self.call_id, verdict.answer, elapsed, latency or 0.0))
+
+    def finish(self) -> dict:
+        """
+        Waits for the transcription of the audio received so far and for the last verdict
+
+        :return: Verdicts and latencies of the call
+        :rtype: dict
+        """
+        self.reader.finish()
+        if self._thread is not None:
+            self._thread.join()
+        self.streaming_detector.stop()
+
+        return {
+            "call": self.call_id,
+            "audio_seconds": self.reader.received_frames / self.reader.frame_rate,
+            "turns": len(self.session.conversation),
+            "verdicts": self.verdicts,
+            "final_answer": self.verdicts[-1]["answer"] if len(self.verdicts) > 0 else None,
+            "time_to_first_fraud": self.streaming_detector.time_to_first_fraud,
+            "transcription_latency_p50": percentile(self.transcription_latencies, 50),
+            "transcription_latency_p95": percentile(self.transcription_latencies, 95),
+            "verdict_latency_p50": percentile(self.verdict_latencies, 50),
+            "verdict_latency_p95": percentile(self.verdict_latencies, 95),
+            "verdict_latency_max": max(self.verdict_latencies, default=0.0),
+            "error": str(self.error) if self.error is not None else None
+        }
+
+class MediaStreamingServer:
+    """
+    WebSocket server receiving the audio of calls as Azure Communication Services media streaming messages,
+    a JSON AudioMetadata message followed by base64 PCM in AudioData messages. Raw binary messages of 16kHz mono
+    16 bit PCM are accepted as well. Each connection is a call, transcribed and judged while it goes on.
+    """
+    def __init__(
+        self,
+        detector: "LLMDetector",
+        speech_config: "SpeechConfig | None" = None,
+        host: str = "0.0.0.0",
+        port: int = MEDIA_PORT,
+        debounce_seconds: float = 2.0,
+        max_delay_seconds: float = 10.0,
+        use_principles: bool = False
+    ):
+        """
+        :param detector: Detector judging the calls
+        :type detector: LLMDetector
+        :param speech_config: Speech service transcribing the calls, None only accepts replayed calls carrying their transcript
+        :type speech_config: SpeechConfig | None
+        :param port: Port the dev tunnel forwards, 0 picks a free one
+        :type port: int
+        """
+        self.detector = detector
+        self.speech_config = speech_config
+        self.host = host
+        self.port = port
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.use_principles = use_principles
+        self.reports: list[dict] = []
+        self._server = None
+
+    def _start_call(self, metadata: dict) -> CallSession:
+        if metadata.get("encoding", "PCM") != "PCM":
+            raise Exception("Unsupported encoding {}".format(metadata["encoding"]))
+
+        call_id = metadata.get("subscriptionId") or "call-{}".format(len(self.reports) + 1)
+        replayed_conversation = TurnStore.from_dict(metadata["replayTranscript"]) if "replayTranscript" in metadata else None
+        reader = FrameQueueReader(int(metadata.get("sampleRate", SPEECH_FRAME_RATE)), int(metadata.get("channels", 1)), 2)
+
+        call = CallSession(
+            call_id, self.detector, reader, self.speech_config, replayed_conversation,
+            self.debounce_seconds, self.max_delay_seconds, self.use_principles
+        )
+        call.start()
+        print("Call {} started".format(call_id))
+
+        return call
+
+    async def _handle(self, websocket):
+        call = None
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    if call is None:
+                        call = self._start_call({})
+                    call.feed(message)
+                    continue
+
+                packet = json.loads(message)
+                if packet.get("kind") == "AudioMetadata" and call is None:
+                    call = self._start_call(packet["audioMetadata"])
+                elif packet.get("kind") == "AudioData":
+                    if call is None:
+                        call = self._start_call({})
+                    # silent packets are fed as well so that offsets keep matching the call
+                    call.feed(base64.b64decode(packet["audioData"]["data"]))
+        finally:
+            if call is not None:
+                # the transcription and the last evaluation block, the other calls carry on meanwhile
+                report = await asyncio.to_thread(call.finish)
+                self.reports.append(report)
+                print("Call {} ended: {} after {:.1f}s of audio, verdict latency p50 {:.2f}s p95 {:.2f}s".format(
+                    report["call"], report["final_answer"], report["audio_seconds"], report["verdict_latency_p50"], report["verdict_latency_p95"]
+                ))
+
+    async def start(self) -> str:
+        """
+        Starts listening, returns the url of the server
+        """
+        from websockets.asyncio.server import serve
+
+        self._server = await serve(self._handle, self.host, self.port, max_size=None)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print("Media streaming server listening on port {}".format(self.port))
+
+        return "ws://{}:{}".format("localhost" if self.host == "0.0.0.0" else self.host, self.port)
+
+    async def stop(self):
+        """
+        Stops listening and waits for the calls in progress to be judged
+        """
+        if self._server is not None:
+            self._server.close(close_connections=False)
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        await self._server.serve_forever()  # type: ignore
+
+def replay_transcript_path(path: str) -> str:
+    # the transcript written by the split of a recording, in the directory named after it
+    return os.path.join(os.path.splitext(path)[0], "transcripts.json")
+
+async def replay_recording(url: str, path: str, speed: float | None = 1.0, with_transcript: bool = True) -> float:
+    """
+    Fake media source sending a recording as media streaming messages, as a call would
+
+    :param url: Url of the media streaming server
+    :type url: str
+    :param path: Recording of any format
+    :type path: str
+    :param speed: How many times faster than real time the frames are sent, None sends them as fast as possible
+    :type speed: float | None
+    :param with_transcript: Send the transcript of the recording along, for servers without a speech service
+    :type with_transcript: bool
+    :return: Seconds taken to send the recording
+    :rtype: float
+    """
+    from websockets.asyncio.client import connect
+
+    frame_bytes = SPEECH_FRAME_RATE * FRAME_MS // 1000 * 2
+    metadata = {
+        "subscriptionId": os.path.basename(os.path.splitext(path)[0]),
+        "encoding": "PCM",
+        "sampleRate": SPEECH_FRAME_RATE,
+        "channels": 1,
+        "length": frame_bytes
+    }
+    if with_transcript:
+        metadata["replayTranscript"] = TurnStore.from_json(replay_transcript_path(path)).to_dict()
+
+    async with connect(url, max_size=None) as websocket:
+        await websocket.send(json.dumps({"kind": "AudioMetadata", "audioMetadata": metadata}))
+
+        start = time.monotonic()
+        sent_ms = 0
+        with open_pcm_reader(path, SPEECH_FRAME_RATE, 1, 2) as reader:
+            for frame in reader.chunks(frame_bytes // 2):
+                await websocket.send(json.dumps({
+                    "kind": "AudioData",
+                    "audioData": {
+                        "timestamp": datetime.now(timezone.utc).isoformat(),
+                        "participantRawID": "replay",
+                        "data": base64.b64encode(frame).decode("ascii"),
+                        "silent": False
+                    }
+                }))
+                sent_ms += FRAME_MS
+
+                if speed is not None:
+                    delay = start + sent_ms / 1000 / speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+    return time.monotonic() - start
+
+async def benchmark_media_server(
+    detector: "LLMDetector",
+    files: list[str],
+    speed: float | None = 1.0,
+    concurrency: int = 4,
+    debounce_seconds: float = 2.0,
+    max_delay_seconds: float = 10.0
+) -> dict:
+    """
+    Replays already transcribed recordings as concurrent calls through a local server and measures the
+    latency between receiving the audio and giving a verdict on it
+
+    :param files: Recordings whose split transcripts exist
+    :type files: list[str]
+    :param concurrency: Calls going on at once
+    :type concurrency: int
+    """
+    server = MediaStreamingServer(detector, host="localhost", port=0, debounce_seconds=debounce_seconds, max_delay_seconds=max_delay_seconds)
+    url = await server.start()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def replay(path: str):
+        async with semaphore:
+            await replay_recording(url, path, speed)
+
+    start = time.monotonic()
+    await asyncio.gather(*(replay(path) for path in files))
+    await server.stop()
+    wall_time = time.monotonic() - start
+
+    verdict_latencies = [verdict["latency"] for report in server.reports for verdict in report["verdicts"] if verdict["latency"] is not None]
+
+    return {
+        "call_count": len(server.reports),
+        "speed": speed,
+        "concurrency": concurrency,
+        "wall_seconds": wall_time,
+        "audio_seconds": sum(report["audio_seconds"] for report in server.reports),
+        "verdicts": len(verdict_latencies),
+        "verdict_latency_p50": percentile(verdict_latencies, 50),
+        "verdict_latency_p95": percentile(verdict_latencies, 95),
+        "verdict_latency_p99": percentile(verdict_latencies, 99),
+        "verdict_latency_max": max(verdict_latencies, default=0.0),
+        "reports": server.reports
+    }
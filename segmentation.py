@@ -0,0 +1,189 @@
+import numpy as np
+from pydantic import BaseModel
+from audio import PcmAudio
+
+class AugmentationSettings(BaseModel):
+    """
+    Ranges the perturbations of every augmented segment are drawn from, uniformly and independently per segment
+    """
+    gain_db: tuple[float, float] = (-6.0, 6.0)
+    # signal to noise ratio of the added white noise, None adds no noise
+    noise_snr_db: tuple[float, float] | None = (20.0, 40.0)
+    max_shift_ms: int = 500
+    # playback rate, 1.1 is 10% faster and shorter in pitch period
+    speed: tuple[float, float] = (0.9, 1.1)
+
+def samples_from_pcm(recording: PcmAudio) -> np.ndarray:
+    """
+    Converts interleaved PCM into float samples between -1 and 1, one column per channel
+
+    :return: Samples of shape (frames, channels)
+    :rtype: np.ndarray
+    """
+    data = np.frombuffer(recording.data, dtype=np.uint8)
+    data = data[:len(data) - len(data) % recording.frame_width]
+
+    if recording.sample_width == 1:
+        # 8 bit wav samples are unsigned
+        samples = data.astype(np.float32) - 128
+    elif recording.sample_width == 3:
+        frames = data.reshape(-1, 3).astype(np.int32)
+        samples = (frames[:, 0] | (frames[:, 1] << 8) | (frames[:, 2] << 16)).astype(np.float32)
+        samples[samples >= 2 ** 23] -= 2 ** 24
+    else:
+        samples = data.view("<i{}".format(recording.sample_width)).astype(np.float32)
+
+    return samples.reshape(-1, recording.channels) / float(2 ** (8 * recording.sample_width - 1))
+
+def pcm_from_samples(samples: np.ndarray, sample_width: int = 2) -> bytes:
+    """
+    Converts float samples of shape (frames, channels) back into interleaved little-endian PCM, clipping them
+    """
+    scale = 2 ** (8 * sample_width - 1)
+    integers = np.clip(np.round(samples.astype(np.float64) * scale), -scale, scale - 1)
+
+    if sample_width == 1:
+        return (integers + 128).astype(np.uint8).tobytes()
+
+    if sample_width == 3:
+        integers = integers.astype("<i4").reshape(-1, 1).view(np.uint8)
+        return integers[:, :3].tobytes()
+
+    return integers.astype("<i{}".format(sample_width)).tobytes()
+
+def count_windows(frame_count: int, window_frames: int, stride_frames: int) -> int:
+    # a recording shorter than a window still gives one, shorter, segment
+    if frame_count <= window_frames:
+        return 1
+
+    return 1 + (frame_count - window_frames) // stride_frames
+
+def window_starts(frame_count: int, window_frames: int, stride_frames: int, count: int) -> np.ndarray:
+    """
+    Picks the start frame of count segments, spread evenly over the available windows.
+    Beyond the amount of distinct windows, windows are drawn again and only their augmentation differs.
+
+    :rtype: np.ndarray
+    """
+    available = count_windows(frame_count, window_frames, stride_frames)
+    distinct = np.unique(np.linspace(0, available - 1, min(count, available)).round().astype(np.int64))
+
+    return np.resize(distinct, count) * stride_frames
+
+def plan_segments(window_counts: dict[str, int], target: int | None, allow_repeats: bool = True) -> dict[str, int]:
+    """
+    Decides how many segments to draw out of every recording so that the class reaches target segments.
+    Every recording gives at least one, then the recordings with the most windows left give one more each, in turn.
+
+    :param window_counts: Amount of distinct windows of every recording
+    :type window_counts: dict[str, int]
+    :param target: Amount of segments wanted for the class, None takes every window of every recording
+    :type target: int | None
+    :param allow_repeats: Draw windows again once every distinct one is used, augmentation telling them apart
+    :type allow_repeats: bool
+    :return: Amount of segments of every recording
+    :rtype: dict[str, int]
+    """
+    if target is None:
+        return dict(window_counts)
+
+    files = sorted(window_counts)
+    plan = {file: 1 for file in files}
+    remaining = target - len(files)
+
+    # water-filling: the next segment always comes from the recording with the most unused windows
+    left = np.array([window_counts[file] - 1 for file in files], dtype=np.int64)
+    while remaining > 0 and left.max(initial=0) > 0:
+        level = left.max()
+        candidates = np.flatnonzero(left == level)[:remaining]
+        for index in candidates:
+            plan[files[index]] += 1
+            left[index] -= 1
+        remaining -= len(candidates)
+
+    if allow_repeats and len(files) > 0:
+        for index in range(remaining):
+            plan[files[index % len(files)]] += 1
+
+    return plan
+
+def source_range(start: int, window_frames: int, frame_rate: int, settings: AugmentationSettings) -> tuple[int, int]:
+    """
+    Frames of the recording a perturbed segment may read from, whatever shift and speed it draws
+
+    :return: First frame and frame after the last one
+    :rtype: tuple[int, int]
+    """
+    max_shift = int(settings.max_shift_ms * frame_rate / 1000)
+    max_speed = max(settings.speed)
+
+    # one more frame for the interpolation and one for rounding
+    return max(0, int(np.floor(start - max_shift * max_speed))), int(np.ceil(start + (window_frames - 1 + max_shift) * max_speed)) + 2
+
+def augment_segments(
+    samples: np.ndarray,
+    starts: np.ndarray,
+    window_frames: int,
+    frame_rate: int,
+    settings: AugmentationSettings,
+    rng: np.random.Generator,
+    augmented: np.ndarray | None = None,
+    offset: int = 0,
+    frame_count: int | None = None
+) -> np.ndarray:
+    """
+    Cuts and perturbs a batch of segments of a recording in one vectorised pass: time shift and speed are
+    a single interpolated gather from the recording, then gain and noise are broadcast over the batch
+
+    :param samples: Float samples of the recording or of an excerpt of it, of shape (frames, channels)
+    :type samples: np.ndarray
+    :param starts: Start frame of every segment
+    :type starts: np.ndarray
+    :param window_frames: Length of the segments in frames
+    :type window_frames: int
+    :param frame_rate: Frame rate of the recording
+    :type frame_rate: int
+    :param settings: Ranges of the perturbations
+    :type settings: AugmentationSettings
+    :param rng: Source of the random perturbations
+    :type rng: np.random.Generator
+    :param augmented: Which segments to perturb, the other ones are cut as they are. All of them if None
+    :type augmented: np.ndarray | None
+    :param offset: Frame of the recording samples starts at, when only an excerpt covering the segments is given
+    :type offset: int
+    :param frame_count: Length of the recording, the end of samples if None
+    :type frame_count: int | None
+    :return: Segments of shape (len(starts), frames, channels), the last ones zero padded when the recording is shorter
+    :rtype: np.ndarray
+    """
+    count = len(starts)
+    if frame_count is None:
+        frame_count = offset + len(samples)
+    window_frames = min(window_frames, frame_count)
+    if augmented is None:
+        augmented = np.ones(count, dtype=bool)
+
+    gain = np.where(augmented, 10 ** (rng.uniform(*settings.gain_db, size=count) / 20), 1.0)
+    max_shift = int(settings.max_shift_ms * frame_rate / 1000)
+    shift = np.where(augmented, rng.integers(-max_shift, max_shift + 1, size=count), 0)
+    speed = np.where(augmented, rng.uniform(*settings.speed, size=count), 1.0)
+
+    # position in the recording each output frame reads from, the segment is delayed by shift then played at speed
+    positions = starts[:, None] + (np.arange(window_frames)[None, :] - shift[:, None]) * speed[:, None]
+    valid = (positions >= 0) & (positions <= frame_count - 1)
+    positions = np.clip(positions - offset, 0, len(samples) - 1)
+
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, len(samples) - 1)
+    fraction = (positions - lower).astype(np.float32)[:, :, None]
+
+    segments = samples[lower] * (1 - fraction) + samples[upper] * fraction
+    segments *= (valid[:, :, None] * gain[:, None, None]).astype(np.float32)
+
+    if settings.noise_snr_db is not None:
+        snr = rng.uniform(*settings.noise_snr_db, size=count)
+        rms = np.sqrt(np.mean(np.square(segments, dtype=np.float64), axis=(1, 2)))
+        noise_level = np.where(augmented, rms / 10 ** (snr / 20), 0.0).astype(np.float32)
+        segments += rng.standard_normal(segments.shape, dtype=np.float32) * noise_level[:, None, None]
+
+    return np.clip(segments, -1.0, 1.0, out=segments)
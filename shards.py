@@ -0,0 +1,191 @@
+import os
+import numpy as np
+from audio import WavReader
+from manifest import atomic_directory
+from transcript import LABELLED_DIRECTORIES, load_dataset
+
+INDEX_FILE = "index.npy"
+TEXTS_FILE = "texts.bin"
+SHARD_FILE = "shard-{:05d}.npy"
+
+# one row per turn, the samples of a turn are shard[start:start + frames * channels]
+# and its text is texts[text_start:text_start + text_length], decoded as utf-8
+INDEX_DTYPE = np.dtype([
+    ("recording", "U64"),
+    ("label", "U8"),
+    ("turn", "<i4"),
+    ("speaker", "U16"),
+    ("offset_ms", "<i8"),
+    ("duration_ms", "<i8"),
+    ("shard", "<i4"),
+    ("start", "<i8"),
+    ("frames", "<i8"),
+    ("channels", "<i2"),
+    ("frame_rate", "<i4"),
+    ("text_start", "<i8"),
+    ("text_length", "<i8")
+])
+
+def _to_int16(data: bytes, sample_width: int) -> np.ndarray:
+    # every shard holds 16 bit samples, wider ones keep their most significant bytes
+    samples = np.frombuffer(data, dtype=np.uint8)
+    if sample_width == 1:
+        return ((samples.astype(np.int16) - 128) << 8).astype("<i2")
+
+    return np.ascontiguousarray(samples.reshape(-1, sample_width)[:, sample_width - 2:]).view("<i2").ravel()
+
+class _ShardWriter:
+    def __init__(self, dest: str, shard_bytes: int):
+        self.dest = dest
+        self.shard_bytes = shard_bytes
+        self.shard = 0
+        self.position = 0
+        self._pending = []
+
+    def append(self, samples: np.ndarray) -> tuple[int, int]:
+        """
+        Adds the samples of a turn to the current shard, a turn never spans two shards
+
+        :return: Shard and position of the first sample
+        :rtype: tuple[int, int]
+        """
+        if self.position > 0 and (self.position + len(samples)) * 2 > self.shard_bytes:
+            self.flush()
+
+        location = (self.shard, self.position)
+        self._pending.append(samples)
+        self.position += len(samples)
+
+        return location
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+
+        np.save(os.path.join(self.dest, SHARD_FILE.format(self.shard)), np.concatenate(self._pending))
+        self.shard += 1
+        self.position = 0
+        self._pending = []
+
+def export_shards(dest: str, directories: dict[str, str] = LABELLED_DIRECTORIES, shard_bytes: int = 128 * 1024 * 1024) -> int:
+    """
+    Packs the turn wav files of every labelled recording into a few large shards of 16 bit PCM
+    along with a columnar index of the turns, so that training jobs open a handful of files instead of thousands
+
+    :param dest: Directory of the dataset, replaced once the export is complete
+    :type dest: str
+    :param directories: Directory of the recordings of each label
+    :type directories: dict[str, str]
+    :param shard_bytes: Size a shard grows to before a new one is started
+    :type shard_bytes: int
+    :return: Amount of turns exported
+    :rtype: int
+    """
+    rows = []
+    texts = bytearray()
+
+    with atomic_directory(os.path.abspath(dest)) as temporary_directory:
+        writer = _ShardWriter(temporary_directory, shard_bytes)
+
+        for transcript_file, label, conversation in load_dataset(directories):
+            recording_directory = os.path.dirname(transcript_file)
+            recording = os.path.basename(recording_directory)
+
+            for turn_number, (offset, turn) in enumerate(conversation.items(), start=1):
+                turn_file = os.path.join(recording_directory, "{}.wav".format(turn_number))
+                if not os.path.isfile(turn_file):
+                    print("Skipping missing turn {}".format(turn_file))
+                    continue
+
+                with WavReader(turn_file) as reader:
+                    samples = np.concatenate([_to_int16(chunk, reader.sample_width) for chunk in reader.chunks()] or [np.empty(0, dtype="<i2")])
+                    channels, frame_rate = reader.channels, reader.frame_rate
+
+                shard, start = writer.append(samples)
+                text = turn["text"].encode("utf-8")
+                rows.append((
+                    recording, label, turn_number, turn["speaker"], offset, turn["duration"],
+                    shard, start, len(samples) // channels, channels, frame_rate, len(texts), len(text)
+                ))
+                texts += text
+
+            print("Exported {} turns of {}".format(len(conversation), recording))
+
+        writer.flush()
+        np.save(os.path.join(temporary_directory, INDEX_FILE), np.array(rows, dtype=INDEX_DTYPE))
+        with open(os.path.join(temporary_directory, TEXTS_FILE), "wb") as texts_file:
+            texts_file.write(texts)
+
+    return len(rows)
+
+class ShardedDataset:
+    """
+    Memory-mapped view over an exported dataset, the samples of any turn are read without copying
+    and only the pages of the turns accessed are ever loaded
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.index = np.load(os.path.join(path, INDEX_FILE), mmap_mode="r")
+        texts_path = os.path.join(path, TEXTS_FILE)
+        self._texts = np.memmap(texts_path, dtype=np.uint8, mode="r") if os.path.getsize(texts_path) > 0 else np.empty(0, dtype=np.uint8)
+        self._shards = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _shard(self, shard: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.path, SHARD_FILE.format(shard)), mmap_mode="r")
+
+        return self._shards[shard]
+
+    def samples(self, turn: int) -> np.ndarray:
+        """
+        Returns a read-only view over the 16 bit samples of a turn, of shape (frames, channels)
+        """
+        row = self.index[turn]
+        start, length = int(row["start"]), int(row["frames"]) * int(row["channels"])
+
+        return self._shard(int(row["shard"]))[start:start + length].reshape(-1, int(row["channels"]))
+
+    def text(self, turn: int) -> str:
+        row = self.index[turn]
+        start = int(row["text_start"])
+
+        return bytes(self._texts[start:start + int(row["text_length"])]).decode("utf-8")
+
+    def __getitem__(self, turn: int) -> dict:
+        row = self.index[turn]
+
+        return {
+            "recording": str(row["recording"]),
+            "label": str(row["label"]),
+            "turn": int(row["turn"]),
+            "speaker": str(row["speaker"]),
+            "offset": int(row["offset_ms"]),
+            "duration": int(row["duration_ms"]),
+            "frame_rate": int(row["frame_rate"]),
+            "text": self.text(turn),
+            "samples": self.samples(turn)
+        }
+
+    def select(self, label: str | None = None, speaker: str | None = None, recording: str | None = None) -> np.ndarray:
+        """
+        Returns the position of the turns matching every given column
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        for column, value in (("label", label), ("speaker", speaker), ("recording", recording)):
+            if value is not None:
+                mask &= self.index[column] == value
+
+        return np.flatnonzero(mask)
+
+    def summary(self) -> dict:
+        return {
+            "turns": len(self.index),
+            # recordings of different labels may share a name
+            "recordings": len(set(zip(self.index["label"].tolist(), self.index["recording"].tolist()))),
+            "shards": int(self.index["shard"].max()) + 1 if len(self.index) > 0 else 0,
+            "labels": {str(label): int(count) for label, count in zip(*np.unique(self.index["label"], return_counts=True))},
+            "hours": float((self.index["frames"] / self.index["frame_rate"]).sum() / 3600) if len(self.index) > 0 else 0.0
+        }
@@ -0,0 +1,201 @@
+import json
+import time
+import random
+import argparse
+import threading
+from uuid import uuid4
+from urllib.parse import urlparse
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class StubModelHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Responses API with random but schema-valid structured outputs,
+    standing in for the model endpoint when testing and benchmarking the pipeline.
+    Also answers the identity and call creation routes of Communication Services, for the call setup load tests.
+    """
+    # keeps connections open between requests, as the real endpoints do, so that clients reusing them benefit from it
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, which Nagle's algorithm would hold back on a kept-alive connection
+    disable_nagle_algorithm = True
+    latency = 0.0
+    rate_limit = 0.0
+    rng = random.Random(0)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict | None = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _access_token(self, request: dict) -> dict:
+        expires_on = datetime.now(timezone.utc) + timedelta(minutes=request.get("expiresInMinutes") or 24 * 60)
+        return {"token": "stub-{}".format(uuid4().hex), "expiresOn": expires_on.isoformat().replace("+00:00", "Z")}
+
+    def _identity(self, path: str, request: dict):
+        time.sleep(self.latency)
+
+        if path.endswith(":issueAccessToken"):
+            self._send_json(200, self._access_token(request))
+            return
+
+        body = {"identity": {"id": "8:acs:stub_{}".format(uuid4())}}
+        if request.get("createTokenWithScopes"):
+            body["accessToken"] = self._access_token(request)
+        self._send_json(201, body)
+
+    def _create_call(self, request: dict):
+        time.sleep(self.latency)
+
+        self._send_json(201, {
+            "callConnectionId": str(uuid4()),
+            "serverCallId": str(uuid4()),
+            "targets": request.get("targets", []),
+            "callConnectionState": "connecting",
+            "callbackUri": request.get("callbackUri"),
+            "source": request.get("source") or {"rawId": "8:acs:stub_source", "communicationUser": {"id": "8:acs:stub_source"}}
+        })
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = urlparse(self.path).path.rstrip("/")
+
+        if "/identities" in path:
+            self._identity(path, request)
+            return
+
+        if path.endswith("/calling/callConnections"):
+            self._create_call(request)
+            return
+
+        if not path.endswith("/responses"):
+            self._send_json(404, {"error": {"message": "Unknown route {}".format(self.path)}})
+            return
+
+        if self.rng.random() < self.rate_limit:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}}, {"retry-after": "0.1"})
+            return
+
+        time.sleep(self.latency)
+
+        text_format = request.get("text", {}).get("format", {})
+        schema = text_format.get("schema", {"type": "string"})
+        output = _generate_instance(schema, schema, self.rng)
+        text = output if isinstance(output, str) else json.dumps(output)
+
+        input_tokens = len(json.dumps(request.get("input", ""))) // 4 + len(request.get("instructions") or "") // 4
+        output_tokens = len(text) // 4
+
+        self._send_json(200, {
+            "id": "resp_{}".format(uuid4().hex),
+            "object": "response",
+            "created_at": time.time(),
+            "model": request.get("model", "stub"),
+            "status": "completed",
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+            "output": [
+                {
+                    "type": "message",
+                    "id": "msg_{}".format(uuid4().hex),
+                    "role": "assistant",
+                    "status": "completed",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}]
+                }
+            ],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens
+            }
+        })
+
+def _generate_instance(schema: dict, root: dict, rng: random.Random, name: str = ""):
+    if "$ref" in schema:
+        # only local references such as #/$defs/TurnOfConversation are produced by pydantic
+        target = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            target = target[part]
+        return _generate_instance(target, root, rng, name)
+
+    if "anyOf" in schema:
+        return _generate_instance(schema["anyOf"][0], root, rng, name)
+
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        return {
+            property_name: _generate_instance(property_schema, root, rng, property_name)
+            for property_name, property_schema in schema.get("properties", {}).items()
+        }
+    elif schema_type == "array":
+        items = [_generate_instance(schema.get("items", {}), root, rng, name) for _ in range(rng.randint(2, 8))]
+        # offsets of a transcript have to go forward to be turned into durations
+        offsets = sorted(rng.sample(range(0, 600), len(items)))
+        for item, offset in zip(items, offsets):
+            if isinstance(item, dict) and "offset" in item:
+                item["offset"] = "[{:02d}:{:02d}]".format(offset // 60, offset % 60)
+        return items
+    elif schema_type == "boolean":
+        return rng.random() < 0.5
+    elif schema_type == "integer":
+        return 0
+    elif schema_type == "number":
+        return 0.0
+    elif schema_type == "null":
+        return None
+
+    return "Stub {} {}".format(name, rng.randint(0, 1000)).strip()
+
+def start_stub_server(port: int = 0, latency: float = 0.0, rate_limit: float = 0.0, seed: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Starts a stub model server on a background thread
+
+    :param port: Port to listen on, 0 picks a free one
+    :type port: int
+    :param latency: Seconds every response is delayed by, to mimic the model's reasoning time
+    :type latency: float
+    :param rate_limit: Share of requests answered with a 429
+    :type rate_limit: float
+    :param seed: Seed of the generated answers
+    :type seed: int
+    :return: The server and the base url to give to the OpenAI client, Communication Services clients take it without /v1
+    :rtype: tuple[ThreadingHTTPServer, str]
+    """
+    handler = type("ConfiguredStubModelHandler", (StubModelHandler,), {
+        "latency": latency,
+        "rate_limit": rate_limit,
+        "rng": random.Random(seed)
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, "http://127.0.0.1:{}/v1".format(server.server_address[1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub of the model endpoint answering with schema-valid structured outputs")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, args.latency, args.rate_limit, args.seed)
+    print("Stub model server listening on {}".format(base_url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
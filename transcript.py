@@ -0,0 +1,373 @@
+import re
+import os
+import json
+import time
+import argparse
+from array import array
+from collections import OrderedDict
+from manifest import is_temporary_path
+
+# same split as the tokenizers of the gpt models: words with their leading space, digits by three, punctuation runs
+_PRETOKENIZER = re.compile(r" ?[A-Za-z]+| ?\d{1,3}| ?[^\sA-Za-z\d]+|\s+")
+_tokenizer = None
+
+def count_tokens(text: str) -> int:
+    """
+    Counts tokens locally, exactly with tiktoken when it is installed, otherwise with an estimate
+    that follows the gpt pre-tokenizer and splits long words into 4 characters pieces
+
+    :param text: Text to count
+    :type text: str
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            import tiktoken
+            _tokenizer = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _tokenizer = False
+
+    if _tokenizer:
+        return len(_tokenizer.encode(text))
+
+    return sum(max(1, (len(piece.strip()) + 3) // 4) for piece in _PRETOKENIZER.findall(text))
+
+def format_offset(offset_in_miliseconds: int) -> str:
+    seconds = int(offset_in_miliseconds) // 1000
+    hours, minutes, seconds = seconds // 3600, seconds // 60 % 60, seconds % 60
+
+    if hours > 0:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{:02d}:{:02d}".format(minutes, seconds)
+
+def parse_offset(offset: str) -> int:
+    """
+    Parses an offset written as "[MM:SS]" or "[H:MM:SS]", brackets optional, seconds possibly with a fraction
+    ("01:02.5", "1:02:03,250"), into milliseconds
+
+    :param offset: Offset as written in a transcript
+    :type offset: str
+    :rtype: int
+    """
+    text = offset.strip().strip("[]").strip().replace(",", ".")
+    whole, _, fraction = text.partition(".")
+    parts = whole.split(":")
+
+    if not 1 <= len(parts) <= 3 or not all(part.isdecimal() for part in parts) or not (fraction == "" or fraction.isdecimal()):
+        raise ValueError("Couldn't parse offset {}".format(offset))
+
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + int(part)
+
+    return seconds * 1000 + (int((fraction + "00")[:3]) if fraction else 0)
+
+class TurnStore:
+    """
+    Turns of a conversation kept column by column: offsets and durations as arrays of integers and speakers
+    as indices into the few speaker names, so that a turn costs a few bytes besides its text.
+    Adding a turn or extending the last one is O(1).
+    """
+    __slots__ = ("offsets", "durations", "speaker_codes", "texts", "speakers")
+
+    def __init__(self):
+        self.offsets = array("q")
+        self.durations = array("q")
+        self.speaker_codes = array("H")
+        self.texts: list[str] = []
+        # a speaker code is the index of the name in this list
+        self.speakers: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _speaker_code(self, speaker: str) -> int:
+        try:
+            return self.speakers.index(speaker)
+        except ValueError:
+            self.speakers.append(speaker)
+            return len(self.speakers) - 1
+
+    def speaker(self, index: int) -> str:
+        return self.speakers[self.speaker_codes[index]]
+
+    def turn(self, index: int) -> dict:
+        return {"speaker": self.speaker(index), "text": self.texts[index], "duration": self.durations[index]}
+
+    def items(self):
+        for index in range(len(self.offsets)):
+            yield self.offsets[index], self.turn(index)
+
+    def append(self, offset: int, speaker: str, text: str, duration: int = 0) -> int:
+        """
+        Adds a turn after the last one, which then lasts until this one starts. A turn starting at the same
+        offset as the last one, e.g. two turns within the same second of a MM:SS transcript, is merged into it,
+        transcripts.json being keyed by offset
+
+        :return: Index of the turn
+        :rtype: int
+        """
+        if len(self.offsets) > 0 and self.offsets[-1] == offset:
+            self.texts[-1] += "\n{}".format(text)
+            self.durations[-1] = max(self.durations[-1], duration)
+            return len(self.offsets) - 1
+
+        if len(self.offsets) > 0:
+            self.durations[-1] = offset - self.offsets[-1]
+
+        self.offsets.append(offset)
+        self.durations.append(duration)
+        self.speaker_codes.append(self._speaker_code(speaker))
+        self.texts.append(text)
+
+        return len(self.offsets) - 1
+
+    def append_or_merge(self, offset: int, speaker: str, text: str, duration: int = 0) -> int:
+        """
+        Adds a turn, or adds the text to the last turn when the same speaker is still talking
+
+        :return: Index of the turn the text went to
+        :rtype: int
+        """
+        if len(self.offsets) > 0 and self.speakers[self.speaker_codes[-1]] == speaker:
+            self.texts[-1] += "\n{}".format(text)
+            return len(self.offsets) - 1
+
+        return self.append(offset, speaker, text, duration)
+
+    def put(self, offset: int, speaker: str, text: str, duration: int = 0) -> int:
+        """
+        Replaces the last turn when it starts at offset, adds a turn otherwise. Meant for listeners
+        that receive the same turn again each time it is extended.
+        """
+        if len(self.offsets) > 0 and self.offsets[-1] == offset:
+            self.speaker_codes[-1] = self._speaker_code(speaker)
+            self.texts[-1] = text
+            self.durations[-1] = duration
+            return len(self.offsets) - 1
+
+        return self.append(offset, speaker, text, duration)
+
+    def slice(self, start: int, end: int | None = None) -> "TurnStore":
+        turns = TurnStore()
+        turns.offsets = self.offsets[start:end]
+        turns.durations = self.durations[start:end]
+        turns.speaker_codes = self.speaker_codes[start:end]
+        turns.texts = self.texts[start:end]
+        turns.speakers = list(self.speakers)
+
+        return turns
+
+    def to_dict(self) -> OrderedDict:
+        # the layout of transcripts.json, offsets as keys
+        conversation = OrderedDict(self.items())
+        # every turn file is named after the position of its turn, which a repeated offset would shift
+        if len(conversation) != len(self):
+            raise Exception("{} turns share their offset with another turn".format(len(self) - len(conversation)))
+
+        return conversation
+
+    @classmethod
+    def from_dict(cls, conversation: dict) -> "TurnStore":
+        turns = cls()
+        for offset, turn in conversation.items():
+            turns.offsets.append(int(offset))
+            turns.durations.append(int(turn.get("duration", 0)))
+            turns.speaker_codes.append(turns._speaker_code(turn["speaker"]))
+            turns.texts.append(turn["text"])
+
+        return turns
+
+    def to_json(self, path: str):
+        with open(path, "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=4, sort_keys=False)
+
+    @classmethod
+    def from_json(cls, path: str) -> "TurnStore":
+        with open(path, "r") as json_file:
+            return cls.from_dict(json.load(json_file, object_pairs_hook=OrderedDict))
+
+    def to_numpy(self) -> dict:
+        """
+        Returns the columns as NumPy arrays, the texts as one utf-8 buffer cut by text_ends, ready for numpy.savez
+        """
+        import numpy as np
+
+        encoded = [text.encode("utf-8") for text in self.texts]
+
+        return {
+            "offsets": np.frombuffer(self.offsets, dtype=np.int64).copy(),
+            "durations": np.frombuffer(self.durations, dtype=np.int64).copy(),
+            "speaker_codes": np.frombuffer(self.speaker_codes, dtype=np.uint16).copy(),
+            "speakers": np.array(self.speakers, dtype=str),
+            "texts": np.frombuffer(b"".join(encoded), dtype=np.uint8).copy(),
+            "text_ends": np.cumsum([len(text) for text in encoded], dtype=np.int64)
+        }
+
+    @classmethod
+    def from_numpy(cls, columns) -> "TurnStore":
+        turns = cls()
+        turns.offsets = array("q", columns["offsets"].astype("int64").tobytes())
+        turns.durations = array("q", columns["durations"].astype("int64").tobytes())
+        turns.speaker_codes = array("H", columns["speaker_codes"].astype("uint16").tobytes())
+        turns.speakers = [str(speaker) for speaker in columns["speakers"]]
+
+        texts, ends = bytes(columns["texts"]), columns["text_ends"].tolist()
+        turns.texts = [texts[start:end].decode("utf-8") for start, end in zip([0] + ends[:-1], ends)]
+
+        return turns
+
+    def save_npz(self, path: str):
+        import numpy as np
+
+        np.savez(path, **self.to_numpy())
+
+    @classmethod
+    def load_npz(cls, path: str) -> "TurnStore":
+        import numpy as np
+
+        with np.load(path) as columns:
+            return cls.from_numpy(columns)
+
+def encode_turn(offset: int, turn: dict) -> str:
+    # durations are left out, the model only needs the order and timing of the turns
+    return "[{}] {}: {}".format(format_offset(offset), turn["speaker"], " ".join(turn["text"].split()))
+
+def encode_transcript(conversation: TurnStore, token_budget: int | None = None, strategy: str = "middle") -> str:
+    """
+    Encodes a conversation as one "[MM:SS] Speaker: text" line per turn, dropping turns once over the budget
+
+    :param conversation: Transcript
+    :type conversation: TurnStore
+    :param token_budget: Maximum tokens of the encoded transcript, unlimited if None
+    :type token_budget: int | None
+    :param strategy: Turns kept when over budget, "head" for the first ones, "tail" for the last ones,
+        "middle" for both ends of the call
+    :type strategy: str
+    """
+    lines = [encode_turn(offset, turn) for offset, turn in conversation.items()]
+    if token_budget is None:
+        return "\n".join(lines)
+
+    if strategy not in ("head", "tail", "middle"):
+        raise ValueError("Unknown truncation strategy {}".format(strategy))
+
+    costs = [count_tokens(line) + 1 for line in lines]
+    if sum(costs) <= token_budget:
+        return "\n".join(lines)
+
+    marker_cost = count_tokens("[... 000 turns omitted ...]") + 1
+    budget = token_budget - marker_cost
+    head, tail = [], []
+    first, last = 0, len(lines) - 1
+
+    # take turns from the requested ends, alternating between both ends for the middle strategy
+    take_from_head = strategy != "tail"
+    while first <= last:
+        index = first if take_from_head else last
+        if costs[index] > budget:
+            break
+
+        budget -= costs[index]
+        if take_from_head:
+            head.append(lines[index])
+            first += 1
+        else:
+            tail.insert(0, lines[index])
+            last -= 1
+
+        if strategy == "middle":
+            take_from_head = not take_from_head
+
+    omitted = last - first + 1
+    if omitted == 0:
+        return "\n".join(head + tail)
+
+    return "\n".join(head + ["[... {} turns omitted ...]".format(omitted)] + tail)
+
+def load_transcript(path: str) -> TurnStore:
+    """
+    Loads a transcripts.json written by the splitter, turning offsets back into integers
+    """
+    return TurnStore.from_json(path)
+
+def find_transcripts(directories: list[str]) -> list[str]:
+    return sorted(
+        os.path.join(directory, recording, "transcripts.json")
+        for directory in directories
+        for recording in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, recording, "transcripts.json")) and not is_temporary_path(recording)
+    )
+
+# recordings of V-Processing are vishing calls, the ones of NV-Processing are not
+LABELLED_DIRECTORIES = {
+    "FRAUD": os.path.join(".", "Audio Recordings", "V-Processing"),
+    "SAFE": os.path.join(".", "Audio Recordings", "NV-Processing")
+}
+
+def load_dataset(directories: dict[str, str] = LABELLED_DIRECTORIES) -> list[tuple[str, str, TurnStore]]:
+    """
+    Loads every transcripts.json along with the label of the directory it was found in
+
+    :param directories: Directory of the recordings of each label
+    :type directories: dict[str, str]
+    :return: Path, label and conversation of every recording
+    :rtype: list[tuple[str, str, TurnStore]]
+    """
+    dataset = []
+    for label, directory in directories.items():
+        if not os.path.isdir(directory):
+            print("Skipping missing directory {}".format(directory))
+            continue
+
+        for transcript_file in find_transcripts([directory]):
+            dataset.append((transcript_file, label, load_transcript(transcript_file)))
+
+    return dataset
+
+def encoding_report(transcript_files: list[str], token_budget: int | None = None, detector=None) -> dict:
+    """
+    Compares the tokens, and the detection latency when given a detector, of the repr of the conversations
+    against their compact encoding
+
+    :param transcript_files: transcripts.json files
+    :type transcript_files: list[str]
+    :param token_budget: Budget of the compact encoding
+    :type token_budget: int | None
+    :param detector: LLMDetector measured on both encodings, tokens only if None
+    """
+    report = {"transcripts": len(transcript_files), "repr_tokens": 0, "compact_tokens": 0, "repr_seconds": 0.0, "compact_seconds": 0.0}
+
+    for transcript_file in transcript_files:
+        conversation = load_transcript(transcript_file)
+        before, after = str(conversation.to_dict()), encode_transcript(conversation, token_budget)
+        report["repr_tokens"] += count_tokens(before)
+        report["compact_tokens"] += count_tokens(after)
+
+        if detector is not None:
+            for key, content in (("repr_seconds", before), ("compact_seconds", after)):
+                start = time.perf_counter()
+                detector._analyse_call_for_vishing_naive(content)
+                report[key] += time.perf_counter() - start
+
+    if report["repr_tokens"] > 0:
+        report["token_reduction"] = 1 - report["compact_tokens"] / report["repr_tokens"]
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the tokens spent on the repr of the transcripts against their compact encoding")
+    parser.add_argument("directories", nargs="*", default=[
+        os.path.join(".", "Audio Recordings", "V-Processing"),
+        os.path.join(".", "Audio Recordings", "NV-Processing")
+    ])
+    parser.add_argument("--token-budget", type=int, default=None)
+    parser.add_argument("--latency", action="store_true", help="also time the naive detector on both encodings")
+    args = parser.parse_args()
+
+    detector = None
+    if args.latency:
+        from detector import LLMDetector
+        detector = LLMDetector()
+
+    print(json.dumps(encoding_report(find_transcripts(args.directories), args.token_budget, detector), indent=4))
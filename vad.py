@@ -0,0 +1,248 @@
+import numpy as np
+from pydantic import BaseModel
+from audio import PcmAudio, PcmReader, open_pcm_reader
+from segmentation import samples_from_pcm
+from transcript import TurnStore
+
+class VadSettings(BaseModel):
+    """
+    Thresholds of the energy and zero-crossing voice activity detection
+    """
+    frame_ms: int = 30
+    # frames louder than the noise floor, taken as this percentile of the frame energies, by margin_db are speech
+    noise_percentile: float = 10.0
+    margin_db: float = 12.0
+    # whatever the noise floor, quieter frames are never speech
+    min_energy_db: float = -55.0
+    # unvoiced consonants are quiet but cross zero often, such frames are kept when within zcr_margin_db of the threshold
+    zcr_threshold: float = 0.25
+    zcr_margin_db: float = 6.0
+    # shorter bursts, such as clicks, are not speech and shorter pauses are kept
+    min_speech_ms: int = 120
+    min_silence_ms: int = 1000
+    # audio kept around every stretch of speech, a dropped pause is compressed into twice that
+    padding_ms: int = 250
+
+def frame_features(samples: np.ndarray, frame_rate: int, frame_ms: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Energy in dB relative to full scale and zero-crossing rate of every whole frame of mono samples
+
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    frame_samples = max(1, frame_rate * frame_ms // 1000)
+    frames = samples[:len(samples) - len(samples) % frame_samples].reshape(-1, frame_samples)
+
+    energy = 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / max(1, frame_samples - 1)
+
+    return energy, zcr
+
+def _regions(speech: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # first frame and frame after the last one of every run of speech frames
+    edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def speech_regions(energy: np.ndarray, zcr: np.ndarray, settings: VadSettings) -> list[tuple[int, int]]:
+    """
+    Decides which frames are speech and groups them into padded regions, pauses shorter than min_silence_ms included
+
+    :return: First frame and frame after the last one of every region
+    :rtype: list[tuple[int, int]]
+    """
+    if len(energy) == 0:
+        return []
+
+    threshold = max(float(np.percentile(energy, settings.noise_percentile)) + settings.margin_db, settings.min_energy_db)
+    speech = (energy > threshold) | ((energy > threshold - settings.zcr_margin_db) & (zcr > settings.zcr_threshold))
+
+    starts, ends = _regions(speech)
+    long_enough = ends - starts >= settings.min_speech_ms / settings.frame_ms
+    starts, ends = starts[long_enough], ends[long_enough]
+    if len(starts) == 0:
+        return []
+
+    # pauses that padding would close anyway are merged as well
+    min_gap = max(settings.min_silence_ms, 2 * settings.padding_ms) / settings.frame_ms
+    kept_gaps = starts[1:] - ends[:-1] >= min_gap
+    starts = starts[np.concatenate(([True], kept_gaps))]
+    ends = ends[np.concatenate((kept_gaps, [True]))]
+
+    padding = int(np.ceil(settings.padding_ms / settings.frame_ms))
+    starts = np.maximum(starts - padding, 0)
+    ends = np.minimum(ends + padding, len(energy))
+
+    return list(zip(starts.tolist(), ends.tolist()))
+
+class OffsetMap:
+    """
+    Ranges of the original recording kept by the trimming, laid end to end in the trimmed recording,
+    to translate milliseconds between both
+    """
+    def __init__(self, kept: list[tuple[int, int]], duration_ms: int):
+        """
+        :param kept: Start and end in milliseconds of every range of the original recording kept, in order
+        :type kept: list[tuple[int, int]]
+        :param duration_ms: Length of the original recording
+        :type duration_ms: int
+        """
+        self.duration_ms = duration_ms
+        self.original_starts = np.array([start for start, _ in kept], dtype=np.int64)
+        self.lengths = np.array([end - start for start, end in kept], dtype=np.int64)
+        self.trimmed_starts = np.concatenate(([0], np.cumsum(self.lengths)[:-1])).astype(np.int64) if len(kept) > 0 else np.empty(0, dtype=np.int64)
+
+    @property
+    def trimmed_ms(self) -> int:
+        return int(self.lengths.sum())
+
+    def kept(self) -> list[tuple[int, int]]:
+        return list(zip(self.original_starts.tolist(), (self.original_starts + self.lengths).tolist()))
+
+    def to_original(self, trimmed_ms: int) -> int:
+        """
+        Offset in the original recording of an offset of the trimmed one
+        """
+        if len(self.lengths) == 0:
+            return trimmed_ms
+
+        index = max(0, int(np.searchsorted(self.trimmed_starts, trimmed_ms, side="right")) - 1)
+
+        return int(self.original_starts[index] + trimmed_ms - self.trimmed_starts[index])
+
+    def to_trimmed(self, original_ms: int) -> int:
+        """
+        Offset in the trimmed recording of an offset of the original one, offsets within a dropped pause
+        land where the pause was cut
+        """
+        if len(self.lengths) == 0:
+            return 0
+
+        index = int(np.searchsorted(self.original_starts, original_ms, side="right")) - 1
+        if index < 0:
+            return 0
+
+        return int(self.trimmed_starts[index] + min(original_ms - self.original_starts[index], self.lengths[index]))
+
+    def restore(self, conversation: TurnStore) -> TurnStore:
+        """
+        Copy of a transcript of the trimmed recording with its offsets and durations in the original recording,
+        a turn spanning a dropped pause lasts through it
+        """
+        restored = conversation.slice(0)
+        for index, (offset, duration) in enumerate(zip(conversation.offsets, conversation.durations)):
+            restored.offsets[index] = self.to_original(offset)
+            restored.durations[index] = self.to_original(offset + duration) - restored.offsets[index]
+
+        return restored
+
+    def report(self) -> dict:
+        return {
+            "original_seconds": self.duration_ms / 1000,
+            "trimmed_seconds": self.trimmed_ms / 1000,
+            "saved_seconds": (self.duration_ms - self.trimmed_ms) / 1000,
+            "saved_share": (self.duration_ms - self.trimmed_ms) / self.duration_ms if self.duration_ms > 0 else 0.0,
+            "regions": len(self.lengths)
+        }
+
+def detect_speech(path: str, settings: VadSettings | None = None, chunk_frames: int = 65536) -> OffsetMap:
+    """
+    Finds the speech of a recording in a single streamed pass over its samples, a chunk at a time
+
+    :param path: Recording of any format
+    :type path: str
+    :param settings: Thresholds of the detection
+    :type settings: VadSettings | None
+    :return: Ranges of the recording to keep
+    :rtype: OffsetMap
+    """
+    settings = settings or VadSettings()
+    energies, zcrs = [], []
+
+    with open_pcm_reader(path) as reader:
+        frame_samples = max(1, reader.frame_rate * settings.frame_ms // 1000)
+        frame_rate = reader.frame_rate
+        # chunks are cut on whole frames of the detection, the rest is carried to the next chunk
+        remainder = np.empty(0, dtype=np.float32)
+        sample_count = 0
+
+        for chunk in reader.chunks(chunk_frames):
+            samples = samples_from_pcm(PcmAudio(chunk, reader.channels, reader.sample_width, reader.frame_rate)).mean(axis=1)
+            sample_count += len(samples)
+            samples = np.concatenate((remainder, samples))
+            whole = len(samples) - len(samples) % frame_samples
+
+            energy, zcr = frame_features(samples[:whole], frame_rate, settings.frame_ms)
+            energies.append(energy)
+            zcrs.append(zcr)
+            remainder = samples[whole:]
+
+    duration_ms = sample_count * 1000 // frame_rate
+    regions = speech_regions(np.concatenate(energies or [np.empty(0)]), np.concatenate(zcrs or [np.empty(0)]), settings)
+    # a frame is a whole number of samples, e.g. 661 at 22050Hz, so it lasts slightly less than frame_ms
+    kept = [
+        (start * frame_samples * 1000 // frame_rate, min(end * frame_samples * 1000 // frame_rate, duration_ms))
+        for start, end in regions
+    ]
+
+    return OffsetMap(kept, duration_ms)
+
+class TrimmedReader(PcmReader):
+    """
+    Reads only the ranges of a recording an OffsetMap keeps, so that the trimmed recording is never written anywhere
+    """
+    def __init__(self, reader: PcmReader, offset_map: OffsetMap):
+        self.reader = reader
+        self.channels = reader.channels
+        self.sample_width = reader.sample_width
+        self.frame_rate = reader.frame_rate
+        self.frame_width = reader.frame_width
+
+        self._ranges = [(start * self.frame_rate // 1000, end * self.frame_rate // 1000) for start, end in offset_map.kept()]
+        self._range = 0
+        self._position = 0
+        self._pending = bytearray()
+
+    def read(self, frames: int) -> bytes:
+        size = frames * self.frame_width
+        while len(self._pending) < size and self._range < len(self._ranges):
+            chunk = self.reader.read(max(frames, 65536))
+            if len(chunk) == 0:
+                break
+
+            chunk_start = self._position
+            self._position += len(chunk) // self.frame_width
+
+            while self._range < len(self._ranges):
+                start, end = self._ranges[self._range]
+                if start >= self._position:
+                    break
+
+                first, last = max(start, chunk_start), min(end, self._position)
+                if last > first:
+                    self._pending += chunk[(first - chunk_start) * self.frame_width:(last - chunk_start) * self.frame_width]
+
+                if end > self._position:
+                    break
+                self._range += 1
+
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+
+        return data
+
+    def close(self):
+        self.reader.close()
+
+def vad_report(files: list[str], settings: VadSettings | None = None) -> list[dict]:
+    """
+    Measures how much audio trimming would save on every recording, without writing anything
+    """
+    reports = []
+    for file in files:
+        report = detect_speech(file, settings).report()
+        report["file"] = file
+        reports.append(report)
+        print("{}: {:.1f}s of {:.1f}s are speech, {:.1f}s saved".format(file, report["trimmed_seconds"], report["original_seconds"], report["saved_seconds"]))
+
+    return reports